@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2024 Numurus, LLC <https://www.numurus.com>.
+#
+# This file is part of nepi-engine
+# (see https://github.com/nepi-engine).
+#
+# License: 3-clause BSD, see https://opensource.org/licenses/BSD-3-Clause
+#
+
+
+##########################################
+# Benchmark the data prep stages on synthetic projects
+##########################################
+
+
+imports = True
+try:
+    import os
+    import sys
+    import io
+    import time
+    import json
+    import zlib
+    import random
+    import shutil
+    import struct
+    import argparse
+    import platform
+    import contextlib
+    import concurrent.futures
+    import numpy as np
+    from PIL import Image
+except Exception as e:
+    print("Missing required python modules " + str(e))
+    print("Connect to internet and run the following in this folder")
+    print("sudo pip3 install -r requirements.txt")
+    print("Then try rerunning this script agian")
+    imports = False
+
+if imports == True:
+  import nepi_ai_train as ai_utils
+  imports = ai_utils.imports
+
+if imports == True:
+  import nepi_ai_catalog as ai_catalog
+  imports = ai_catalog.imports
+
+if imports == True:
+  import nepi_ai_label_index as ai_label_index
+  imports = ai_label_index.imports
+
+if imports == True:
+  import yolo_detector_utils as yolo_utils
+  imports = yolo_utils.imports
+
+
+if imports == False:
+    sys.exit(1) # Terminate the script with an exit code (e.g., 1 for error)
+
+
+##########################################
+# Variables
+##########################################
+
+BENCHMARK_SIZES = [10000, 100000, 1000000]
+BENCHMARK_FOLDER_SIZE = 1000
+BENCHMARK_CLASSES = ['Can', 'Lamp', 'Bulb', 'Box', 'Person']
+BENCHMARK_IMAGE_SIZE = [64, 48]
+BENCHMARK_MAX_BOXES = 6
+BENCHMARK_PNG_PERCENT = 10
+BENCHMARK_UNLABELED_PERCENT = 10
+BENCHMARK_NUM_TEMPLATES = 16
+BENCHMARK_RESULTS_FILE_NAME = 'benchmark_results.json'
+
+VOC_XML = ('<annotation><folder>{folder}</folder><filename>{file_name}</filename>'
+           '<size><width>{width}</width><height>{height}</height><depth>3</depth></size>{objects}</annotation>\n')
+VOC_OBJECT = ('<object><name>{name}</name><pose>Unspecified</pose><truncated>0</truncated><difficult>0</difficult>'
+              '<bndbox><xmin>{xmin}</xmin><ymin>{ymin}</ymin><xmax>{xmax}</xmax><ymax>{ymax}</ymax></bndbox></object>')
+
+##########################################
+# Methods
+##########################################
+
+def make_image_templates(num_templates, image_size, seed = 0):
+    # Returns {'jpg': [...], 'png': [...]} encoded noise images. Noise keeps the perceptual hashes apart.
+    rng = np.random.default_rng(seed)
+    templates = {'jpg': [], 'png': []}
+    [width, height] = image_size
+    for ind in range(num_templates):
+        image = Image.fromarray(rng.integers(0, 256, size = (height, width, 3), dtype = np.uint8))
+        for f_ext, image_format in [['jpg', 'JPEG'], ['png', 'PNG']]:
+            buffer = io.BytesIO()
+            image.save(buffer, format = image_format)
+            templates[f_ext].append(buffer.getvalue())
+    return templates
+
+
+def make_unique_image(template, f_ext, tag):
+    # Adds a comment to an encoded image so every synthetic file has its own content hash
+    payload = tag.encode('utf-8')
+    if f_ext == 'png':
+        chunk = b'tEXt' + b'Comment\x00' + payload
+        # The text chunk goes right after the 8 byte signature and 25 byte IHDR chunk
+        return template[:33] + struct.pack('>I', len(chunk) - 4) + chunk + struct.pack('>I', zlib.crc32(chunk)) + template[33:]
+    return template[:2] + b'\xff\xfe' + struct.pack('>H', len(payload) + 2) + payload + template[2:]
+
+
+def make_voc_xml(folder_name, file_name, image_size, rng):
+    [width, height] = image_size
+    objects = []
+    for ind in range(rng.randint(1, BENCHMARK_MAX_BOXES)):
+        xmin = rng.randint(0, width - 8)
+        ymin = rng.randint(0, height - 8)
+        objects.append(VOC_OBJECT.format(name = rng.choice(BENCHMARK_CLASSES), xmin = xmin, ymin = ymin,
+                                         xmax = rng.randint(xmin + 4, width), ymax = rng.randint(ymin + 4, height)))
+    return VOC_XML.format(folder = folder_name, file_name = file_name, width = width, height = height, objects = ''.join(objects))
+
+
+def write_synthetic_folder(folder_path, num_images, templates, image_size, seed):
+    # Writes one raw data folder of tiny images, most of them with a VOC xml label file
+    rng = random.Random(seed)
+    os.makedirs(folder_path)
+    folder_name = os.path.basename(folder_path)
+    for ind in range(num_images):
+        f_ext = 'png' if rng.random() * 100 < BENCHMARK_PNG_PERCENT else 'jpg'
+        f_base = folder_name + '_' + str(ind).zfill(6)
+        file_name = f_base + '.' + f_ext
+        template = templates[f_ext][rng.randrange(len(templates[f_ext]))]
+        with open(os.path.join(folder_path, file_name), 'wb') as f:
+            f.write(make_unique_image(template, f_ext, f_base))
+        if rng.random() * 100 >= BENCHMARK_UNLABELED_PERCENT:
+            with open(os.path.join(folder_path, f_base + '.xml'), 'w') as f:
+                f.write(make_voc_xml(folder_name, file_name, image_size, rng))
+    return num_images
+
+
+def create_synthetic_project(project_folder, num_images, folder_size = BENCHMARK_FOLDER_SIZE, seed = 0):
+    # Creates a project folder in the nepi_yolo_detector_training layout with num_images raw images.
+    # Returns the project settings dict.
+    if os.path.exists(project_folder):
+        shutil.rmtree(project_folder)
+    data_folder = os.path.join(project_folder, yolo_utils.DATA_RAW_FOLDER)
+    for folder in [yolo_utils.DATA_RAW_FOLDER, yolo_utils.DATA_LABEL_FOLDER, yolo_utils.MODEL_TRAIN_FOLDER, yolo_utils.MODEL_DEPLOY_FOLDER]:
+        os.makedirs(os.path.join(project_folder, folder))
+    templates = make_image_templates(BENCHMARK_NUM_TEMPLATES, BENCHMARK_IMAGE_SIZE, seed = seed)
+    folder_sizes = [folder_size] * (num_images // folder_size)
+    if num_images % folder_size > 0:
+        folder_sizes.append(num_images % folder_size)
+    folder_paths = [os.path.join(data_folder, 'capture_' + str(ind).zfill(5)) for ind in range(len(folder_sizes))]
+    seeds = [seed * 100000 + ind for ind in range(len(folder_sizes))]
+    with concurrent.futures.ProcessPoolExecutor(max_workers = os.cpu_count() or 1) as executor:
+        list(executor.map(write_synthetic_folder, folder_paths, folder_sizes, [templates] * len(folder_sizes),
+                          [BENCHMARK_IMAGE_SIZE] * len(folder_sizes), seeds))
+
+    project_dict = dict()
+    template_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), yolo_utils.PROJECT_FILE)
+    if os.path.exists(template_file):
+        project_dict = ai_utils.read_dict_from_file(template_file) or dict()
+    project_dict.update({
+        'MODEL_NAME': 'benchmark',
+        'DESCRIPTION': 'synthetic benchmark project',
+        'CLASSES': list(BENCHMARK_CLASSES),
+        'CLASSES_DICT': ai_utils.create_classes_dict(BENCHMARK_CLASSES),
+        'USE_PERCENT_DATA': 100,
+        'RANDOM_DATA_SIZE': min(100, num_images),
+        'RANDOM_SEED': seed
+    })
+    project_dict.setdefault('IMAGE_SIZE', 640)
+    ai_utils.write_dict_to_file(project_dict, os.path.join(project_folder, yolo_utils.PROJECT_FILE))
+    return project_dict
+
+
+def run_data_prep(project_folder, project_dict, metrics, link_mode = 'copy', seed = 0):
+    # Runs the data prep stages the way the initialize and train scripts do, with one metrics stage each
+    data_folder = os.path.join(project_folder, yolo_utils.DATA_RAW_FOLDER)
+    label_folder = os.path.join(project_folder, yolo_utils.DATA_LABEL_FOLDER)
+    train_folder = os.path.join(project_folder, yolo_utils.MODEL_TRAIN_FOLDER)
+    classes = list(project_dict['CLASSES'])
+    classes_dict = dict(project_dict['CLASSES_DICT'])
+    catalog = ai_catalog.dataset_catalog(project_folder)
+
+    metrics.start_stage('fix_data_files')
+    fixed_files = ai_utils.fix_data_files(data_folder)
+    metrics.start_stage('update_labling_data')
+    imgs_list = ai_utils.update_labling_data(data_folder, label_folder, project_dict['USE_PERCENT_DATA'], catalog = catalog,
+                                             seed = seed, link_mode = link_mode)
+    metrics.start_stage('create_random_data_set')
+    # A new random set folder is made on every run, so only the first run is timed
+    random_folder_path = os.path.join(label_folder, yolo_utils.RANDOM_FILE_NAME)
+    if os.path.exists(random_folder_path + '_1') == False:
+        rand_imgs_list = ai_utils.create_random_data_set(imgs_list, random_folder_path, project_dict['RANDOM_DATA_SIZE'],
+                                                         seed = seed, link_mode = link_mode)
+    metrics.start_stage('convert_xml_files')
+    for folder in ai_utils.get_folder_list(label_folder):
+        [classes, classes_dict] = ai_utils.convert_xml_files(folder, classes, classes_dict, unknown_action = 'skip')
+    metrics.start_stage('update_stats_file')
+    label_index = ai_label_index.label_index(label_folder, classes = classes)
+    stats_dict = ai_utils.update_stats_file(label_folder, catalog = catalog, label_index = label_index)
+    metrics.start_stage('update_train_files')
+    success = yolo_utils.update_train_files(project_dict, label_folder, train_folder, catalog = catalog)
+    metrics.end_stage()
+    catalog.close()
+    ai_utils.pop_written_paths()
+    return success
+
+
+def run_benchmark(output_folder, sizes, folder_size = BENCHMARK_FOLDER_SIZE, link_mode = 'copy', num_passes = 2,
+                  keep = False, quiet = True, seed = 0):
+    # Returns a list of result dicts, one for each size and pass. The first pass starts from an empty
+    # labeling folder and catalog, later passes measure reruns with nothing new to do.
+    results = []
+    for num_images in sizes:
+        project_folder = os.path.join(output_folder, 'benchmark_' + str(num_images))
+        print('Creating synthetic project with ' + str(num_images) + ' images in: ' + project_folder)
+        start_time = time.time()
+        project_dict = create_synthetic_project(project_folder, num_images, folder_size = folder_size, seed = seed)
+        generate_seconds = time.time() - start_time
+        print('Created synthetic project in ' + str(round(generate_seconds, 1)) + ' secs')
+        for pass_ind in range(num_passes):
+            pass_name = 'cold' if pass_ind == 0 else 'warm_' + str(pass_ind)
+            print('Running ' + pass_name + ' data prep pass for ' + str(num_images) + ' images')
+            metrics = ai_utils.start_run_metrics('benchmark')
+            output = open(os.devnull, 'w') if quiet == True else sys.stdout
+            try:
+                with contextlib.redirect_stdout(output):
+                    success = run_data_prep(project_folder, project_dict, metrics, link_mode = link_mode, seed = seed)
+                    stage_dicts = metrics.finish(success)
+            finally:
+                if quiet == True:
+                    output.close()
+            ai_utils.RUN_METRICS = None
+            result_dict = {
+                'num_images': num_images,
+                'num_folders': int(np.ceil(num_images / float(folder_size))),
+                'pass': pass_name,
+                'link_mode': link_mode,
+                'success': bool(success),
+                'generate_seconds': round(generate_seconds, 3),
+                'seconds': round(sum(stage_dict['seconds'] for stage_dict in stage_dicts), 3),
+                'stages': stage_dicts
+            }
+            results.append(result_dict)
+            print_result(result_dict)
+        if keep == False:
+            shutil.rmtree(project_folder)
+    return results
+
+
+def print_result(result_dict, compare_dict = None):
+    print(str(result_dict['num_images']) + ' images, ' + result_dict['pass'] + ' pass: ' + str(result_dict['seconds']) + ' secs')
+    compare_stages = dict()
+    if compare_dict is not None:
+        compare_stages = dict((stage_dict['stage'], stage_dict) for stage_dict in compare_dict['stages'])
+    for stage_dict in result_dict['stages']:
+        line = '  ' + stage_dict['stage'].ljust(24) + str(stage_dict['seconds']).rjust(10) + ' secs'
+        compare_stage = compare_stages.get(stage_dict['stage'])
+        if compare_stage is not None:
+            ratio = stage_dict['seconds'] / max(compare_stage['seconds'], 1e-3)
+            line += '  ' + str(round(ratio, 2)).rjust(6) + 'x of ' + str(compare_stage['seconds']) + ' secs'
+        print(line)
+
+
+def get_git_commit():
+    try:
+        import subprocess
+        folder = os.path.dirname(os.path.realpath(__file__))
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = folder, capture_output = True, text = True).stdout.strip()
+    except Exception:
+        return ''
+
+
+###############################################
+# Main
+###############################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Times the data prep stages on synthetic projects of several sizes')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = BENCHMARK_SIZES, help = 'number of images in each project')
+    parser.add_argument('--folder-size', type = int, default = BENCHMARK_FOLDER_SIZE, help = 'images in each raw data folder')
+    parser.add_argument('--output-folder', default = os.path.join('/tmp', 'nepi_ai_benchmark'), help = 'folder for the synthetic projects')
+    parser.add_argument('--results-file', default = None, help = 'json results file, default is in the output folder')
+    parser.add_argument('--compare', default = None, help = 'earlier json results file to compare stage times with')
+    parser.add_argument('--link-mode', default = 'copy', choices = ai_utils.LINK_MODES)
+    parser.add_argument('--passes', type = int, default = 2, help = 'data prep passes for each size, the first one is cold')
+    parser.add_argument('--keep', action = 'store_true', help = 'keep the synthetic projects')
+    parser.add_argument('--verbose', action = 'store_true', help = 'show the output of each stage')
+    args = parser.parse_args()
+
+    if os.path.exists(args.output_folder) == False:
+        os.makedirs(args.output_folder)
+    results_file = args.results_file
+    if results_file is None:
+        results_file = os.path.join(args.output_folder, BENCHMARK_RESULTS_FILE_NAME)
+    ai_utils.set_data_store_folder(os.path.join(args.output_folder, ai_utils.DATA_STORE_FOLDER_NAME))
+
+    results = run_benchmark(args.output_folder, args.sizes, folder_size = args.folder_size, link_mode = args.link_mode,
+                            num_passes = args.passes, keep = args.keep, quiet = args.verbose == False)
+    results_dict = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': get_git_commit(),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'results': results
+    }
+    ai_utils.write_file_atomic(results_file, lambda f: json.dump(results_dict, f, indent = 2))
+    print('Saved benchmark results to: ' + results_file)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare_results = json.load(f)['results']
+        print('Compared with: ' + args.compare)
+        for result_dict in results:
+            compare_dict = None
+            for old_dict in compare_results:
+                if old_dict['num_images'] == result_dict['num_images'] and old_dict['pass'] == result_dict['pass']:
+                    compare_dict = old_dict
+            print_result(result_dict, compare_dict)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2024 Numurus, LLC <https://www.numurus.com>.
+#
+# This file is part of nepi-engine
+# (see https://github.com/nepi-engine).
+#
+# License: 3-clause BSD, see https://opensource.org/licenses/BSD-3-Clause
+#
+
+
+##########################################
+# Remove unused images from the data store
+##########################################
+
+
+imports = True
+try:
+    import os
+    import sys
+except Exception as e:
+    print("Missing required python modules " + str(e))
+    print("Connect to internet and run the following in this folder")
+    print("sudo pip3 install -r requirements.txt")
+    print("Then try rerunning this script agian")
+    imports = False
+
+if imports == True:
+  import nepi_ai_train as ai_utils
+  imports = ai_utils.imports
+
+if imports == True:
+  import yolo_detector_utils as yolo_utils
+  imports = yolo_utils.imports
+
+
+if imports == False:
+    sys.exit(1) # Terminate the script with an exit code (e.g., 1 for error)
+
+
+###############################################
+# Main
+###############################################
+
+if __name__ == '__main__':
+    sudo = ai_utils.check_for_sudo()
+    print('Starting clean data store process')
+    project = yolo_utils.project_yolo_detector()
+    store_folder = project.store_folder
+    label_folder = project.label_folder
+    metrics = project.start_run_metrics('clean_data_store')
+
+    if os.path.exists(store_folder) == False:
+        print('No data store found in project folder: ' + project.project_folder)
+    else:
+        metrics.start_stage('data_store_gc')
+        [num_removed, num_bytes] = ai_utils.gc_data_store(store_folder,[label_folder])
+        metrics.start_stage('permissions')
+        success = ai_utils.fix_folder_permissions(store_folder,project.user,project.group)
+    metrics.finish()
+    success = ai_utils.fix_folder_permissions(project.project_folder,project.user,project.group,file_paths = ai_utils.pop_written_paths())
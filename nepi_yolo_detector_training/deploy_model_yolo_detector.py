@@ -62,11 +62,14 @@ if __name__ == '__main__':
     model_name = project.model_name
     base_model = project.base_model
     image_size = project.image_size
+    metrics = project.start_run_metrics('deploy')
 
 
     print('Updating folder pbest_model_pathermissions')
+    metrics.start_stage('permissions')
     success = ai_utils.fix_folder_permissions(train_folder,project.user,project.group)
     success = ai_utils.fix_folder_permissions(deploy_folder,project.user,project.group)
+    metrics.start_stage('deploy_model')
     best_model_path = None
     deploy_name = model_name + '_' + base_model.replace('.pt','') + '_' + str(image_size)
     copy_file_path = os.path.join(deploy_folder,deploy_name+'.pt')
@@ -89,4 +92,8 @@ if __name__ == '__main__':
                 print('Failed to update model yaml file')
         else:
             print('Failed to update model from best')
-    success = ai_utils.fix_folder_permissions(deploy_folder,project.user,project.group)
+    metrics.start_stage('permissions')
+    written_paths = ai_utils.pop_written_paths()
+    success = ai_utils.fix_folder_permissions(deploy_folder,project.user,project.group,file_paths = written_paths)
+    metrics.finish(best_model_path is not None)
+    success = ai_utils.fix_folder_permissions(project_folder,project.user,project.group,file_paths = ai_utils.pop_written_paths())
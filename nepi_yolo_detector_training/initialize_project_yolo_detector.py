@@ -16,6 +16,7 @@
 imports = True
 try:
     import os
+    import sys
     import copy
 except Exception as e:
     print("Missing required python modules " + str(e))
@@ -28,6 +29,14 @@ if imports == True:
   import nepi_ai_train as ai_utils
   imports = ai_utils.imports
 
+if imports == True:
+  import nepi_ai_catalog as ai_catalog
+  imports = ai_catalog.imports
+
+if imports == True:
+  import nepi_ai_label_index as ai_label_index
+  imports = ai_label_index.imports
+
 if imports == True:
   import yolo_detector_utils as yolo_utils
   imports = yolo_utils.imports
@@ -66,34 +75,98 @@ if __name__ == '__main__':
     classes_file = project.classes_file
     random_file_name = project.random_file_name
     random_data_size = project.random_data_size
+    random_seed = project.random_seed
     print("Use Percent Data: " + str(use_percent_data))
-
-
+    metrics = project.start_run_metrics('initialize')
+    catalog = ai_catalog.dataset_catalog(project_folder)
+    check_cache_file = os.path.join(project_folder,ai_utils.IMAGE_CHECK_CACHE_FILE_NAME)
+    ai_utils.load_image_check_cache(check_cache_file)
+    # Records finished folders so a run that was interrupted resumes where it stopped
+    journal_file = os.path.join(project_folder,ai_utils.STAGE_JOURNAL_FILE_NAME)
+    # Classes are left out of the run key since this run can add to them, see the convert_classes stage
+    run_dict = dict((key, value) for key, value in project_dict.items() if key not in ['CLASSES','CLASSES_DICT'])
+    journal = ai_utils.stage_journal(journal_file, run_key = ai_utils.get_data_hash(str(run_dict).encode('utf-8')))
+
+
+    metrics.start_stage('fix_data')
     success = ai_utils.fix_folder_permissions(data_folder,project.user,project.group)
     fixed_files = ai_utils.fix_data_files(label_folder)
-    fixed_files = ai_utils.fix_data_files(data_folder)
+    fixed_files = ai_utils.fix_data_files(data_folder, recursive = project.recursive_data_folders)
     # Copy/Update files from raw data folder
-    imgs_list = ai_utils.update_labling_data(data_folder, label_folder, use_percent_data)
+    metrics.start_stage('link_data')
+    imgs_list = ai_utils.update_labling_data(data_folder, label_folder, use_percent_data, catalog = catalog, seed = random_seed,
+                                             link_mode = project.data_link_mode, recursive = project.recursive_data_folders,
+                                             journal = journal)
+    if imgs_list == False:
+        print('Failed to update labeling data folder: ' + label_folder)
+        catalog.close()
+        sys.exit(1)
 
     random_folder_path = os.path.join(label_folder,random_file_name)          
-    rand_imgs_list = ai_utils.create_random_data_set(imgs_list,random_folder_path,random_data_size) 
+    metrics.start_stage('random_set')
+    if journal.is_done('random_set', random_folder_path) == False:
+        rand_imgs_list = ai_utils.create_random_data_set(imgs_list,random_folder_path,random_data_size,seed = random_seed,
+                                                         link_mode = project.data_link_mode, journal = journal)
+        journal.mark_done('random_set', random_folder_path)
     # Check/Fix xml labels and save txt label files
- 
+    metrics.start_stage('convert_xml')
     folders = ai_utils.get_folder_list(label_folder)
     new_classes = copy.deepcopy(classes)
     new_classes_dict = copy.deepcopy(classes_dict)
+    # Existing txt label files are only current if the classes list is unchanged
+    classes_changed = os.path.exists(classes_file) == False or ai_utils.read_list_from_file(classes_file) != classes
+    # Collect unknown labels from all folders first so each one is resolved only once
+    xml_files = []
     for folder in folders:
-        [new_classes,new_classes_dict] = ai_utils.convert_xml_files(folder,new_classes,new_classes_dict)
-    print(new_classes_dict)
+        if classes_changed == True:
+            xml_files += ai_utils.get_file_list(folder, ext_list = ['xml'])
+        else:
+            xml_files += ai_utils.get_stale_xml_files(folder)[0]
+    unknown_labels = ai_utils.find_unknown_labels(xml_files,new_classes,new_classes_dict)
+    if len(unknown_labels) > 0:
+        print('Found unknown labels: ' + str(unknown_labels))
+        [new_classes,new_classes_dict,unresolved_labels] = ai_utils.resolve_unknown_labels(unknown_labels,new_classes,new_classes_dict,
+                                                                                           project.label_mapping,project.unknown_label_action)
     if new_classes != classes or new_classes_dict != classes_dict:
+        # Saved before any txt files use the new class indexes, so an interrupted run resumes with the same classes
+        print('Updating classes in project settings')
+        project.update_classes(copy.deepcopy(new_classes),copy.deepcopy(new_classes_dict))
+    # Folders converted with other classes in an interrupted run have to be converted again
+    classes_key = str([new_classes,new_classes_dict])
+    if journal.is_done('convert_classes', classes_key) == False:
+        journal.reset_stage('convert_xml')
+        journal.reset_stage('convert_classes')
+        journal.mark_done('convert_classes', classes_key)
+    for folder in journal.get_pending('convert_xml', folders):
+        [new_classes,new_classes_dict] = ai_utils.convert_xml_files(folder,new_classes,new_classes_dict,force = classes_changed,
+                                                                    label_mapping = project.label_mapping,unknown_action = 'skip')
+        journal.mark_done('convert_xml', folder)
+    print(new_classes_dict)
+    if new_classes != project.classes or new_classes_dict != project.classes_dict:
         print('Updating classes in project settings')
         project.update_classes(new_classes,new_classes_dict)
-    ai_utils.write_list_to_file(classes,classes_file)
+    ai_utils.write_list_to_file(new_classes,classes_file)
     print('Updating folder stats')
-    stats_dict = ai_utils.update_stats_file(data_folder)
-    stats_dict = ai_utils.update_stats_file(label_folder)
-
-    success = ai_utils.fix_folder_permissions(project_folder,project.user,project.group)
+    metrics.start_stage('stats')
+    stats_dict = ai_utils.update_stats_file(data_folder, catalog = catalog)
+    label_index = ai_label_index.label_index(label_folder)
+    stats_dict = ai_utils.update_stats_file(label_folder, catalog = catalog, label_index = label_index)
+    catalog.close()
+    ai_utils.save_image_check_cache(check_cache_file)
+    if project.data_link_mode == 'store':
+        print('Removing unused images from data store')
+        metrics.start_stage('data_store_gc')
+        ai_utils.gc_data_store(project.store_folder,[label_folder])
+
+    journal.finish()
+
+    # Only paths written during this run need their permissions updated
+    metrics.start_stage('permissions')
+    written_paths = ai_utils.pop_written_paths()
+    success = ai_utils.fix_folder_permissions(project_folder,project.user,project.group,file_paths = written_paths)
+    metrics.finish(success)
+    # The run log is written last
+    success = ai_utils.fix_folder_permissions(project_folder,project.user,project.group,file_paths = ai_utils.pop_written_paths())
 
 
       
@@ -29,6 +29,14 @@ if imports == True:
   import nepi_ai_train as ai_utils
   imports = ai_utils.imports
 
+if imports == True:
+  import nepi_ai_catalog as ai_catalog
+  imports = ai_catalog.imports
+
+if imports == True:
+  import nepi_ai_label_index as ai_label_index
+  imports = ai_label_index.imports
+
 if imports == True:
   import yolo_detector_utils as yolo_utils
   imports = yolo_utils.imports
@@ -56,13 +64,16 @@ if __name__ == '__main__':
     label_folder = project.label_folder
     classes = project.classes
     classes_dict = project.classes_dict
+    metrics = project.start_run_metrics('label')
 
     if os.path.exists(label_folder) == False:
         print('Failed to find required project folder: ' + label_folder + " " + str())
     else:
 
         print('Updating folder permissions')
+        metrics.start_stage('permissions')
         success = ai_utils.fix_folder_permissions(label_folder,project.user,project.group)
+        metrics.end_stage()
 
         if os.path.exists(LABEL_IMAGE_CONFIG_FILE):
             print("Reseting labelImg config for new session " + str(LABEL_IMAGE_CONFIG_FILE)) 
@@ -92,6 +103,7 @@ if __name__ == '__main__':
             args = [sel_path,classes_file]
             command = [script] + args
             print("Launching script with command " + str(command)) 
+            metrics.start_stage('labeling')
             try:
                 result = subprocess.run(command, capture_output=True, text=True, check=True)
                 print("Script output:")
@@ -103,16 +115,28 @@ if __name__ == '__main__':
                 print("Error starting script: " + script + " " + str(e))
 
             print('Updating converting xml files to txt files')
+            metrics.start_stage('convert_xml')
             new_classes = copy.deepcopy(classes)
             new_classes_dict = copy.deepcopy(classes_dict)
-            [new_classes,new_classes_dict] = ai_utils.convert_xml_files(sel_path,classes,classes_dict)
+            [new_classes,new_classes_dict] = ai_utils.convert_xml_files(sel_path,new_classes,new_classes_dict,
+                                                                        label_mapping = project.label_mapping,
+                                                                        unknown_action = project.unknown_label_action)
             if new_classes != classes or new_classes_dict != classes_dict:
                 project.update_classes(new_classes,new_classes_dict)
             print('Updating folder stats')
-            stats_dict = ai_utils.update_stats_file(label_folder)
+            metrics.start_stage('stats')
+            catalog = ai_catalog.dataset_catalog(project.project_folder)
+            # Labels are edited in place, which does not change the folder mtime
+            catalog.refresh_folder(sel_path, force = True)
+            label_index = ai_label_index.label_index(label_folder)
+            stats_dict = ai_utils.update_stats_file(label_folder, catalog = catalog, label_index = label_index)
+            catalog.close()
             #print('Ended Label Data session with label folder stats: ' + str(stats_dict))
             print('Updating folder permissions')
+            metrics.start_stage('permissions')
             success = ai_utils.fix_folder_permissions(sel_path,project.user,project.group)
+        metrics.finish()
+        success = ai_utils.fix_folder_permissions(project.project_folder,project.user,project.group,file_paths = ai_utils.pop_written_paths())
 
     
       
@@ -18,8 +18,13 @@ try:
     import os
     import sys
     import copy
-    from ultralytics import YOLO
-    import torch 
+    import time
+    import shutil
+    import importlib.util
+    # torch and ultralytics take many seconds to import on edge units, so are only imported once training starts
+    for module_name in ['ultralytics','torch']:
+        if importlib.util.find_spec(module_name) is None:
+            raise ImportError("No module named '" + module_name + "'")
 
 except Exception as e:
     print("Missing required python modules " + str(e))
@@ -32,6 +37,14 @@ if imports == True:
   import nepi_ai_train as ai_utils
   imports = ai_utils.imports
 
+if imports == True:
+  import nepi_ai_catalog as ai_catalog
+  imports = ai_catalog.imports
+
+if imports == True:
+  import nepi_ai_label_index as ai_label_index
+  imports = ai_label_index.imports
+
 if imports == True:
   import yolo_detector_utils as yolo_utils
   imports = yolo_utils.imports
@@ -41,23 +54,10 @@ if imports == False:
     sys.exit(1) # Terminate the script with an exit code (e.g., 1 for error)
 
 
+torch = None
+YOLO = None
 cuda = None
-try:
-  cuda = torch.cuda.is_avialble()
-  if cuda == False:
-    print('No GPU found')
-  else:
-    print('Found GPU')
-except:
-  print('No GPU found')
-
 ipex = None 
-if cuda is None:   
-  try:
-    import intel_extension_for_pytorch as ipex
-    print('Found XPU')
-  except:
-    print('No XPU found')    
 
 ##########################################
 # Variables
@@ -67,12 +67,93 @@ if cuda is None:
 # Methods
 ##########################################
 
+def import_training_modules():
+  global torch, YOLO, cuda, ipex
+  import torch
+  from ultralytics import YOLO
+  try:
+    cuda = torch.cuda.is_available()
+  except Exception:
+    cuda = False
+  if cuda == False:
+    print('No GPU found')
+  else:
+    print('Found GPU')
+
+  if cuda == False:
+    try:
+      import intel_extension_for_pytorch as ipex
+      if hasattr(torch, 'xpu') == False or torch.xpu.is_available() == False:
+        ipex = None
+    except Exception:
+      ipex = None
+    if ipex is None:
+      print('No XPU found')
+    else:
+      print('Found XPU')
+
 def get_best_device():
 	device = 'cpu'
-	if device == 'cpu' and cuda is not None:
-	    device = torch.device('cuda')
+	if device == 'cpu' and cuda == True:
+	    device = 'cuda'
 	if device == 'cpu' and ipex is not None:
-	    device = torch.device('xpu')
+	    device = 'xpu'
+	return device
+
+
+def get_val_map(model_file, data_file, img_size, train_args, name):
+  # Returns the mAP50-95 of a model on the val split
+  val_args = dict((key, value) for key, value in train_args.items() if key in ['batch','workers','device'] and value != -1)
+  results = YOLO(model_file).val(data=data_file, split='val', imgsz=img_size, name=name, exist_ok=True, plots=False, **val_args)
+  add_run_written_paths(getattr(results, 'save_dir', None))
+  return float(results.box.map)
+
+
+def add_run_written_paths(run_folder):
+  # Records the folders and files written by a trainer or validator run, so only those have their permissions fixed
+  if run_folder is None or os.path.isdir(str(run_folder)) == False:
+    return
+  run_folder = os.path.abspath(str(run_folder))
+  for path in ai_utils.walk_folder_paths(run_folder):
+    ai_utils.add_written_path(path)
+  # Also the runs folders the trainer created above the run folder
+  parent_folder = os.path.dirname(run_folder)
+  while parent_folder.startswith(os.getcwd() + os.sep):
+    ai_utils.add_written_path(parent_folder)
+    parent_folder = os.path.dirname(parent_folder)
+
+
+def get_incremental_data_file(project, last_dict, fingerprint, split_hashes, best_model_path):
+  # Returns the data set file for a fine tune run of the best model on the new train images and a replay sample
+  # of the others, or None if the project needs a full training run
+  project_dict = project.project_dict
+  trained_dict = yolo_utils.read_trained_files(project.train_folder)
+  reason = None
+  if best_model_path is None or len(trained_dict) == 0:
+    reason = 'no trained model to fine tune'
+  elif any(last_dict.get(key) != project_dict.get(key) for key in ['CLASSES','IMAGE_SIZE','BASE_MODEL']):
+    reason = 'the classes, image size, or base model changed'
+  elif last_dict.get('INCREMENTAL_REJECTED_FINGERPRINT') == fingerprint:
+    reason = 'the last fine tuned model for this data was not promoted'
+  elif len(split_hashes['val']) == 0:
+    reason = 'there are no val images to check a fine tuned model'
+  else:
+    label_index = ai_label_index.label_index(project.label_folder, classes = project.classes)
+    label_index.update()
+    [new_files, replay_files] = yolo_utils.get_incremental_train_files(split_hashes, trained_dict, label_index,
+                                                                       project.incremental_replay_ratio, seed = project.random_seed)
+    new_percent = 100.0 * len(new_files) / max(len(split_hashes['train']), 1)
+    if len(new_files) == 0:
+      reason = 'there are no new train images'
+    elif new_percent > project.incremental_max_new_percent:
+      reason = str(round(new_percent, 1)) + '% of the train images are new'
+  if reason is not None:
+    print("Running full training, " + reason)
+    return None
+  print("Fine tuning best model on " + str(len(new_files)) + " new and " + str(len(replay_files)) + " replay images")
+  ai_utils.count_metric('incremental_new_images', len(new_files))
+  ai_utils.count_metric('incremental_replay_images', len(replay_files))
+  return yolo_utils.write_incremental_train_files(project_dict, project.train_folder, new_files + replay_files)
 
 
 
@@ -100,14 +181,37 @@ if __name__ == "__main__":
     img_size  = project.image_size
     num_epochs  = project.num_epochs
     batch_size  = project.batch_size
+    metrics = project.start_run_metrics('train')
 
 
     print('Updating folder permissions')
-    success = ai_utils.fix_folder_permissions(label_folder,project.user,project.group)
-    success = ai_utils.fix_folder_permissions(train_folder,project.user,project.group)
+    metrics.start_stage('permissions')
+    # Only the first run in a train folder walks the label and train folders, later runs
+    # fix the paths each script records as written
+    if os.path.exists(os.path.join(train_folder,yolo_utils.TRAIN_DICT_FILE_NAME)) == False:
+        success = ai_utils.fix_folder_permissions(label_folder,project.user,project.group)
+        success = ai_utils.fix_folder_permissions(train_folder,project.user,project.group)
+    else:
+        written_paths = ai_utils.pop_written_paths()
+        success = ai_utils.fix_folder_permissions(label_folder,project.user,project.group,file_paths = written_paths)
+        success = ai_utils.fix_folder_permissions(train_folder,project.user,project.group,file_paths = written_paths)
     print('Fixing any bad label files')
+    metrics.start_stage('fix_data')
     fixed_files = ai_utils.fix_data_files(label_folder)
+    labels_ok = True
+    if project.label_check_action != 'ignore':
+        print('Checking label files')
+        metrics.start_stage('check_labels')
+        label_index = ai_label_index.label_index(label_folder, classes = classes)
+        label_index.update()
+        report_file = os.path.join(label_folder,ai_label_index.LABEL_CHECK_REPORT_FILE_NAME)
+        check_dict = label_index.check_labels(len(classes), fix = project.label_check_action == 'fix', report_file = report_file)
+        if project.label_check_action == 'report' and check_dict['num_issue_files'] > 0:
+            print('Found label issues, see report file: ' + report_file)
+            print("Fix the label files or set 'LABEL_CHECK_ACTION' to 'fix' in the project settings file")
+            labels_ok = False
     print("Starting training for model name: " + model_name)
+    cur_folder = None
     try:
         print("Changing to training folder:", train_folder)
         os.chdir(train_folder)  
@@ -115,8 +219,29 @@ if __name__ == "__main__":
     except Exception as e:
         print("Error: The specified training folder was not found: " + str(e))
  
-    print("Updating training files in: " + str(train_folder))
-    success = yolo_utils.update_train_files(project_dict,label_folder,train_folder)
+    success = labels_ok
+    fingerprint = None
+    split_hashes = None
+    if success == True:
+        print("Updating training files in: " + str(train_folder))
+        metrics.start_stage('train_files')
+        catalog = ai_catalog.dataset_catalog(project_folder)
+        success = yolo_utils.update_train_files(project_dict,label_folder,train_folder,catalog = catalog)
+        if success == True:
+            print("Fingerprinting training data and settings")
+            metrics.start_stage('fingerprint')
+            split_hashes = yolo_utils.get_split_file_hashes(project_dict,label_folder,train_folder,catalog = catalog)
+            fingerprint = yolo_utils.get_train_fingerprint(project_dict,label_folder,train_folder,split_hashes = split_hashes)
+        catalog.close()
+
+    trainer = None
+    if success == True and project.use_packed_data == True:
+        print("Updating packed training data in: " + str(train_folder))
+        metrics.start_stage('packed_data')
+        success = yolo_utils.update_packed_data(project_dict,train_folder)
+        import yolo_packed_dataset as yolo_packed
+        if yolo_packed.imports == True:
+            trainer = yolo_packed.packed_detection_trainer
 
 
     if success == False:
@@ -132,7 +257,9 @@ if __name__ == "__main__":
     
         if last_dict['BASE_MODEL'] != project_dict['BASE_MODEL']:
             print("Resetting training session for new base model: " + project_dict['BASE_MODEL'])
-            for folder in get_folder_list(train_folder):
+            for folder in ai_utils.get_folder_list(train_folder):
+                if yolo_utils.is_train_data_folder(os.path.basename(folder)) == True:
+                    continue # training data, not training results
                 try:
                     shutil.rmtree(folder)
                     print(f"Old Training Folder '{folder}' and its contents deleted successfully.")
@@ -154,13 +281,106 @@ if __name__ == "__main__":
             if os.path.exists(copy_file_path):
                start_model = os.path.basename(best_model_path)
 
-        ai_utils.write_dict_to_file(project_dict,train_dict_file)
-        success = ai_utils.fix_folder_permissions(train_folder,project.user,project.group)
-        print("Starting training with base model: " + str(start_model))
-        if cur_folder == train_folder:
-            model = YOLO(start_model)
-            device = get_best_device()
-            print("Training with device: " + str(device))
-            model = model.to(device)
-            results = model.train(data=train_file, epochs=num_epochs, imgsz=img_size, batch=batch_size, name=model_name)
-    success = ai_utils.fix_folder_permissions(train_folder,project.user,project.group)
\ No newline at end of file
+        # Skip training if the last successful run used the same data and settings,
+        # or resume the last run if it was stopped before finishing
+        skip_training = False
+        resume_model = None
+        if project.skip_unchanged_training == True and best_model_path is not None and fingerprint == last_dict.get('TRAIN_FINGERPRINT'):
+            print("Training data and settings have not changed since the last training run, skipping training")
+            ai_utils.count_metric('training_skipped')
+            skip_training = True
+        elif fingerprint == last_dict.get('RUN_FINGERPRINT') and fingerprint != last_dict.get('TRAIN_FINGERPRINT'):
+            resume_model = yolo_utils.get_resume_model(train_folder, last_dict.get('RUN_START_TIME', 0))
+        incremental_data_file = None
+        if project.incremental_training == True and skip_training == False and resume_model is None:
+            metrics.start_stage('incremental_files')
+            incremental_data_file = get_incremental_data_file(project, last_dict, fingerprint, split_hashes, best_model_path)
+
+        metrics.end_stage()
+        if cur_folder == train_folder and skip_training == False:
+            import_training_modules()
+            train_dict = copy.deepcopy(project_dict)
+            # Fine tune runs are short, so are started over rather than resumed
+            train_dict['RUN_FINGERPRINT'] = fingerprint if incremental_data_file is None else None
+            train_dict['RUN_START_TIME'] = time.time()
+            train_args = {'batch': batch_size}
+            if resume_model is not None:
+                print("Resuming stopped training run from: " + resume_model)
+                model = YOLO(resume_model)
+                if 'TRAIN_PLAN' in last_dict:
+                    train_dict['TRAIN_PLAN'] = last_dict['TRAIN_PLAN']
+                train_dict['RUN_START_TIME'] = last_dict['RUN_START_TIME']
+            else:
+                print("Starting training with base model: " + str(start_model))
+                model = YOLO(start_model)
+                device = get_best_device()
+                print("Training with device: " + str(device))
+                model = model.to(device)
+                if project.plan_training == True:
+                    print("Planning batch size, data loader workers, and cache mode")
+                    metrics.start_stage('plan')
+                    import yolo_train_planner as yolo_planner
+                    plan = yolo_planner.plan_training(model, device, project_dict, train_folder, last_train_dict = last_dict)
+                    if plan is not None:
+                        train_dict['TRAIN_PLAN'] = plan
+                        train_args = yolo_planner.get_train_args(plan)
+            ai_utils.write_dict_to_file(train_dict,train_dict_file)
+            written_paths = ai_utils.pop_written_paths()
+            success = ai_utils.fix_folder_permissions(project_folder,project.user,project.group,file_paths = written_paths)
+            metrics.start_stage('train')
+            if resume_model is not None:
+                try:
+                    results = model.train(resume=True, trainer=trainer)
+                    add_run_written_paths(model.trainer.save_dir)
+                except Exception as e:
+                    # Runs that already finished all their epochs can not be resumed
+                    print("Failed to resume training run, starting a new run: " + str(e))
+                    resume_model = None
+                    model = YOLO(start_model)
+                    device = get_best_device()
+                    print("Training with device: " + str(device))
+                    model = model.to(device)
+                    if train_dict.get('TRAIN_PLAN') is not None:
+                        import yolo_train_planner as yolo_planner
+                        train_args = yolo_planner.get_train_args(train_dict['TRAIN_PLAN'])
+            promoted = True
+            trained_dict = dict()
+            if resume_model is None and incremental_data_file is not None:
+                metrics.start_stage('val_best')
+                best_map = get_val_map(start_model, train_file, img_size, train_args, model_name + '_val')
+                metrics.start_stage('train')
+                ai_utils.count_metric('epochs', project.incremental_epochs)
+                results = model.train(data=incremental_data_file, epochs=project.incremental_epochs, imgsz=img_size, name=model_name + '_incremental',
+                                      trainer=trainer, optimizer='SGD', lr0=project.incremental_lr0, warmup_epochs=0, **train_args)
+                add_run_written_paths(model.trainer.save_dir)
+                new_model_file = os.path.join(str(model.trainer.save_dir), 'weights', yolo_utils.BEST_FILE_NAME)
+                metrics.start_stage('val_new')
+                new_map = get_val_map(new_model_file, train_file, img_size, train_args, model_name + '_val')
+                print("Val mAP50-95 of the best model: " + str(round(best_map, 4)) + ", fine tuned model: " + str(round(new_map, 4)))
+                promoted = new_map >= best_map - project.incremental_map_tolerance
+                if promoted == True:
+                    print("Promoted fine tuned model: " + new_model_file)
+                    ai_utils.count_metric('incremental_promoted')
+                    trained_dict = yolo_utils.read_trained_files(train_folder)
+                else:
+                    # Renamed so the deploy script keeps using the last best model
+                    rejected_model_file = os.path.join(os.path.dirname(new_model_file), yolo_utils.REJECTED_FILE_NAME)
+                    os.replace(new_model_file, rejected_model_file)
+                    print("Fine tuned model did not hold the val mAP and was not promoted, saved as: " + rejected_model_file)
+                    ai_utils.count_metric('incremental_rejected')
+                    train_dict['INCREMENTAL_REJECTED_FINGERPRINT'] = fingerprint
+            elif resume_model is None:
+                ai_utils.count_metric('epochs', num_epochs)
+                results = model.train(data=train_file, epochs=num_epochs, imgsz=img_size, name=model_name, trainer=trainer, **train_args)
+                add_run_written_paths(model.trainer.save_dir)
+            # Only a run that finished and was promoted is recorded as the last successful run
+            if promoted == True:
+                train_dict['TRAIN_FINGERPRINT'] = fingerprint
+                for [image_file, rel_path, image_hash, label_hash] in split_hashes['train']:
+                    trained_dict[rel_path] = [image_hash, label_hash]
+                yolo_utils.write_trained_files(trained_dict,train_folder)
+            ai_utils.write_dict_to_file(train_dict,train_dict_file)
+    metrics.start_stage('permissions')
+    success = ai_utils.fix_folder_permissions(project_folder,project.user,project.group,file_paths = ai_utils.pop_written_paths())
+    metrics.finish(success)
+    success = ai_utils.fix_folder_permissions(project_folder,project.user,project.group,file_paths = ai_utils.pop_written_paths())
\ No newline at end of file
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2024 Numurus, LLC <https://www.numurus.com>.
+#
+# This file is part of nepi-engine
+# (see https://github.com/nepi-engine).
+#
+# License: 3-clause BSD, see https://opensource.org/licenses/BSD-3-Clause
+#
+
+##########################################
+# Watch the raw data folder and ingest new data drops
+##########################################
+
+
+imports = True
+try:
+    import os
+    import sys
+    import time
+except Exception as e:
+    print("Missing required python modules " + str(e))
+    print("Connect to internet and run the following in this folder")
+    print("sudo pip3 install -r requirements.txt")
+    print("Then try rerunning this script agian")
+    imports = False
+
+if imports == True:
+  import nepi_ai_train as ai_utils
+  imports = ai_utils.imports
+
+if imports == True:
+  import nepi_ai_catalog as ai_catalog
+  imports = ai_catalog.imports
+
+if imports == True:
+  import nepi_ai_label_index as ai_label_index
+  imports = ai_label_index.imports
+
+if imports == True:
+  import yolo_detector_utils as yolo_utils
+  imports = yolo_utils.imports
+
+
+if imports == False:
+    sys.exit(1) # Terminate the script with an exit code (e.g., 1 for error)
+
+
+##########################################
+# Methods
+##########################################
+
+def get_changed_source_folders(data_folder, changed_files):
+    # Returns the data folders that hold changed image or label files, and the changed label files
+    source_folders = set()
+    label_files = []
+    for file_path in changed_files:
+        file_name = os.path.basename(file_path)
+        if file_name.startswith('.') or ai_utils.get_file_type(file_name) == 'other':
+            continue
+        folder = os.path.dirname(file_path)
+        if folder == data_folder or folder.startswith(data_folder + os.sep) == False:
+            continue
+        source_folders.add(folder)
+        if ai_utils.get_file_type(file_name) != 'image':
+            label_files.append(file_path)
+    return [sorted(source_folders), label_files]
+
+
+def copy_late_label_files(data_folder, label_folder, label_files):
+    # Label files dropped after their image was ingested are copied next to the label folder image
+    copy_pairs = []
+    for file_path in label_files:
+        source_folder = os.path.dirname(file_path)
+        output_folder = os.path.join(label_folder,ai_utils.get_label_folder_name(data_folder,source_folder))
+        f_base = os.path.splitext(os.path.basename(file_path))[0]
+        output_path = os.path.join(output_folder,os.path.basename(file_path))
+        if os.path.exists(output_path) == True:
+            continue
+        for img_type in ai_utils.IMAGE_FILE_TYPES:
+            if os.path.exists(os.path.join(output_folder,f_base + '.' + img_type)):
+                copy_pairs.append([file_path,output_path])
+                break
+    if len(copy_pairs) > 0:
+        print('Copying ' + str(len(copy_pairs)) + ' late label files')
+        ai_utils.copy_files_bulk(copy_pairs)
+
+
+def ingest_data_drop(project, source_folders, label_files, catalog, label_index, metrics):
+    data_folder = project.data_folder
+    label_folder = project.label_folder
+    metrics.start_stage('fix_data')
+    fixed_files = ai_utils.fix_data_files(data_folder, folders = source_folders)
+    metrics.start_stage('link_data')
+    imgs_list = ai_utils.update_labling_data(data_folder, label_folder, project.use_percent_data, catalog = catalog,
+                                             seed = project.random_seed, link_mode = project.data_link_mode, folders = source_folders)
+    if imgs_list == False:
+        print('Skipping data drop in folders: ' + str(source_folders))
+        return imgs_list
+    copy_late_label_files(data_folder, label_folder, label_files)
+
+    # Only the label folders fed by this drop need their xml files converted
+    metrics.start_stage('convert_xml')
+    label_folders = []
+    for source_folder in source_folders:
+        folder = os.path.join(label_folder,ai_utils.get_label_folder_name(data_folder,source_folder))
+        if os.path.exists(folder):
+            label_folders.append(folder)
+    fixed_files = ai_utils.fix_data_files(label_folder, folders = label_folders)
+    classes = list(project.classes)
+    classes_dict = dict(project.classes_dict)
+    xml_files = []
+    for folder in label_folders:
+        xml_files += ai_utils.get_stale_xml_files(folder)[0]
+    unknown_labels = ai_utils.find_unknown_labels(xml_files,classes,classes_dict)
+    if len(unknown_labels) > 0:
+        # Nobody is there to answer questions in watch mode
+        unknown_action = project.unknown_label_action
+        if unknown_action == 'ask':
+            unknown_action = 'skip'
+        print('Found unknown labels: ' + str(unknown_labels))
+        [classes,classes_dict,unresolved_labels] = ai_utils.resolve_unknown_labels(unknown_labels,classes,classes_dict,
+                                                                                   project.label_mapping,unknown_action)
+    for folder in label_folders:
+        [classes,classes_dict] = ai_utils.convert_xml_files(folder,classes,classes_dict,
+                                                            label_mapping = project.label_mapping,unknown_action = 'skip')
+    if classes != project.classes or classes_dict != project.classes_dict:
+        print('Updating classes in project settings')
+        project.update_classes(classes,classes_dict)
+        ai_utils.write_list_to_file(classes,project.classes_file)
+        label_index.classes = classes
+
+    # Only the folders touched by this drop are rescanned, the train lists are rebuilt by the train script
+    print('Updating folder stats')
+    metrics.start_stage('stats')
+    stats_dict = ai_utils.update_stats_file(data_folder, catalog = catalog, folders = source_folders)
+    stats_dict = ai_utils.update_stats_file(label_folder, catalog = catalog, label_index = label_index, folders = label_folders)
+    if project.watch_update_train_files == True and os.path.exists(project.train_folder):
+        metrics.start_stage('train_files')
+        success = yolo_utils.update_train_files(project.project_dict,label_folder,project.train_folder,catalog = catalog)
+    return imgs_list
+
+
+
+###############################################
+# Main
+###############################################
+
+if __name__ == '__main__':
+    sudo = ai_utils.check_for_sudo()
+    print('Starting watch data process')
+    project = yolo_utils.project_yolo_detector()
+    project_folder = project.project_folder
+    data_folder = project.data_folder
+    label_folder = project.label_folder
+    if os.path.exists(data_folder) == False or os.path.exists(label_folder) == False:
+        print('Run the initialize project script before watching for new data')
+        sys.exit(1)
+
+    check_cache_file = os.path.join(project_folder,ai_utils.IMAGE_CHECK_CACHE_FILE_NAME)
+    ai_utils.load_image_check_cache(check_cache_file)
+    label_index = ai_label_index.label_index(label_folder, classes = project.classes)
+    watcher = ai_utils.folder_watcher(data_folder, recursive = project.recursive_data_folders,
+                                      poll_interval = project.watch_poll_interval)
+    print('Watching for new data in: ' + data_folder + ' (Ctrl-C to stop)')
+    try:
+        while True:
+            changed_files = watcher.wait_for_drop(project.watch_debounce_secs)
+            start_time = time.time()
+            [source_folders, label_files] = get_changed_source_folders(data_folder, changed_files)
+            if len(source_folders) == 0:
+                continue
+            print('Found ' + str(len(changed_files)) + ' new files in folders: ' + str(source_folders))
+            # Each data drop is logged as its own run
+            metrics = project.start_run_metrics('watch')
+            ai_utils.count_metric('files_dropped', len(changed_files))
+            catalog = ai_catalog.dataset_catalog(project_folder)
+            imgs_list = ingest_data_drop(project, source_folders, label_files, catalog, label_index, metrics)
+            catalog.close()
+            ai_utils.save_image_check_cache(check_cache_file)
+            if project.data_link_mode == 'store' and project.watch_gc_data_store == True:
+                metrics.start_stage('data_store_gc')
+                ai_utils.gc_data_store(project.store_folder,[label_folder])
+            metrics.start_stage('permissions')
+            written_paths = ai_utils.pop_written_paths()
+            success = ai_utils.fix_folder_permissions(project_folder,project.user,project.group,file_paths = written_paths)
+            metrics.finish()
+            success = ai_utils.fix_folder_permissions(project_folder,project.user,project.group,file_paths = ai_utils.pop_written_paths())
+            print('Ingested data drop in ' + str(round(time.time() - start_time, 2)) + ' secs')
+    except KeyboardInterrupt:
+        print('Stopping watch data process')
+    watcher.close()
@@ -21,6 +21,8 @@ try:
     import grp
     import pwd    
     import random
+    import json
+    import hashlib
 
 except Exception as e:
     print("Missing required python modules " + str(e))
@@ -33,6 +35,10 @@ if imports == True:
   import nepi_ai_train as ai_utils
   imports = ai_utils.imports
 
+if imports == True:
+  import nepi_ai_label_index as ai_label_index
+  imports = ai_label_index.imports
+
 
 if imports == False:
     sys.exit(1) # Terminate the script with an exit code (e.g., 1 for error)
@@ -63,13 +69,36 @@ TRAIN_DICT_FILE_NAME = 'train_info_dict.yaml'
 
 
 CUSTOM_FILE_NAME = 'data_custom.yaml'
+INCREMENTAL_CUSTOM_FILE_NAME = 'data_incremental.yaml'
+INCREMENTAL_TRAIN_FILE_NAME = 'incremental_train_data.txt'
+TRAINED_FILES_FILE_NAME = 'trained_files.txt'
 BEST_FILE_NAME = 'best.pt'
+LAST_FILE_NAME = 'last.pt'
+REJECTED_FILE_NAME = 'best_rejected.pt'
+SPLIT_MANIFEST_FILE_NAME = 'split_manifest.txt'
+SPLIT_FILE_NAMES = {
+  'train' : 'train_data.txt',
+  'val' : 'val_data.txt',
+  'test' : 'test_data.txt'
+}
 
 VAL_DATA_PERCENTAGE = 10
 TEST_DATA_PERCENTAGE = 10
 MAKE_TRAIN_TEST_UNIQUE = True
 USE_BEST_MODEL_FOR_RETRAIN = True
 
+# Settings that change the trained model, along with the train, val, and test data
+TRAIN_SETTINGS_KEYS = ['CLASSES','IMAGE_SIZE','BASE_MODEL','NUM_EPOCHS','BATCH_SIZE','PLAN_TRAINING',
+                       'USE_IMAGE_CACHE','USE_PACKED_DATA','PACKED_DATA_FORMAT']
+BOOL_SETTINGS = ['RECURSIVE_DATA_FOLDERS','USE_IMAGE_CACHE','USE_PACKED_DATA','WATCH_UPDATE_TRAIN_FILES','WATCH_GC_DATA_STORE',
+                 'PLAN_TRAINING','SKIP_UNCHANGED_TRAINING','INCREMENTAL_TRAINING']
+
+INCREMENTAL_MAX_NEW_PERCENT = 20
+INCREMENTAL_REPLAY_RATIO = 2.0
+INCREMENTAL_EPOCHS_DIVISOR = 10 # incremental runs default to NUM_EPOCHS divided by this
+INCREMENTAL_LR0 = 0.001
+INCREMENTAL_MAP_TOLERANCE = 0.005
+
 
 
 
@@ -90,8 +119,31 @@ class project_yolo_detector:
     label_folder = ''
     train_folder = ''
     deploy_folder = ''
+    store_folder = ''
 
     use_percent_data = 100
+    random_seed = None
+    data_link_mode = 'copy'
+    recursive_data_folders = False
+    use_image_cache = False
+    use_packed_data = False
+    label_check_action = 'fix'
+    watch_poll_interval = ai_utils.WATCH_POLL_INTERVAL
+    watch_debounce_secs = ai_utils.WATCH_DEBOUNCE_SECONDS
+    watch_update_train_files = False
+    watch_gc_data_store = False
+    metrics_folder = None
+    plan_training = True
+    skip_unchanged_training = True
+    incremental_training = False
+    incremental_max_new_percent = INCREMENTAL_MAX_NEW_PERCENT
+    incremental_replay_ratio = INCREMENTAL_REPLAY_RATIO
+    incremental_epochs = 1
+    incremental_lr0 = INCREMENTAL_LR0
+    incremental_map_tolerance = INCREMENTAL_MAP_TOLERANCE
+
+    label_mapping = dict()
+    unknown_label_action = 'ask'
 
     classes_file = ''
     train_file = ''
@@ -128,6 +180,8 @@ class project_yolo_detector:
         self.label_folder = os.path.join(self.project_folder,DATA_LABEL_FOLDER)
         self.train_folder = os.path.join(self.project_folder,MODEL_TRAIN_FOLDER)
         self.deploy_folder = os.path.join(self.project_folder,MODEL_DEPLOY_FOLDER)
+        self.store_folder = os.path.join(self.project_folder,ai_utils.DATA_STORE_FOLDER_NAME)
+        ai_utils.set_data_store_folder(self.store_folder)
 
         self.classes_file = os.path.join(self.label_folder,CLASSES_FILE_NAME)
         self.train_file = os.path.join(self.train_folder,CUSTOM_FILE_NAME)
@@ -149,6 +203,29 @@ class project_yolo_detector:
             self.classes = self.project_dict['CLASSES']
             self.use_percent_data = self.project_dict['USE_PERCENT_DATA']
             self.random_data_size =  self.project_dict['RANDOM_DATA_SIZE']
+            self.random_seed = self.project_dict.get('RANDOM_SEED', None)
+            self.recursive_data_folders = self.project_dict.get('RECURSIVE_DATA_FOLDERS', False)
+            self.data_link_mode = self.project_dict.get('DATA_LINK_MODE', 'copy')
+            if self.data_link_mode not in ai_utils.LINK_MODES:
+                print('Unknown DATA_LINK_MODE ' + str(self.data_link_mode) + ' not in ' + str(ai_utils.LINK_MODES) + ', using copy')
+                self.data_link_mode = 'copy'
+            self.use_image_cache = self.project_dict.get('USE_IMAGE_CACHE', False)
+            self.use_packed_data = self.project_dict.get('USE_PACKED_DATA', False)
+            self.label_check_action = self.project_dict.get('LABEL_CHECK_ACTION', 'fix')
+            if self.label_check_action not in ai_label_index.LABEL_CHECK_ACTIONS:
+                print('Unknown LABEL_CHECK_ACTION ' + str(self.label_check_action) + ' not in ' + str(ai_label_index.LABEL_CHECK_ACTIONS) + ', using fix')
+                self.label_check_action = 'fix'
+            self.watch_poll_interval = self.project_dict.get('WATCH_POLL_INTERVAL', ai_utils.WATCH_POLL_INTERVAL)
+            self.watch_debounce_secs = self.project_dict.get('WATCH_DEBOUNCE_SECONDS', ai_utils.WATCH_DEBOUNCE_SECONDS)
+            self.watch_update_train_files = self.project_dict.get('WATCH_UPDATE_TRAIN_FILES', False)
+            self.watch_gc_data_store = self.project_dict.get('WATCH_GC_DATA_STORE', False)
+            self.metrics_folder = self.project_dict.get('METRICS_TEXTFILE_FOLDER', None)
+            self.plan_training = self.project_dict.get('PLAN_TRAINING', True)
+            self.skip_unchanged_training = self.project_dict.get('SKIP_UNCHANGED_TRAINING', True)
+            self.label_mapping = self.project_dict.get('LABEL_MAPPING', None)
+            if self.label_mapping is None:
+                self.label_mapping = dict()
+            self.unknown_label_action = self.project_dict.get('UNKNOWN_LABEL_ACTION', 'ask')
             '''
             if USE_BEST_MODEL_FOR_RETRAIN == True:
                 best_model = get_best_model(self.train_folder)
@@ -159,6 +236,12 @@ class project_yolo_detector:
             self.image_size = self.project_dict['IMAGE_SIZE']
             self.num_epochs = self.project_dict['NUM_EPOCHS']
             self.batch_size = self.project_dict['BATCH_SIZE']
+            self.incremental_training = self.project_dict.get('INCREMENTAL_TRAINING', False)
+            self.incremental_max_new_percent = self.project_dict.get('INCREMENTAL_MAX_NEW_PERCENT', INCREMENTAL_MAX_NEW_PERCENT)
+            self.incremental_replay_ratio = self.project_dict.get('INCREMENTAL_REPLAY_RATIO', INCREMENTAL_REPLAY_RATIO)
+            self.incremental_epochs = self.project_dict.get('INCREMENTAL_EPOCHS', max(1, self.num_epochs // INCREMENTAL_EPOCHS_DIVISOR))
+            self.incremental_lr0 = self.project_dict.get('INCREMENTAL_LR0', INCREMENTAL_LR0)
+            self.incremental_map_tolerance = self.project_dict.get('INCREMENTAL_MAP_TOLERANCE', INCREMENTAL_MAP_TOLERANCE)
 
             # Gather owner and group details for project mountpoint
 
@@ -174,6 +257,11 @@ class project_yolo_detector:
                 self.project_dict['CLASSES_DICT'] = ai_utils.create_classes_dict(self.classes)
             self.classes_dict = self.project_dict['CLASSES_DICT']
 
+    def start_run_metrics(self,script_name):
+        # Stage times and counts are appended to the project's run log when the script calls finish()
+        log_file = os.path.join(self.project_folder,ai_utils.RUN_LOG_FILE_NAME)
+        return ai_utils.start_run_metrics(script_name, log_file = log_file, prom_folder = self.metrics_folder)
+
     def update_classes(self,classes, classes_dict):
         self.project_dict['CLASSES'] = classes
         self.classes = classes
@@ -193,6 +281,79 @@ class project_yolo_detector:
 
 
 
+REQUIRED_SETTINGS = {
+    'MODEL_NAME': str,
+    'DESCRIPTION': str,
+    'CLASSES': list,
+    'USE_PERCENT_DATA': (int, float),
+    'RANDOM_DATA_SIZE': int,
+    'BASE_MODEL': str,
+    'IMAGE_SIZE': int,
+    'NUM_EPOCHS': int,
+    'BATCH_SIZE': int
+}
+
+def validate_project_settings(project_dict, project_folder = None):
+    # Checks a project settings dict without loading any data. Errors stop the scripts from working,
+    # warnings are settings that are ignored or replaced by a default. Returns [errors, warnings].
+    errors = []
+    warnings = []
+    if not isinstance(project_dict, dict):
+        return [['Project settings file is empty or not a yaml dictionary'], warnings]
+    for key, value_type in REQUIRED_SETTINGS.items():
+        if key not in project_dict:
+            errors.append('Missing required setting: ' + key)
+        elif isinstance(project_dict[key], value_type) == False or isinstance(project_dict[key], bool):
+            errors.append("Setting '" + key + "' has the wrong type: " + str(project_dict[key]))
+    classes = project_dict.get('CLASSES')
+    if isinstance(classes, list):
+        if len(classes) == 0:
+            errors.append("'CLASSES' is empty")
+        if len(set(str(label) for label in classes)) != len(classes):
+            errors.append("'CLASSES' has duplicate labels")
+    if isinstance(project_dict.get('USE_PERCENT_DATA'), (int, float)) and not 0 < project_dict['USE_PERCENT_DATA'] <= 100:
+        errors.append("'USE_PERCENT_DATA' must be more than 0 and at most 100")
+    for key in ['IMAGE_SIZE', 'NUM_EPOCHS', 'BATCH_SIZE']:
+        if isinstance(project_dict.get(key), int) and project_dict[key] <= 0 and not (key == 'BATCH_SIZE' and project_dict[key] == -1):
+            errors.append("'" + key + "' must be more than 0")
+    if isinstance(project_dict.get('IMAGE_SIZE'), int) and project_dict['IMAGE_SIZE'] % 32 != 0:
+        warnings.append("'IMAGE_SIZE' is not a multiple of 32 and will be rounded up by the trainer")
+    option_lists = {
+        'DATA_LINK_MODE': ai_utils.LINK_MODES,
+        'LABEL_CHECK_ACTION': ai_label_index.LABEL_CHECK_ACTIONS,
+        'UNKNOWN_LABEL_ACTION': ai_utils.UNKNOWN_LABEL_ACTIONS,
+        'PACKED_DATA_FORMAT': ai_utils.PACKED_DATA_FORMATS
+    }
+    for key, options in option_lists.items():
+        if key in project_dict and project_dict[key] not in options:
+            warnings.append("'" + key + "' value " + str(project_dict[key]) + ' not in ' + str(options) + ', the default is used')
+    for key in BOOL_SETTINGS:
+        if key in project_dict and isinstance(project_dict[key], bool) == False:
+            errors.append("'" + key + "' must be true or false")
+    for key in ['INCREMENTAL_MAX_NEW_PERCENT','INCREMENTAL_REPLAY_RATIO','INCREMENTAL_EPOCHS','INCREMENTAL_LR0']:
+        if key in project_dict and (isinstance(project_dict[key], (int, float)) == False or isinstance(project_dict[key], bool) or project_dict[key] <= 0):
+            errors.append("'" + key + "' must be a number more than 0")
+    label_mapping = project_dict.get('LABEL_MAPPING')
+    if label_mapping is not None and isinstance(label_mapping, dict) == False:
+        errors.append("'LABEL_MAPPING' must be a dictionary of label: class name")
+    if project_folder is not None:
+        for folder in [DATA_RAW_FOLDER, DATA_LABEL_FOLDER, MODEL_TRAIN_FOLDER, MODEL_DEPLOY_FOLDER]:
+            if os.path.exists(os.path.join(project_folder, folder)) == False:
+                warnings.append('Missing project folder: ' + folder)
+        base_model = project_dict.get('BASE_MODEL')
+        if isinstance(base_model, str) and os.path.exists(os.path.join(project_folder, MODEL_TRAIN_FOLDER, base_model)) == False:
+            warnings.append("'BASE_MODEL' file " + base_model + ' not found in the ' + MODEL_TRAIN_FOLDER + ' folder, the trainer will try to download it')
+        classes_file = os.path.join(project_folder, DATA_LABEL_FOLDER, CLASSES_FILE_NAME)
+        if isinstance(classes, list) and os.path.exists(classes_file) and ai_utils.read_list_from_file(classes_file) != [str(label) for label in classes]:
+            warnings.append("'CLASSES' changed since the last init, rerun the initialize project script")
+    return [errors, warnings]
+
+
+def is_train_data_folder(folder_name):
+    # Cache and packed data folders in the train folder hold training data, not training results
+    return folder_name == ai_utils.PACKED_DATA_FOLDER_NAME or folder_name.startswith(ai_utils.IMAGE_CACHE_FOLDER_NAME)
+
+
 def copy_best_model(source_folder,output_file_path):
     best_model_path = None
     found_model_path = None
@@ -200,10 +361,14 @@ def copy_best_model(source_folder,output_file_path):
     #print(source_folder)
     if os.path.exists(source_folder) == True:
         for path, dirs, files in os.walk(source_folder):
+            dirs[:] = [folder_name for folder_name in dirs if is_train_data_folder(folder_name) == False]
             #print(files)
             for file in files:
                 if file == BEST_FILE_NAME:
-                    found_model_path = os.path.join(path, file)
+                    # Use the newest best model, so a promoted fine tune run is used over the run it started from
+                    file_path = os.path.join(path, file)
+                    if found_model_path is None or os.path.getmtime(file_path) > os.path.getmtime(found_model_path):
+                        found_model_path = file_path
     if found_model_path is not None:
         print('Found best model file: ' + found_model_path)
         output_path = os.path.dirname(output_file_path)
@@ -230,86 +395,290 @@ def copy_best_model(source_folder,output_file_path):
     return best_model_path
 
 
-def update_train_files(project_dict,label_folder,train_folder):
+def get_resume_model(train_folder, start_time):
+    # Returns the newest last.pt file saved by a training run started at start_time or later, or None
+    resume_model_path = None
+    resume_mtime = start_time
+    for path, dirs, files in os.walk(train_folder):
+        dirs[:] = [folder_name for folder_name in dirs if is_train_data_folder(folder_name) == False]
+        if LAST_FILE_NAME in files:
+            file_path = os.path.join(path, LAST_FILE_NAME)
+            mtime = os.path.getmtime(file_path)
+            if mtime >= resume_mtime:
+                resume_model_path = file_path
+                resume_mtime = mtime
+    return resume_model_path
+
+
+def get_split_file_hashes(project_dict,label_folder,train_folder,catalog = None):
+  # Returns a dict of split name to a list of [image_file, rel_path, image_hash, label_hash] for each train, val, and test
+  # list entry. Cached images are hashed by their labeling folder source, and rel_path is relative to the labeling folder.
+  cache_folder = os.path.join(train_folder,ai_utils.IMAGE_CACHE_FOLDER_NAME + '_' + str(project_dict['IMAGE_SIZE']))
+  split_hashes = dict()
+  for split in ai_utils.SPLIT_NAMES:
+    split_file_path = os.path.join(train_folder,SPLIT_FILE_NAMES[split])
+    image_files = []
+    if os.path.exists(split_file_path) == True:
+      image_files = [image_file for image_file in ai_utils.read_list_from_file(split_file_path) if image_file != '']
+    source_files = []
+    for image_file in image_files:
+      if image_file.startswith(cache_folder + os.sep):
+        image_file = os.path.join(label_folder,os.path.relpath(image_file,cache_folder))
+      source_files.append(image_file)
+    if catalog is not None:
+      image_hashes = catalog.get_image_hashes(source_files)
+    else:
+      image_hashes = [None] * len(source_files)
+    entries = []
+    for image_file, source_file, image_hash in zip(image_files, source_files, image_hashes):
+      if image_hash is None:
+        try:
+          image_hash = ai_utils.get_file_sha256(source_file)
+        except OSError:
+          image_hash = 'missing'
+      try:
+        with open(os.path.splitext(source_file)[0] + '.txt','rb') as f:
+          label_hash = ai_utils.get_data_hash(f.read())
+      except OSError:
+        label_hash = 'missing'
+      entries.append([image_file, os.path.relpath(source_file,label_folder), image_hash, label_hash])
+    split_hashes[split] = entries
+  ai_utils.count_metric('fingerprint_files', sum(len(entries) for entries in split_hashes.values()))
+  return split_hashes
+
+
+def get_train_fingerprint(project_dict,label_folder,train_folder,catalog = None,split_hashes = None):
+  # Hash of the settings that change the trained model, the base model file, and the train, val, and test lists
+  # with the content hashes of every image and label file
+  if split_hashes is None:
+    split_hashes = get_split_file_hashes(project_dict,label_folder,train_folder,catalog = catalog)
+  file_hash = hashlib.sha1()
+  settings = dict((key, project_dict.get(key)) for key in TRAIN_SETTINGS_KEYS)
+  file_hash.update(json.dumps(settings, sort_keys = True).encode())
+  base_model_file = os.path.join(train_folder,project_dict['BASE_MODEL'])
+  if os.path.exists(base_model_file):
+    file_hash.update(ai_utils.get_file_sha256(base_model_file).encode())
+  for split in ai_utils.SPLIT_NAMES:
+    for [image_file, rel_path, image_hash, label_hash] in split_hashes[split]:
+      file_hash.update((split + '\t' + rel_path + '\t' + str(image_hash) + '\t' + label_hash + '\n').encode())
+  return file_hash.hexdigest()
+
+
+def read_trained_files(train_folder):
+  # Returns a dict of labeling folder rel_path to [image_hash, label_hash] for the images the current best model was trained on
+  trained_dict = dict()
+  file_path = os.path.join(train_folder,TRAINED_FILES_FILE_NAME)
+  if os.path.exists(file_path) == True:
+    for line in ai_utils.read_list_from_file(file_path):
+      parts = line.split('\t')
+      if len(parts) == 3:
+        trained_dict[parts[0]] = parts[1:]
+  return trained_dict
+
+
+def write_trained_files(trained_dict,train_folder):
+  file_path = os.path.join(train_folder,TRAINED_FILES_FILE_NAME)
+  return ai_utils.write_list_to_file([rel_path + '\t' + '\t'.join(hashes) for rel_path, hashes in sorted(trained_dict.items())], file_path)
+
+
+def get_incremental_train_files(split_hashes,trained_dict,label_index,replay_ratio,seed = None):
+  # Returns [new_files, replay_files] from the train list. New files are images the best model was not trained on,
+  # or whose image or labels changed since. Replay files are a sample of the other images, replay_ratio times the number
+  # of new files, taken one image per class in turn so rare classes are replayed as often as common ones.
+  new_files = []
+  old_files = []
+  for [image_file, rel_path, image_hash, label_hash] in split_hashes['train']:
+    if trained_dict.get(rel_path) == [image_hash, label_hash]:
+      old_files.append([image_file, rel_path])
+    else:
+      new_files.append(image_file)
+  num_replay = min(len(old_files), int(round(len(new_files) * replay_ratio)))
+  file_class_ids = label_index.get_file_class_ids()
+  class_files = dict()
+  for [image_file, rel_path] in old_files:
+    class_ids = file_class_ids.get(os.path.splitext(rel_path)[0] + '.txt', [])
+    for class_id in (class_ids if len(class_ids) > 0 else [-1]): # -1 for background images without boxes
+      class_files.setdefault(class_id, []).append(image_file)
+  rng = random.Random(seed)
+  class_lists = []
+  for class_id in sorted(class_files.keys(), key = lambda class_id: [class_id < 0, class_id]):
+    rng.shuffle(class_files[class_id])
+    class_lists.append(class_files[class_id])
+  replay_files = []
+  replay_set = set()
+  positions = [0] * len(class_lists)
+  while len(replay_files) < num_replay:
+    for ind, files in enumerate(class_lists):
+      while positions[ind] < len(files) and files[positions[ind]] in replay_set:
+        positions[ind] += 1
+      if positions[ind] < len(files) and len(replay_files) < num_replay:
+        replay_files.append(files[positions[ind]])
+        replay_set.add(files[positions[ind]])
+  return [new_files, replay_files]
+
+
+def write_incremental_train_files(project_dict,train_folder,image_files):
+  # Writes the incremental train list and a data set file that uses it with the regular val and test lists.
+  # Returns the data set file path, or None if it could not be written.
+  train_file_path = os.path.join(train_folder,INCREMENTAL_TRAIN_FILE_NAME)
+  ai_utils.write_list_to_file(image_files, train_file_path)
+  data = {
+    'path' : train_folder,
+    'train' : INCREMENTAL_TRAIN_FILE_NAME,
+    'val' : SPLIT_FILE_NAMES['val'],
+    'test' : SPLIT_FILE_NAMES['test'],
+    'nc' : len(project_dict['CLASSES']),
+    'names' : project_dict['CLASSES']
+  }
+  custom_file_path = os.path.join(train_folder,INCREMENTAL_CUSTOM_FILE_NAME)
+  if ai_utils.write_dict_to_file(data,custom_file_path) == False:
+    return None
+  return custom_file_path
+
+
+def update_train_files(project_dict,label_folder,train_folder,catalog = None):
 
-  exist_files = []
   train_files = []
   val_files = []
   test_files = []
   ulab_files = []
 
-  ### Load existing files
-  train_file_path = os.path.join(train_folder,'train_data.txt')
-  if os.path.exists(train_file_path) == True:
-    train_files = ai_utils.read_list_from_file(train_file_path)
-    exist_files = train_files
-  val_file_path = os.path.join(train_folder,'val_data.txt')
-  if os.path.exists(val_file_path) == True:
-    val_files = ai_utils.read_list_from_file(val_file_path)
-    exist_files = exist_files + val_files
-  test_file_path = os.path.join(train_folder,'test_data.txt')
-  if os.path.exists(test_file_path) == True:
-    test_files = ai_utils.read_list_from_file(test_file_path)
-    exist_files = exist_files + test_files
+  train_file_path = os.path.join(train_folder,SPLIT_FILE_NAMES['train'])
+  val_file_path = os.path.join(train_folder,SPLIT_FILE_NAMES['val'])
+  test_file_path = os.path.join(train_folder,SPLIT_FILE_NAMES['test'])
+  split_lists = {
+    'train' : train_files,
+    'val' : val_files,
+    'test' : test_files
+  }
+
+  ### Load existing split assignments
+  manifest_file_path = os.path.join(train_folder,SPLIT_MANIFEST_FILE_NAME)
+  split_dict = ai_utils.read_split_manifest(manifest_file_path)
+  new_split_dict = dict()
+  if len(split_dict) == 0:
+    # Seed the manifest from any lists written before it existed so those images keep their split
+    for split, file_path in zip(ai_utils.SPLIT_NAMES,[train_file_path,val_file_path,test_file_path]):
+      if os.path.exists(file_path) == True:
+        for image_file in ai_utils.read_list_from_file(file_path):
+          if image_file != '':
+            rel_path = os.path.relpath(image_file,label_folder)
+            if rel_path not in new_split_dict:
+              new_split_dict[rel_path] = split
+    split_dict.update(new_split_dict)
+  print("Loaded " + str(len(split_dict)) + " existing split assignments")
+
   ### Walk through folder folders
   print("Processing folders in: " + label_folder)
-  folders_to_process=ai_utils.get_folder_list(label_folder)
+  if catalog is not None:
+    folders_to_process=catalog.get_folder_list(label_folder)
+  else:
+    folders_to_process=ai_utils.get_folder_list(label_folder)
   print('')
   print('Found folders: ' + str(folders_to_process))
+  labeled_files = []
   for folder in folders_to_process:
     print('Processing folder: ' + folder)
-    path, dirs, files = next(os.walk(folder))
-    data_size = len(files)
-    ind = 0
-    data_val_size = int(float(1)/float(VAL_DATA_PERCENTAGE) * data_size)
-    val_indexes = random.sample(range(data_size), k=data_val_size)
-    data_test_size = int(float(1)/float(TEST_DATA_PERCENTAGE) * data_size)
-    test_indexes = random.sample(range(data_size), k=data_test_size)
-    files = os.listdir(folder)
+    if catalog is not None:
+      [img_files,xml_files,txt_files] = catalog.get_folder_files(folder)
+      files = img_files
+      file_set = set(txt_files)
+    else:
+      files = os.listdir(folder)
+      file_set = set(files)
+    folder_name = os.path.basename(folder)
     #print("Found " + str(len(files)) + " files in folder")
-    #print('Found image files: ' + str(files))
     for f in files:
-      f_ext = os.path.splitext(f)[1]
+      [f_base,f_ext] = os.path.splitext(f)
       f_ext = f_ext.replace(".","")
-      try:
-        if f_ext in ai_utils.IMAGE_FILE_TYPES:
-          image_file = (folder + '/' + f)
-          #print('Found image file: ' + image_file)
-          #print(image_file)
-          label_file = (folder + '/' + f.split(f_ext)[0]+'txt')
-          #print('Looking for label file: ' + label_file)
-          if os.path.exists(label_file):
-            #print('Found label file' + label_file)
-            ind += 1
-            if ind in val_indexes and image_file not in exist_files: ##### FINISH THIS
-              #print('Adding image to val file list')
-              val_files.append(image_file)
-            elif ind in test_indexes and image_file not in exist_files: 
-              #print('Adding image to test file list')
-              test_files.append(image_file)
-            elif image_file not in exist_files: 
-              #print('Adding image to train file list')
-              train_files.append(image_file)
-          else:
-            # print("Warning: No label file for image: " + image_file)
-            ulab_files.append(image_file)
-      except Exception as e:
-        print("Excepton on file write: " + str(e))
-
-
-  #print(test_files)
-  #print(test_label_files)
-  #print(train_files)
-  #print(val_files)
+      if f_ext in ai_utils.IMAGE_FILE_TYPES:
+        image_file = (folder + '/' + f)
+        if (f_base + '.txt') in file_set:
+          labeled_files.append([folder_name + '/' + f, image_file, folder, f])
+        else:
+          # print("Warning: No label file for image: " + image_file)
+          ulab_files.append(image_file)
+  # Sorted so groups and the images kept from them do not depend on folder listing order
+  labeled_files.sort()
+
+  ### Group near duplicate images so each group stays in one split
+  dedup_distance = project_dict.get('DEDUP_MAX_DISTANCE', None)
+  max_cluster_size = project_dict.get('DEDUP_MAX_CLUSTER_SIZE', 0)
+  if dedup_distance is not None and len(labeled_files) > 0:
+    image_files = [entry[1] for entry in labeled_files]
+    if catalog is not None:
+      phashes = catalog.get_image_phashes(image_files)
+    else:
+      phashes = ai_utils.get_image_phashes(image_files)
+    cluster_ids = ai_utils.find_duplicate_clusters(phashes,dedup_distance)
+  else:
+    cluster_ids = list(range(len(labeled_files)))
+  clusters = dict()
+  for ind, cluster_id in enumerate(cluster_ids):
+    clusters.setdefault(cluster_id,[]).append(ind)
+
+  # New images take the split recorded for most of their group, recorded images always keep their own split
+  keep_inds = set()
+  cluster_splits = dict()
+  num_mixed = 0
+  for cluster_id, members in clusters.items():
+    existing_splits = [split_dict[labeled_files[ind][0]] for ind in members if labeled_files[ind][0] in split_dict]
+    if len(existing_splits) > 0:
+      split = max(ai_utils.SPLIT_NAMES, key = existing_splits.count)
+      if len(set(existing_splits)) > 1:
+        num_mixed += 1
+    else:
+      split = ai_utils.get_hash_split(labeled_files[members[0]][0],VAL_DATA_PERCENTAGE,TEST_DATA_PERCENTAGE)
+    cluster_splits[cluster_id] = split
+    if max_cluster_size > 0 and len(members) > max_cluster_size:
+      # Keep evenly spaced images from large clusters
+      step = len(members) / float(max_cluster_size)
+      members = [members[int(i * step)] for i in range(max_cluster_size)]
+    keep_inds.update(members)
+
+  folder_split_dicts = dict()
+  for ind, [rel_path, image_file, folder, f] in enumerate(labeled_files):
+    split = split_dict.get(rel_path)
+    if split is None:
+      split = cluster_splits[cluster_ids[ind]]
+      split_dict[rel_path] = split
+      new_split_dict[rel_path] = split
+    if ind in keep_inds:
+      split_lists[split].append(image_file)
+    folder_split_dicts.setdefault(folder,dict())[f] = split
+  if catalog is not None:
+    for folder, folder_split_dict in folder_split_dicts.items():
+      catalog.set_splits(folder,folder_split_dict)
+  if dedup_distance is not None:
+    num_clustered = sum(len(members) for members in clusters.values() if len(members) > 1)
+    print("Found " + str(sum(1 for members in clusters.values() if len(members) > 1)) + " near duplicate groups with " +
+          str(num_clustered) + " images, left out " + str(len(labeled_files) - len(keep_inds)) + " images")
+    if num_mixed > 0:
+      print("Found " + str(num_mixed) + " near duplicate groups with images recorded in more than one split, kept their recorded splits")
 
   print("Found " + str(len(ulab_files)) + " unlabeled files")
-
-  ### Create train/test data set file
+  print("Assigned splits for " + str(len(new_split_dict)) + " new files")
+  print("Split sizes train/val/test: " + str([len(train_files),len(val_files),len(test_files)]))
+  ai_utils.count_metric('split_images_assigned', len(new_split_dict))
+  ai_utils.count_metric('train_images', len(train_files) + len(val_files) + len(test_files))
+
+  ### Update split manifest and train/test data set files
+  if len(new_split_dict) > 0:
+    ai_utils.append_split_manifest(new_split_dict,manifest_file_path)
+  if project_dict.get('USE_IMAGE_CACHE', False) == True:
+    # Point the data set files at letterboxed copies sized for training
+    image_size = project_dict['IMAGE_SIZE']
+    cache_folder = os.path.join(train_folder,ai_utils.IMAGE_CACHE_FOLDER_NAME + '_' + str(image_size))
+    rel_paths = [os.path.relpath(image_file,label_folder) for image_file in (train_files + val_files + test_files)]
+    cached_set = ai_utils.build_image_cache(label_folder,cache_folder,rel_paths,image_size)
+    for split_files in [train_files,val_files,test_files]:
+      for i, image_file in enumerate(split_files):
+        rel_path = os.path.relpath(image_file,label_folder)
+        if rel_path in cached_set:
+          split_files[i] = os.path.join(cache_folder,rel_path)
   ai_utils.write_list_to_file(train_files, train_file_path)
-  if os.path.exists(val_file_path) == False:
-    ai_utils.write_list_to_file(val_files, val_file_path)
-  if os.path.exists(test_file_path) == False:
-    ai_utils.write_list_to_file(test_files, test_file_path)
+  ai_utils.write_list_to_file(val_files, val_file_path)
+  ai_utils.write_list_to_file(test_files, test_file_path)
 
   ### Create dictionary
 
@@ -332,6 +701,22 @@ def update_train_files(project_dict,label_folder,train_folder):
   return success
 
 
+def update_packed_data(project_dict,train_folder):
+  # Packs each split list in the training folder into memory mapped shard files
+  success = True
+  pack_folder = os.path.join(train_folder,ai_utils.PACKED_DATA_FOLDER_NAME)
+  data_format = project_dict.get('PACKED_DATA_FORMAT', 'encoded')
+  shard_size_mb = project_dict.get('PACKED_SHARD_SIZE_MB', ai_utils.PACKED_SHARD_SIZE_MB)
+  for split in ai_utils.SPLIT_NAMES:
+    split_file_path = os.path.join(train_folder,SPLIT_FILE_NAMES[split])
+    image_files = []
+    if os.path.exists(split_file_path) == True:
+      image_files = [image_file for image_file in ai_utils.read_list_from_file(split_file_path) if image_file != '']
+    if ai_utils.pack_data_split(image_files,pack_folder,split,data_format,shard_size_mb) == False:
+      success = False
+  return success
+
+
 def write_model_yaml_file(project_dict,output_file_path):
     success = False
     framework = project_dict['BASE_MODEL'].split('.pt')[0][:-1]
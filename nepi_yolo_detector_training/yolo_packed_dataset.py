@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2024 Numurus, LLC <https://www.numurus.com>.
+#
+# This file is part of nepi-engine
+# (see https://github.com/nepi-engine).
+#
+# License: 3-clause BSD, see https://opensource.org/licenses/BSD-3-Clause
+#
+
+
+
+############################
+# Yolo trainer that reads packed data shards
+############################
+
+imports = True
+try:
+    import os
+    import sys
+    import math
+    import cv2
+    import numpy as np
+    from ultralytics.data.dataset import YOLODataset
+    from ultralytics.models.yolo.detect import DetectionTrainer
+    from ultralytics.utils import colorstr
+
+except Exception as e:
+    print("Missing required python modules " + str(e))
+    print("Connect to internet and run the following in this folder")
+    print("sudo pip3 install -r requirements.txt")
+    print("Then try rerunning this script agian")
+    imports = False
+
+if imports == True:
+  import nepi_ai_train as ai_utils
+  imports = ai_utils.imports
+
+if imports == True:
+  import yolo_detector_utils as yolo_utils
+  imports = yolo_utils.imports
+
+
+if imports == False:
+    sys.exit(1) # Terminate the script with an exit code (e.g., 1 for error)
+
+
+##########################################
+# Packed Data Classes
+##########################################
+
+class packed_yolo_dataset(YOLODataset):
+    # YOLODataset that reads images and labels from a packed data split instead of individual files
+
+    def __init__(self, *args, pack_folder = None, split = 'train', **kwargs):
+        self.packed = ai_utils.packed_data_set(pack_folder, split)
+        super().__init__(*args, **kwargs)
+
+    def get_img_files(self, img_path):
+        return list(self.packed.im_files)
+
+    def get_labels(self):
+        labels = []
+        for i, im_file in enumerate(self.im_files):
+            boxes = self.packed.get_labels(i)
+            [height, width] = self.packed.shapes[i]
+            labels.append(dict(
+                im_file = im_file,
+                shape = (int(height), int(width)),
+                cls = boxes[:, 0:1].copy(),
+                bboxes = boxes[:, 1:].copy(),
+                segments = [],
+                keypoints = None,
+                normalized = True,
+                bbox_format = 'xywh'))
+        return labels
+
+    def load_image(self, i, rect_mode = True):
+        # Same resizing as the base class, without keeping decoded images in memory
+        if self.packed.data_format == 'raw':
+            im = cv2.cvtColor(self.packed.get_image(i), cv2.COLOR_RGB2BGR)
+        else:
+            im = cv2.imdecode(np.asarray(self.packed.get_image_bytes(i)), cv2.IMREAD_COLOR)
+        if im is None:
+            raise FileNotFoundError('Failed to decode packed image: ' + self.im_files[i])
+        h0, w0 = im.shape[:2]
+        if rect_mode:
+            r = self.imgsz / max(h0, w0)
+            if r != 1:
+                w, h = (min(math.ceil(w0 * r), self.imgsz), min(math.ceil(h0 * r), self.imgsz))
+                im = cv2.resize(im, (w, h), interpolation = cv2.INTER_LINEAR)
+        elif not (h0 == w0 == self.imgsz):
+            im = cv2.resize(im, (self.imgsz, self.imgsz), interpolation = cv2.INTER_LINEAR)
+        if self.augment:
+            # Mosaic picks its extra images from the buffer
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                self.buffer.pop(0)
+        return im, (h0, w0), im.shape[:2]
+
+
+class packed_detection_trainer(DetectionTrainer):
+    # DetectionTrainer that uses the packed split for a data set file when one exists
+
+    def build_dataset(self, img_path, mode = 'train', batch = None):
+        split = None
+        if isinstance(img_path, str):
+            for split_name, file_name in yolo_utils.SPLIT_FILE_NAMES.items():
+                if os.path.basename(img_path) == file_name:
+                    split = split_name
+        if split is None:
+            return super().build_dataset(img_path, mode, batch)
+        pack_folder = os.path.join(os.path.dirname(img_path), ai_utils.PACKED_DATA_FOLDER_NAME)
+        [index_name, shard_prefix] = ai_utils.get_packed_file_names(split)
+        if os.path.exists(os.path.join(pack_folder, index_name)) == False:
+            print('No packed data found for split ' + split + ', using image files')
+            return super().build_dataset(img_path, mode, batch)
+        print('Using packed data for split ' + split + ' from: ' + pack_folder)
+        model = getattr(self.model, 'module', self.model)
+        stride = max(int(model.stride.max() if model else 0), 32)
+        cfg = self.args
+        return packed_yolo_dataset(
+            pack_folder = pack_folder,
+            split = split,
+            img_path = img_path,
+            imgsz = cfg.imgsz,
+            batch_size = batch,
+            augment = mode == 'train',
+            hyp = cfg,
+            rect = cfg.rect or mode == 'val',
+            cache = None,
+            single_cls = cfg.single_cls or False,
+            stride = stride,
+            pad = 0.0 if mode == 'train' else 0.5,
+            prefix = colorstr(mode + ': '),
+            task = cfg.task,
+            classes = cfg.classes,
+            data = self.data,
+            fraction = cfg.fraction if mode == 'train' else 1.0)
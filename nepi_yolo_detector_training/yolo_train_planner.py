@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2024 Numurus, LLC <https://www.numurus.com>.
+#
+# This file is part of nepi-engine
+# (see https://github.com/nepi-engine).
+#
+# License: 3-clause BSD, see https://opensource.org/licenses/BSD-3-Clause
+#
+
+
+
+############################
+# Training resource planner for yolo detector training
+############################
+
+imports = True
+try:
+    import os
+    import sys
+    import copy
+    import math
+    import time
+    import random
+    import shutil
+    import tempfile
+    import threading
+    import concurrent.futures
+    import cv2
+    import numpy as np
+    import torch
+
+except Exception as e:
+    print("Missing required python modules " + str(e))
+    print("Connect to internet and run the following in this folder")
+    print("sudo pip3 install -r requirements.txt")
+    print("Then try rerunning this script agian")
+    imports = False
+
+if imports == True:
+  import nepi_ai_train as ai_utils
+  imports = ai_utils.imports
+
+if imports == True:
+  import yolo_detector_utils as yolo_utils
+  imports = yolo_utils.imports
+
+
+if imports == False:
+    sys.exit(1) # Terminate the script with an exit code (e.g., 1 for error)
+
+
+##########################################
+# Variables
+##########################################
+
+CACHE_MODES = ['none','disk','ram'] # from lightest to heaviest, matching the trainer's cache options
+TRAIN_CACHE_ARGS = {'none': False, 'disk': 'disk', 'ram': 'ram'}
+# Trainer device arguments for the devices the trainer can select, others train on the cpu
+TRAIN_DEVICE_ARGS = {'cuda': 0, 'cpu': 'cpu'}
+BATCH_SIZE_OPTIONS = [2,4,8,16,32,64]
+MAX_BATCH_SIZE = 64 # largest batch size tried when BATCH_SIZE is -1
+SAMPLE_IMAGES = 32
+PROBE_SECONDS = 5.0
+PROBE_STEPS = 3
+MEMORY_FRACTION = 0.8 # of the device or system memory a training run may plan to use
+CPU_MEMORY_FACTOR = 2.0 # optimizer state, ema model, and data batches on top of the probe's own memory use
+WORKER_MEMORY_MB = 300
+CACHE_MEMORY_FRACTION = 0.5 # the trainer also keeps half the free memory or disk when caching
+SPEED_TOLERANCE = 0.05 # plans within this fraction of the fastest count as equal, and the lightest one is used
+REPLAN_DATA_CHANGE = 0.1 # saved plans are reused until the training image count changes by more than this fraction
+
+PROBE_ARRAYS = []
+
+##########################################
+# Methods
+##########################################
+
+def set_probe_arrays(arrays):
+    global PROBE_ARRAYS
+    PROBE_ARRAYS = arrays
+
+
+def load_probe_image(item):
+    # Loads one image the way the trainer's data loader does for a cache mode. Augmentation is
+    # the same for all cache modes, so is left out. Returns the size of the loaded image in bytes.
+    [cache_mode, source, image_size] = item
+    if cache_mode == 'ram':
+        img = PROBE_ARRAYS[source].copy()
+    elif cache_mode == 'disk':
+        img = np.load(source)
+    else:
+        img = cv2.imread(source)
+        if img is None:
+            return 0
+        [height, width] = img.shape[:2]
+        scale = image_size / float(max(height, width))
+        if scale != 1:
+            img = cv2.resize(img, (min(math.ceil(width * scale), image_size), min(math.ceil(height * scale), image_size)),
+                             interpolation = cv2.INTER_LINEAR)
+    return img.nbytes
+
+
+def get_device_memory_mb(device):
+    if device == 'cuda':
+        return int(torch.cuda.get_device_properties(0).total_memory / 1048576.0)
+    if device == 'xpu' and hasattr(torch, 'xpu'):
+        return int(torch.xpu.get_device_properties(0).total_memory / 1048576.0)
+    return None
+
+
+def sync_device(device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    elif device == 'xpu':
+        torch.xpu.synchronize()
+
+
+def run_train_step(net, images, device):
+    # Forward and backward pass with a stand in loss. The trainer's loss and optimizer step add little next to these.
+    net.zero_grad(set_to_none = True)
+    with torch.autocast(device_type = 'cuda', enabled = device == 'cuda'):
+        outputs = net(images)
+    if isinstance(outputs, (list, tuple)) == False:
+        outputs = [outputs]
+    loss = sum(output.float().mean() for output in outputs if isinstance(output, torch.Tensor))
+    loss.backward()
+
+
+def probe_train_steps(net, device, batch_size, image_size, warmup = True):
+    # Returns the training images per second for batch_size on device
+    images = torch.rand(batch_size, 3, image_size, image_size, device = device)
+    if warmup == True:
+        run_train_step(net, images, device)
+        sync_device(device)
+    num_steps = 0
+    start_time = time.time()
+    while num_steps == 0 or (num_steps < PROBE_STEPS and time.time() - start_time < PROBE_SECONDS):
+        run_train_step(net, images, device)
+        sync_device(device)
+        num_steps += 1
+    return batch_size * num_steps / max(time.time() - start_time, 1e-6)
+
+
+def probe_batch_sizes(net, device, batch_sizes, image_size, memory_mb):
+    # Tries batch sizes from smallest to largest until one does not fit in memory.
+    # Returns a list of [batch_size, images_per_sec, memory_mb] for the ones that fit.
+    results = []
+    base_memory_mb = ai_utils.get_peak_memory_mb()
+    for batch_size in batch_sizes:
+        try:
+            if device == 'cuda':
+                torch.cuda.reset_peak_memory_stats()
+            rate = probe_train_steps(net, device, batch_size, image_size)
+        except RuntimeError as e:
+            if 'out of memory' not in str(e).lower():
+                raise
+            print('Batch size ' + str(batch_size) + ' ran out of device memory')
+            if device == 'cuda':
+                torch.cuda.empty_cache()
+            break
+        if device == 'cuda':
+            used_mb = torch.cuda.max_memory_allocated() / 1048576.0
+        else:
+            # Peak resident memory only grows, so larger batches are measured after smaller ones
+            used_mb = (ai_utils.get_peak_memory_mb() - base_memory_mb) * CPU_MEMORY_FACTOR
+        print('Batch size ' + str(batch_size) + ': ' + str(round(rate, 1)) + ' images/sec, ' + str(int(used_mb)) + ' MB')
+        ai_utils.count_metric('plan_probes')
+        if used_mb > memory_mb * MEMORY_FRACTION:
+            print('Batch size ' + str(batch_size) + ' does not fit in ' + str(memory_mb) + ' MB')
+            break
+        results.append([batch_size, rate, used_mb])
+    return results
+
+
+def probe_data_loading(net, device, batch_size, image_size, load_items, arrays, num_workers, train_rate):
+    # Returns the training images per second with num_workers data loader processes feeding the trainer
+    if len(load_items) == 0:
+        return train_rate
+    if num_workers == 0:
+        # The trainer loads each batch in its own process between steps
+        set_probe_arrays(arrays)
+        start_time = time.time()
+        for item in load_items:
+            load_probe_image(item)
+        load_rate = len(load_items) / max(time.time() - start_time, 1e-6)
+        return 1.0 / (1.0 / train_rate + 1.0 / load_rate)
+    # Loader processes run while the trainer steps, so they share the cpus the way a real run does
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers = num_workers, initializer = set_probe_arrays, initargs = (arrays,))
+    stop_event = threading.Event()
+    num_loaded = [0]
+    def load_loop():
+        while stop_event.is_set() == False:
+            num_loaded[0] += len(list(executor.map(load_probe_image, load_items, chunksize = max(1, len(load_items) // (num_workers * 2)))))
+    try:
+        list(executor.map(load_probe_image, load_items[:num_workers])) # start the worker processes
+        load_thread = threading.Thread(target = load_loop)
+        start_time = time.time()
+        load_thread.start()
+        try:
+            train_rate = probe_train_steps(net, device, batch_size, image_size, warmup = False)
+        finally:
+            stop_event.set()
+            load_thread.join()
+        load_rate = num_loaded[0] / max(time.time() - start_time, 1e-6)
+    finally:
+        executor.shutdown()
+    return min(train_rate, load_rate)
+
+
+def get_plan_key(device, resources, device_memory_mb, project_dict, max_batch_size):
+    # Saved plans are only reused for the same hardware and training settings
+    return {
+        'device': device,
+        'cpu_count': resources['cpu_count'],
+        'ram_total_mb': resources['ram_total_mb'],
+        'device_memory_mb': device_memory_mb,
+        'base_model': project_dict['BASE_MODEL'],
+        'image_size': project_dict['IMAGE_SIZE'],
+        'max_batch_size': max_batch_size,
+        'use_packed_data': project_dict.get('USE_PACKED_DATA', False)
+    }
+
+
+def get_saved_plan(train_dict, plan_key, num_images):
+    # Returns the plan saved in a train info dict if it was made with plan_key for about as many images, or None
+    if train_dict is None:
+        return None
+    plan = train_dict.get('TRAIN_PLAN')
+    if isinstance(plan, dict) == False or plan.get('plan_key') != plan_key:
+        return None
+    planned_images = plan.get('num_images', 0)
+    if planned_images <= 0 or abs(num_images - planned_images) > planned_images * REPLAN_DATA_CHANGE:
+        return None
+    return plan
+
+
+def get_train_args(plan):
+    # Returns the trainer arguments for a plan
+    train_args = {
+        'batch': plan['batch'],
+        'workers': plan['workers'],
+        'cache': TRAIN_CACHE_ARGS[plan['cache']]
+    }
+    if plan['device'] in TRAIN_DEVICE_ARGS:
+        train_args['device'] = TRAIN_DEVICE_ARGS[plan['device']]
+    return train_args
+
+
+def plan_training(model, device, project_dict, train_folder, last_train_dict = None):
+    # Probes the cpus, memory, device, and training data, then times short training runs over
+    # batch sizes, data loader worker counts, and cache modes. Returns the fastest plan that fits in memory,
+    # or None if there are no training images to plan with.
+    image_size = project_dict['IMAGE_SIZE']
+    max_batch_size = project_dict['BATCH_SIZE'] if project_dict['BATCH_SIZE'] > 0 else MAX_BATCH_SIZE
+    if device not in TRAIN_DEVICE_ARGS:
+        # The trainer only takes cuda device indexes or cpu, so runs on other devices train on the cpu
+        print('Trainer does not support device ' + device + ', planning training on the cpu')
+        device = 'cpu'
+    resources = ai_utils.get_system_resources(train_folder)
+    device_memory_mb = get_device_memory_mb(device)
+    split_file = os.path.join(train_folder, yolo_utils.SPLIT_FILE_NAMES['train'])
+    image_files = [image_file for image_file in ai_utils.read_list_from_file(split_file) if image_file != '']
+    num_images = len(image_files)
+    if num_images == 0:
+        print('No training images found in ' + split_file + ', training without a plan')
+        return None
+    plan_key = get_plan_key(device, resources, device_memory_mb, project_dict, max_batch_size)
+    plan = get_saved_plan(last_train_dict, plan_key, num_images)
+    if plan is not None:
+        print('Using saved training plan: ' + str(get_train_args(plan)))
+        return plan
+    print('Planning training for ' + str(num_images) + ' images on device ' + device + ' with resources: ' + str(resources))
+    start_time = time.time()
+    # Probes run on a copy, so the batch norm statistics of the model that gets trained are not changed
+    net = copy.deepcopy(model.model).to(device)
+    net.train()
+    for param in net.parameters():
+        param.requires_grad = True
+
+    ### Batch sizes
+    batch_sizes = sorted(set([batch_size for batch_size in BATCH_SIZE_OPTIONS if batch_size < max_batch_size] + [max_batch_size]))
+    memory_mb = device_memory_mb if device_memory_mb is not None else resources['ram_available_mb']
+    batch_results = probe_batch_sizes(net, device, batch_sizes, image_size, memory_mb)
+    if len(batch_results) == 0:
+        print('No batch size fit in memory, training with batch size 1')
+        batch_results = [[1, 0.0, 0.0]]
+    best_rate = max(result[1] for result in batch_results)
+    # The smallest batch size within SPEED_TOLERANCE of the fastest uses the least memory
+    [batch_size, train_rate, train_memory_mb] = min([result for result in batch_results if result[1] >= best_rate * (1 - SPEED_TOLERANCE)],
+                                                    key = lambda result: result[0])
+
+    ### Data loader workers and cache modes
+    loader_results = []
+    if best_rate == 0:
+        sample_files = []
+        loader_results.append(['none', min(2, resources['cpu_count']), 0.0])
+    else:
+        sample_files = random.Random(0).sample(image_files, min(num_images, SAMPLE_IMAGES))
+        arrays = []
+        for image_file in sample_files:
+            img = cv2.imread(image_file)
+            if img is not None:
+                [height, width] = img.shape[:2]
+                scale = image_size / float(max(height, width))
+                arrays.append(cv2.resize(img, (max(1, int(width * scale)), max(1, int(height * scale)))))
+        cache_mb = sum(img.nbytes for img in arrays) / max(len(arrays), 1) * num_images / 1048576.0
+        cpu_memory_mb = train_memory_mb if device == 'cpu' else 0
+        cache_modes = ['none']
+        if project_dict.get('USE_PACKED_DATA', False) == False and len(arrays) > 0:
+            if resources['disk_free_mb'] is not None and cache_mb < resources['disk_free_mb'] * CACHE_MEMORY_FRACTION:
+                cache_modes.append('disk')
+            if cache_mb < (resources['ram_available_mb'] - cpu_memory_mb) * CACHE_MEMORY_FRACTION:
+                cache_modes.append('ram')
+        worker_counts = sorted(set([0, min(2, resources['cpu_count']), resources['cpu_count'] // 2, resources['cpu_count']]))
+        probe_folder = tempfile.mkdtemp(prefix = 'plan_probe_', dir = train_folder)
+        try:
+            for cache_mode in cache_modes:
+                if cache_mode == 'disk':
+                    load_items = []
+                    for ind, img in enumerate(arrays):
+                        npy_file = os.path.join(probe_folder, str(ind) + '.npy')
+                        np.save(npy_file, img)
+                        load_items.append([cache_mode, npy_file, image_size])
+                elif cache_mode == 'ram':
+                    load_items = [[cache_mode, ind, image_size] for ind in range(len(arrays))]
+                else:
+                    load_items = [[cache_mode, image_file, image_size] for image_file in sample_files]
+                for num_workers in worker_counts:
+                    workers_memory_mb = cpu_memory_mb + num_workers * WORKER_MEMORY_MB + (cache_mb if cache_mode == 'ram' else 0)
+                    if num_workers > 0 and workers_memory_mb > resources['ram_available_mb'] * MEMORY_FRACTION:
+                        continue
+                    rate = probe_data_loading(net, device, batch_size, image_size, load_items,
+                                              arrays if cache_mode == 'ram' else [], num_workers, train_rate)
+                    print('Cache ' + cache_mode + ', ' + str(num_workers) + ' workers: ' + str(round(rate, 1)) + ' images/sec')
+                    ai_utils.count_metric('plan_probes')
+                    loader_results.append([cache_mode, num_workers, rate])
+        finally:
+            shutil.rmtree(probe_folder, ignore_errors = True)
+    best_rate = max(result[2] for result in loader_results)
+    fast_results = [result for result in loader_results if result[2] >= best_rate * (1 - SPEED_TOLERANCE)]
+    [cache_mode, num_workers, rate] = min(fast_results, key = lambda result: [CACHE_MODES.index(result[0]), result[1]])
+    del net
+    if device == 'cuda':
+        torch.cuda.empty_cache()
+
+    plan = {
+        'device': device,
+        'batch': batch_size,
+        'workers': num_workers,
+        'cache': cache_mode,
+        'images_per_sec': round(rate, 2),
+        'epoch_minutes': round(num_images / rate / 60.0, 2) if rate > 0 else None,
+        'num_images': num_images,
+        'cache_mb': int(cache_mb) if len(sample_files) > 0 else None,
+        'ram_available_mb': resources['ram_available_mb'],
+        'disk_free_mb': resources['disk_free_mb'],
+        'batch_probes': dict((str(result[0]), round(result[1], 2)) for result in batch_results),
+        'loader_probes': dict((result[0] + '_' + str(result[1]), round(result[2], 2)) for result in loader_results),
+        'plan_seconds': round(time.time() - start_time, 1),
+        'plan_key': plan_key
+    }
+    print('Planned training: ' + str(get_train_args(plan)) + ' at about ' + str(plan['epoch_minutes']) + ' minutes per epoch')
+    return plan
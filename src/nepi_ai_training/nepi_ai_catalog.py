@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2024 Numurus, LLC <https://www.numurus.com>.
+#
+# This file is part of nepi-engine
+# (see https://github.com/nepi-engine).
+#
+# License: 3-clause BSD, see https://opensource.org/licenses/BSD-3-Clause
+#
+
+
+
+############################
+# Persistent dataset catalog for ai training scripts
+############################
+
+imports = True
+try:
+    import os
+    import sys
+    import sqlite3
+    import concurrent.futures
+
+except Exception as e:
+    print("Missing required python modules " + str(e))
+    print("Connect to internet and run the following in this folder")
+    print("sudo pip3 install -r requirements.txt")
+    print("Then try rerunning this script agian")
+    imports = False
+
+if imports == True:
+  import nepi_ai_train as ai_utils
+  imports = ai_utils.imports
+  Image = ai_utils.Image
+
+
+##########################################
+# Catalog Settings
+##########################################
+
+CATALOG_FILE_NAME = 'dataset_catalog.db'
+
+CATALOG_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS folders (
+        folder TEXT PRIMARY KEY,
+        mtime_ns INTEGER,
+        num_img_files INTEGER,
+        num_xml_files INTEGER,
+        num_txt_files INTEGER
+    )''',
+    '''CREATE TABLE IF NOT EXISTS images (
+        folder TEXT,
+        name TEXT,
+        size INTEGER,
+        mtime_ns INTEGER,
+        hash TEXT,
+        width INTEGER,
+        height INTEGER,
+        valid INTEGER,
+        xml_name TEXT,
+        txt_name TEXT,
+        label_mtime_ns INTEGER,
+        num_boxes INTEGER,
+        split TEXT,
+        PRIMARY KEY (folder, name)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS files (
+        folder TEXT,
+        name TEXT,
+        ext TEXT,
+        PRIMARY KEY (folder, name)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS phashes (
+        hash TEXT PRIMARY KEY,
+        phash TEXT
+    )'''
+]
+
+
+##########################################
+# Catalog Utility Functions
+##########################################
+
+def get_file_hash(file_path):
+    return ai_utils.get_file_sha256(file_path)
+
+
+def get_image_info(file_path):
+    # Returns [width, height, valid] for an image file
+    width = 0
+    height = 0
+    valid = False
+    try:
+        with Image.open(file_path) as img:
+            [width, height] = img.size
+            img.verify()
+        valid = True
+    except Exception:
+        pass
+    return width, height, valid
+
+
+def get_image_hash(file_path):
+    # Returns the content hash of a file, or None if it can not be read
+    file_hash = None
+    try:
+        file_hash = get_file_hash(file_path)
+    except OSError:
+        pass
+    return file_hash
+
+
+def count_label_boxes(folder, txt_name, xml_name):
+    num_boxes = 0
+    try:
+        if txt_name is not None:
+            with open(os.path.join(folder, txt_name)) as f:
+                num_boxes = sum(1 for line in f if line.strip() != '')
+        elif xml_name is not None:
+            with open(os.path.join(folder, xml_name)) as f:
+                num_boxes = f.read().count('<object>')
+    except Exception as e:
+        print("Failed to count label boxes in folder: " + folder + " " + str(e))
+    return num_boxes
+
+
+def get_mtime_ns(path):
+    mtime_ns = None
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        pass
+    return mtime_ns
+
+
+##########################################
+# Dataset Catalog Class
+##########################################
+
+
+class dataset_catalog:
+
+    catalog_file = ''
+    conn = None
+    num_workers = 1
+
+    def __init__(self, project_folder, catalog_file = None, num_workers = None):
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        self.num_workers = num_workers
+        if catalog_file is None:
+            catalog_file = os.path.join(project_folder, CATALOG_FILE_NAME)
+        self.catalog_file = catalog_file
+        self.conn = sqlite3.connect(self.catalog_file)
+        ai_utils.add_written_path(self.catalog_file)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in CATALOG_SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    def commit(self):
+        # Saves scan and image check results so far, used as a checkpoint during long runs
+        if self.conn is not None:
+            self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+    def refresh_folder(self, folder, force = False):
+        # Rescans a folder only if its mtime changed since the last scan.
+        # Files edited in place do not change the folder mtime, so use force for those.
+        # New images are only recorded by size and mtime. They are hashed and checked when first needed.
+        changed = False
+        folder_mtime = get_mtime_ns(folder)
+        row = self.conn.execute('SELECT mtime_ns FROM folders WHERE folder=?', (folder,)).fetchone()
+        if folder_mtime is None:
+            if row is not None:
+                self.remove_folder(folder)
+                changed = True
+            return changed
+        if row is not None and row[0] == folder_mtime and force == False:
+            return changed
+        changed = True
+        print('Updating catalog for folder: ' + folder)
+
+        img_files = []
+        file_exts = dict()
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file() == False:
+                    continue
+                f_ext = os.path.splitext(entry.name)[1].replace(".","")
+                file_exts[entry.name] = f_ext
+                if f_ext in ai_utils.IMAGE_FILE_TYPES:
+                    img_files.append(entry.name)
+
+        old_rows = dict()
+        for old_row in self.conn.execute('SELECT name, size, mtime_ns, hash, width, height, valid, label_mtime_ns, num_boxes, split ' \
+                                         'FROM images WHERE folder=?', (folder,)):
+            old_rows[old_row[0]] = old_row
+
+        image_rows = []
+        for name in img_files:
+            file_path = os.path.join(folder, name)
+            try:
+                stat_info = os.stat(file_path)
+            except OSError:
+                continue
+            f_base = os.path.splitext(name)[0]
+            xml_name = f_base + '.xml' if (f_base + '.xml') in file_exts else None
+            txt_name = f_base + '.txt' if (f_base + '.txt') in file_exts else None
+            label_mtime = 0
+            for label_name in [xml_name, txt_name]:
+                if label_name is not None:
+                    label_mtime = max(label_mtime, get_mtime_ns(os.path.join(folder, label_name)) or 0)
+
+            old_row = old_rows.get(name)
+            split = None
+            if old_row is not None and old_row[1] == stat_info.st_size and old_row[2] == stat_info.st_mtime_ns:
+                [file_hash, width, height, valid] = old_row[3:7]
+                split = old_row[9]
+            else:
+                # A valid of None marks an image that has not been checked yet
+                [file_hash, width, height, valid] = [None, 0, 0, None]
+            if old_row is not None and old_row[7] == label_mtime and old_row[1] == stat_info.st_size:
+                num_boxes = old_row[8]
+            else:
+                num_boxes = count_label_boxes(folder, txt_name, xml_name)
+            image_rows.append([folder, name, stat_info.st_size, stat_info.st_mtime_ns, file_hash, width, height, valid,
+                               xml_name, txt_name, label_mtime, num_boxes, split])
+
+        num_xml_files = sum(1 for f_ext in file_exts.values() if f_ext == 'xml')
+        num_txt_files = sum(1 for f_ext in file_exts.values() if f_ext == 'txt')
+        with self.conn:
+            self.conn.execute('DELETE FROM images WHERE folder=?', (folder,))
+            self.conn.execute('DELETE FROM files WHERE folder=?', (folder,))
+            self.conn.executemany('INSERT INTO images VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', image_rows)
+            self.conn.executemany('INSERT INTO files VALUES (?,?,?)',
+                                  [(folder, name, f_ext) for name, f_ext in file_exts.items()])
+            self.conn.execute('INSERT OR REPLACE INTO folders VALUES (?,?,?,?,?)',
+                              (folder, folder_mtime, len(img_files), num_xml_files, num_txt_files))
+        return changed
+
+    def remove_folder(self, folder):
+        with self.conn:
+            self.conn.execute('DELETE FROM folders WHERE folder=?', (folder,))
+            self.conn.execute('DELETE FROM images WHERE folder=?', (folder,))
+            self.conn.execute('DELETE FROM files WHERE folder=?', (folder,))
+
+    def get_folder_list(self, folder_path, force = False, recursive = False):
+        # Same result as ai_utils.get_folder_list, with each subfolder refreshed in the catalog
+        folder_list = ai_utils.get_folder_list(folder_path, recursive = recursive)
+        for folder in folder_list:
+            self.refresh_folder(folder, force = force)
+        # Drop folders that no longer exist
+        # The prefix is compared with substr, since '_' and '%' in folder names are LIKE wildcards
+        prefix = folder_path.rstrip('/') + '/'
+        folder_set = set(folder_list)
+        query = 'SELECT folder FROM folders WHERE substr(folder,1,?)=?'
+        for row in self.conn.execute(query, (len(prefix), prefix)).fetchall():
+            if row[0] not in folder_set and (recursive == True or '/' not in row[0][len(prefix):]):
+                self.remove_folder(row[0])
+        return folder_list
+
+    def get_folder_files(self, folder_path):
+        # Same result as ai_utils.get_folder_files, served from the catalog
+        img_files = []
+        xml_files = []
+        txt_files = []
+        if os.path.exists(folder_path) == False:
+            print('Get stats folder not found: ' + folder_path)
+        else:
+            self.refresh_folder(folder_path)
+            for [name, f_ext] in self.conn.execute('SELECT name, ext FROM files WHERE folder=?', (folder_path,)):
+                if f_ext in ai_utils.IMAGE_FILE_TYPES:
+                    img_files.append(name)
+                if f_ext == 'xml':
+                    xml_files.append(name)
+                if f_ext == 'txt':
+                    txt_files.append(name)
+        return img_files,xml_files,txt_files
+
+    def get_folder_stats(self, folder_path):
+        self.refresh_folder(folder_path)
+        row = self.conn.execute('SELECT num_img_files, num_xml_files, num_txt_files FROM folders WHERE folder=?',
+                                (folder_path,)).fetchone()
+        if row is None:
+            row = (0, 0, 0)
+        num_boxes = self.conn.execute('SELECT COALESCE(SUM(num_boxes),0) FROM images WHERE folder=?',
+                                      (folder_path,)).fetchone()[0]
+        stats = {
+            'num_img_files': row[0],
+            'num_xml_files': row[1],
+            'num_txt_files': row[2],
+            'num_boxes': num_boxes
+        }
+        return stats
+
+    def check_image_file(self, file_path):
+        # Catalog backed version of ai_utils.check_image_file.
+        # Images are checked the first time they are asked for and the result is saved with the next commit.
+        folder = os.path.dirname(file_path)
+        name = os.path.basename(file_path)
+        self.refresh_folder(folder)
+        query = 'SELECT size, mtime_ns, valid FROM images WHERE folder=? AND name=?'
+        row = self.conn.execute(query, (folder, name)).fetchone()
+        if row is None:
+            return ai_utils.check_image_file(file_path)
+        try:
+            stat_info = os.stat(file_path)
+        except OSError:
+            return False
+        if row[0] != stat_info.st_size or row[1] != stat_info.st_mtime_ns:
+            self.refresh_folder(folder, force = True)
+            row = self.conn.execute(query, (folder, name)).fetchone()
+            if row is None:
+                return False
+        if row[2] is None:
+            [width, height, valid] = get_image_info(file_path)
+            self.conn.execute('UPDATE images SET width=?, height=?, valid=? WHERE folder=? AND name=?',
+                              (width, height, int(valid), folder, name))
+            ai_utils.IMAGE_CHECK_CACHE[file_path] = [row[0], row[1], valid]
+            ai_utils.count_metric('catalog_image_checks')
+            return valid
+        return row[2] == 1
+
+    def get_image_rows(self, folder_path, valid_only = True, labeled_only = False):
+        # Returns list of [name, size, mtime_ns, hash, width, height, valid, xml_name, txt_name, num_boxes, split]
+        # Images not checked yet have a valid of None and are included with valid_only
+        self.refresh_folder(folder_path)
+        query = 'SELECT name, size, mtime_ns, hash, width, height, valid, xml_name, txt_name, num_boxes, split ' \
+                'FROM images WHERE folder=?'
+        if valid_only == True:
+            query += ' AND (valid IS NULL OR valid=1)'
+        if labeled_only == True:
+            query += ' AND txt_name IS NOT NULL'
+        return [list(row) for row in self.conn.execute(query + ' ORDER BY name', (folder_path,))]
+
+    def set_splits(self, folder_path, split_dict):
+        # split_dict maps image file name to its split name
+        with self.conn:
+            self.conn.executemany('UPDATE images SET split=? WHERE folder=? AND name=?',
+                                  [(split, folder_path, name) for name, split in split_dict.items()])
+
+    def get_image_hashes(self, file_paths):
+        # Returns the catalog's content hash of each image file, or None for files not in the catalog.
+        # Catalog images without a hash yet are hashed here and their hashes saved.
+        content_hashes = []
+        folder_hashes = dict()
+        hash_rows = []
+        for file_path in file_paths:
+            folder = os.path.dirname(file_path)
+            if folder not in folder_hashes:
+                self.refresh_folder(folder)
+                folder_hashes[folder] = dict((row[0], row[1:]) for row in
+                                             self.conn.execute('SELECT name, hash, size, mtime_ns FROM images WHERE folder=?', (folder,)))
+            content_hash = None
+            row = folder_hashes[folder].get(os.path.basename(file_path))
+            if row is not None:
+                try:
+                    stat_info = os.stat(file_path)
+                    # Images replaced in place are hashed again rather than trusting the catalog row
+                    if row[1] == stat_info.st_size and row[2] == stat_info.st_mtime_ns:
+                        content_hash = row[0]
+                        if content_hash is None:
+                            hash_rows.append([len(content_hashes), folder, os.path.basename(file_path)])
+                except OSError:
+                    pass
+            content_hashes.append(content_hash)
+
+        if len(hash_rows) > 0:
+            paths = [file_paths[entry[0]] for entry in hash_rows]
+            if self.num_workers > 1 and len(paths) >= ai_utils.MIN_POOL_FILES:
+                print('Hashing ' + str(len(paths)) + ' image files with ' + str(self.num_workers) + ' workers')
+                chunk_size = max(1, len(paths) // (self.num_workers * 4))
+                with concurrent.futures.ProcessPoolExecutor(max_workers = self.num_workers) as executor:
+                    new_hashes = list(executor.map(get_image_hash, paths, chunksize = chunk_size))
+            else:
+                new_hashes = [get_image_hash(file_path) for file_path in paths]
+            for [ind, folder, name], content_hash in zip(hash_rows, new_hashes):
+                content_hashes[ind] = content_hash
+            ai_utils.count_metric('catalog_image_hashes', len(paths))
+            with self.conn:
+                self.conn.executemany('UPDATE images SET hash=? WHERE folder=? AND name=?',
+                                      [(content_hash, folder, name) for [ind, folder, name], content_hash in
+                                       zip(hash_rows, new_hashes) if content_hash is not None])
+        return content_hashes
+
+    def get_image_phashes(self, file_paths):
+        # Catalog backed version of ai_utils.get_image_phashes, cached by image content hash
+        content_hashes = self.get_image_hashes(file_paths)
+        cached = dict()
+        hash_list = list(set(content_hash for content_hash in content_hashes if content_hash is not None))
+        for start in range(0, len(hash_list), 500):
+            batch = hash_list[start:start + 500]
+            query = 'SELECT hash, phash FROM phashes WHERE hash IN (' + ','.join(['?'] * len(batch)) + ')'
+            cached.update(dict(self.conn.execute(query, batch)))
+        missing = [ind for ind, content_hash in enumerate(content_hashes) if cached.get(content_hash) is None]
+        phashes = [cached.get(content_hash) for content_hash in content_hashes]
+        if len(missing) > 0:
+            new_phashes = ai_utils.get_image_phashes([file_paths[ind] for ind in missing], self.num_workers)
+            new_rows = []
+            for ind, phash in zip(missing, new_phashes):
+                phashes[ind] = phash
+                if phash is not None and content_hashes[ind] is not None:
+                    new_rows.append((content_hashes[ind], phash))
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO phashes VALUES (?,?)', new_rows)
+        return phashes
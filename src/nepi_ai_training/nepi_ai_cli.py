@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2024 Numurus, LLC <https://www.numurus.com>.
+#
+# This file is part of nepi-engine
+# (see https://github.com/nepi-engine).
+#
+# License: 3-clause BSD, see https://opensource.org/licenses/BSD-3-Clause
+#
+
+
+
+############################
+# nepi-ai-train command line tool
+############################
+
+# Only the standard library is imported here. Each command imports what it needs when it runs,
+# so 'stats' and 'validate' never load the training frameworks.
+
+imports = True
+try:
+    import os
+    import sys
+    import glob
+    import runpy
+    import argparse
+    import importlib
+except Exception as e:
+    print("Missing required python modules " + str(e))
+    imports = False
+
+
+if imports == False:
+    sys.exit(1) # Terminate the script with an exit code (e.g., 1 for error)
+
+
+##########################################
+# Variables
+##########################################
+
+PROJECT_FILE = 'project_settings.yaml'
+DATA_RAW_FOLDER = 'data_raw'
+DATA_LABEL_FOLDER = 'data_labeling'
+
+# Commands that run a project script, with the script name prefix used by every framework
+SCRIPT_COMMANDS = {
+    'init': 'initialize_project',
+    'label': 'label_data',
+    'train': 'train_model',
+    'deploy': 'deploy_model',
+    'watch': 'watch_data',
+    'clean': 'clean_data_store'
+}
+# Framework utility modules that provide validate_project_settings
+PROJECT_UTILS_MODULES = ['yolo_detector_utils']
+
+##########################################
+# Methods
+##########################################
+
+def find_project_folder(folder_path):
+    # Returns folder_path or the closest folder above it with a project settings file, or None
+    folder_path = os.path.abspath(folder_path)
+    while True:
+        if os.path.exists(os.path.join(folder_path, PROJECT_FILE)):
+            return folder_path
+        parent_folder = os.path.dirname(folder_path)
+        if parent_folder == folder_path:
+            return None
+        folder_path = parent_folder
+
+
+def set_project_path(project_folder):
+    # Project scripts import the sdk modules copied into the project folder, or else the installed ones next to this file
+    if project_folder not in sys.path:
+        sys.path.insert(0, project_folder)
+    sdk_folder = os.path.dirname(os.path.realpath(__file__))
+    if sdk_folder not in sys.path:
+        sys.path.append(sdk_folder)
+
+
+def import_sdk_module(module_name):
+    # Sdk modules come from the nepi_ai_training package when this file runs as part of it, and otherwise are
+    # the top level modules installed next to this file or copied into the project folder. Package modules are
+    # also registered by their top level name, so modules that import them by that name share one copy.
+    if __package__:
+        module = importlib.import_module(__package__ + '.' + module_name)
+        sys.modules.setdefault(module_name, module)
+        return module
+    return importlib.import_module(module_name)
+
+
+def find_project_script(project_folder, command):
+    script_files = sorted(glob.glob(os.path.join(project_folder, SCRIPT_COMMANDS[command] + '_*.py')))
+    if len(script_files) == 0:
+        return None
+    return script_files[0]
+
+
+def run_project_script(project_folder, command, script_args):
+    script_file = find_project_script(project_folder, command)
+    if script_file is None:
+        print('No ' + SCRIPT_COMMANDS[command] + ' script found in project folder: ' + project_folder)
+        return 1
+    sys.argv = [script_file] + script_args
+    runpy.run_path(script_file, run_name = '__main__')
+    return 0
+
+
+def print_folder_stats(stats_file):
+    ai_utils = import_sdk_module('nepi_ai_train')
+    stats_dict = ai_utils.read_dict_from_file(stats_file)
+    if stats_dict is None:
+        return
+    print('')
+    print(stats_file)
+    print('  ' + 'folder'.ljust(32) + 'images'.rjust(10) + 'xml'.rjust(10) + 'txt'.rjust(10) + 'boxes'.rjust(10))
+    folder_names = sorted(key for key in stats_dict.keys() if key != 'ALL_FOLDERS') + ['ALL_FOLDERS']
+    for folder_name in folder_names:
+        folder_stats = stats_dict.get(folder_name) or dict()
+        print('  ' + folder_name.ljust(32) + ''.join(str(folder_stats.get(key, '')).rjust(10) for key in
+                                                   ['num_img_files', 'num_xml_files', 'num_txt_files', 'num_boxes']))
+    class_counts = (stats_dict.get('ALL_FOLDERS') or dict()).get('class_counts')
+    if class_counts is not None:
+        print('  class counts: ' + ', '.join(name + ': ' + str(count) for name, count in class_counts.items()))
+
+
+def run_stats(project_folder, update = False):
+    ai_utils = import_sdk_module('nepi_ai_train')
+    data_folder = os.path.join(project_folder, DATA_RAW_FOLDER)
+    label_folder = os.path.join(project_folder, DATA_LABEL_FOLDER)
+    if update == True:
+        ai_catalog = import_sdk_module('nepi_ai_catalog')
+        ai_label_index = import_sdk_module('nepi_ai_label_index')
+        catalog = ai_catalog.dataset_catalog(project_folder)
+        ai_utils.update_stats_file(data_folder, catalog = catalog)
+        ai_utils.update_stats_file(label_folder, catalog = catalog, label_index = ai_label_index.label_index(label_folder))
+        catalog.close()
+    for folder in [data_folder, label_folder]:
+        stats_file = os.path.join(folder, ai_utils.STATS_FILE_NAME)
+        if os.path.exists(stats_file) == False:
+            print('No stats file found, run the initialize project script or stats --update: ' + stats_file)
+        else:
+            print_folder_stats(stats_file)
+    return 0
+
+
+def run_validate(project_folder, check_labels = False):
+    # Returns 1 if the project settings have errors or, with check_labels, if any label file has issues
+    ai_utils = import_sdk_module('nepi_ai_train')
+    project_dict = ai_utils.read_dict_from_file(os.path.join(project_folder, PROJECT_FILE))
+    errors = []
+    warnings = []
+    for module_name in PROJECT_UTILS_MODULES:
+        if os.path.exists(os.path.join(project_folder, module_name + '.py')):
+            project_utils = importlib.import_module(module_name)
+            [errors, warnings] = project_utils.validate_project_settings(project_dict, project_folder)
+            break
+    for warning in warnings:
+        print('WARNING: ' + warning)
+    for error in errors:
+        print('ERROR: ' + error)
+    success = len(errors) == 0
+    if success == True and check_labels == True:
+        ai_label_index = import_sdk_module('nepi_ai_label_index')
+        label_folder = os.path.join(project_folder, DATA_LABEL_FOLDER)
+        label_index = ai_label_index.label_index(label_folder, classes = project_dict['CLASSES'])
+        label_index.update()
+        check_dict = label_index.check_labels(len(project_dict['CLASSES']))
+        success = check_dict['num_issue_files'] == 0
+    print('Project settings are valid' if success == True else 'Project validation failed')
+    return 0 if success == True else 1
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'nepi-ai-train', description = 'Runs NEPI AI training project commands')
+    parser.add_argument('-p', '--project-folder', default = os.getcwd(),
+                        help = 'project folder, or a folder inside it (default is the current folder)')
+    subparsers = parser.add_subparsers(dest = 'command')
+    for command, script_prefix in SCRIPT_COMMANDS.items():
+        subparser = subparsers.add_parser(command, help = 'run the ' + script_prefix + ' script')
+        subparser.add_argument('script_args', nargs = argparse.REMAINDER, help = 'arguments passed to the script')
+    subparser = subparsers.add_parser('stats', help = 'print the image, label, and class counts of the project folders')
+    subparser.add_argument('--update', action = 'store_true', help = 'rescan the folders before printing')
+    subparser = subparsers.add_parser('validate', help = 'check the project settings file')
+    subparser.add_argument('--labels', action = 'store_true', help = 'also check the txt label files')
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+
+    project_folder = find_project_folder(args.project_folder)
+    if project_folder is None:
+        print('No ' + PROJECT_FILE + ' file found in or above folder: ' + os.path.abspath(args.project_folder))
+        return 1
+    set_project_path(project_folder)
+    if args.command in SCRIPT_COMMANDS:
+        return run_project_script(project_folder, args.command, args.script_args)
+    if args.command == 'stats':
+        return run_stats(project_folder, update = args.update)
+    return run_validate(project_folder, check_labels = args.labels)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2024 Numurus, LLC <https://www.numurus.com>.
+#
+# This file is part of nepi-engine
+# (see https://github.com/nepi-engine).
+#
+# License: 3-clause BSD, see https://opensource.org/licenses/BSD-3-Clause
+#
+
+
+
+############################
+# Array backed index of the yolo txt labels in a labeling folder
+############################
+
+imports = True
+try:
+    import os
+    import sys
+
+except Exception as e:
+    print("Missing required python modules " + str(e))
+    print("Connect to internet and run the following in this folder")
+    print("sudo pip3 install -r requirements.txt")
+    print("Then try rerunning this script agian")
+    imports = False
+
+if imports == True:
+  import nepi_ai_train as ai_utils
+  imports = ai_utils.imports
+  np = ai_utils.np
+
+
+##########################################
+# Label Index Settings
+##########################################
+
+LABEL_INDEX_FILE_NAME = 'label_index.npz'
+
+# Box size bin edges, as the square root of the normalized box area
+BOX_SIZE_BINS = [0.0, 0.02, 0.05, 0.1, 0.2, 0.4, 1.0]
+
+LABEL_CHECK_REPORT_FILE_NAME = 'label_check_report.yaml'
+LABEL_CHECK_ACTIONS = ['fix','report','ignore']
+LABEL_ISSUE_NAMES = ['bad_class_id','out_of_range','zero_area','duplicate']
+# Coordinates within this distance outside of [0, 1] are clipped without being reported
+LABEL_RANGE_TOLERANCE = 1e-4
+# Boxes with a normalized width or height at or below this size are removed
+MIN_BOX_SIZE = 1e-4
+
+
+##########################################
+# Label Index Class
+##########################################
+
+
+class label_index:
+
+    label_folder = ''
+    index_file = ''
+    classes = []
+
+    def __init__(self, label_folder, index_file = None, classes = None):
+        self.label_folder = label_folder
+        if index_file is None:
+            index_file = os.path.join(label_folder, LABEL_INDEX_FILE_NAME)
+        self.index_file = index_file
+        if classes is None:
+            classes_file = os.path.join(label_folder, ai_utils.CLASSES_FILE_NAME)
+            classes = []
+            if os.path.exists(classes_file):
+                classes = [line for line in ai_utils.read_list_from_file(classes_file) if line != '']
+        self.classes = classes
+        self.clear()
+        self.load()
+
+    def clear(self):
+        self.folders = np.zeros(0, dtype = np.str_)
+        self.file_folder_ids = np.zeros(0, dtype = np.int32)
+        self.file_names = np.zeros(0, dtype = np.str_)
+        self.file_sizes = np.zeros(0, dtype = np.int64)
+        self.file_mtimes = np.zeros(0, dtype = np.int64)
+        self.image_ids = np.zeros(0, dtype = np.int32)
+        self.class_ids = np.zeros(0, dtype = np.int32)
+        self.xywh = np.zeros((0, 4), dtype = np.float32)
+
+    def load(self):
+        if os.path.exists(self.index_file):
+            try:
+                with np.load(self.index_file) as index:
+                    self.folders = index['folders']
+                    self.file_folder_ids = index['file_folder_ids']
+                    self.file_names = index['file_names']
+                    self.file_sizes = index['file_sizes']
+                    self.file_mtimes = index['file_mtimes']
+                    self.image_ids = index['image_ids']
+                    self.class_ids = index['class_ids']
+                    self.xywh = index['xywh']
+            except Exception as e:
+                print('Failed to load label index, rebuilding: ' + self.index_file + ' ' + str(e))
+                self.clear()
+
+    def save(self):
+        ai_utils.write_file_atomic(self.index_file, lambda f: np.savez(f, folders = self.folders,
+                                   file_folder_ids = self.file_folder_ids, file_names = self.file_names,
+                                   file_sizes = self.file_sizes, file_mtimes = self.file_mtimes, image_ids = self.image_ids,
+                                   class_ids = self.class_ids, xywh = self.xywh), mode = 'wb')
+
+    def update(self, folders = None):
+        # Rereads only the txt label files whose size or mtime changed since the last update.
+        # Set folders to a list of folder names to only scan those folders, the files of the others are kept as indexed.
+        # Returns the number of label files read.
+        old_keys = dict()
+        old_folder_ids = dict()
+        for i, [folder_id, name] in enumerate(zip(self.file_folder_ids.tolist(), self.file_names.tolist())):
+            old_keys[(str(self.folders[folder_id]), name)] = i
+            old_folder_ids.setdefault(str(self.folders[folder_id]), []).append(i)
+        scan_folders = set(folders) if folders is not None else None
+        folders = sorted(os.path.basename(folder) for folder in ai_utils.get_folder_list(self.label_folder))
+        file_folder_ids = []
+        file_names = []
+        file_sizes = []
+        file_mtimes = []
+        keep_old_ids = []
+        keep_new_ids = []
+        new_image_ids = []
+        new_class_ids = []
+        new_xywh = []
+        num_existing = 0
+        for folder_id, folder in enumerate(folders):
+            if scan_folders is not None and folder not in scan_folders and folder in old_folder_ids:
+                for old_id in old_folder_ids[folder]:
+                    keep_old_ids.append(old_id)
+                    keep_new_ids.append(len(file_names))
+                    num_existing += 1
+                    file_folder_ids.append(folder_id)
+                    file_names.append(str(self.file_names[old_id]))
+                    file_sizes.append(int(self.file_sizes[old_id]))
+                    file_mtimes.append(int(self.file_mtimes[old_id]))
+                continue
+            with os.scandir(os.path.join(self.label_folder, folder)) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.txt') == False or entry.is_file() == False:
+                        continue
+                    if entry.name == ai_utils.CLASSES_FILE_NAME:
+                        continue # labelImg class list, not a label file
+                    file_stat = entry.stat()
+                    image_id = len(file_names)
+                    old_id = old_keys.get((folder, entry.name))
+                    if old_id is not None and self.file_sizes[old_id] == file_stat.st_size and self.file_mtimes[old_id] == file_stat.st_mtime_ns:
+                        keep_old_ids.append(old_id)
+                        keep_new_ids.append(image_id)
+                    else:
+                        try:
+                            [class_ids, xywh] = ai_utils.read_txt_label_array(entry.path)
+                        except Exception as e:
+                            print('Failed to read label file: ' + entry.path + ' ' + str(e))
+                            continue
+                        new_image_ids.append(np.full(len(class_ids), image_id, dtype = np.int32))
+                        new_class_ids.append(class_ids.astype(np.int32))
+                        new_xywh.append(xywh.astype(np.float32))
+                    if old_id is not None:
+                        num_existing += 1
+                    file_folder_ids.append(folder_id)
+                    file_names.append(entry.name)
+                    file_sizes.append(file_stat.st_size)
+                    file_mtimes.append(file_stat.st_mtime_ns)
+        num_read = len(file_names) - len(keep_old_ids)
+        num_removed = len(self.file_names) - num_existing
+        if num_read == 0 and num_removed == 0 and np.array_equal(self.folders, np.array(folders, dtype = np.str_)):
+            return 0
+        # Carry over the boxes of unchanged files with their new image ids
+        id_map = np.full(len(self.file_names), -1, dtype = np.int32)
+        id_map[np.array(keep_old_ids, dtype = np.int64)] = np.array(keep_new_ids, dtype = np.int32)
+        kept_ids = id_map[self.image_ids]
+        keep_mask = kept_ids >= 0
+        self.image_ids = np.concatenate([kept_ids[keep_mask]] + new_image_ids).astype(np.int32)
+        self.class_ids = np.concatenate([self.class_ids[keep_mask]] + new_class_ids).astype(np.int32)
+        self.xywh = np.concatenate([self.xywh[keep_mask]] + new_xywh).astype(np.float32).reshape(-1, 4)
+        self.folders = np.array(folders, dtype = np.str_)
+        self.file_folder_ids = np.array(file_folder_ids, dtype = np.int32)
+        self.file_names = np.array(file_names, dtype = np.str_)
+        self.file_sizes = np.array(file_sizes, dtype = np.int64)
+        self.file_mtimes = np.array(file_mtimes, dtype = np.int64)
+        self.save()
+        ai_utils.count_metric('label_files_read', num_read)
+        ai_utils.count_metric('label_boxes_read', sum(len(class_ids) for class_ids in new_class_ids))
+        print('Label index read ' + str(num_read) + ' label files, removed ' + str(num_removed) + ', now has ' +
+              str(len(self.file_names)) + ' files and ' + str(len(self.class_ids)) + ' boxes')
+        return num_read
+
+    def get_num_classes(self):
+        num_classes = len(self.classes)
+        if len(self.class_ids) > 0:
+            num_classes = max(num_classes, int(self.class_ids.max()) + 1)
+        return num_classes
+
+    def get_class_name(self, class_id):
+        if class_id < len(self.classes):
+            return self.classes[class_id]
+        return str(class_id)
+
+    def get_box_mask(self, folder = None, class_id = None):
+        mask = self.class_ids >= 0
+        if folder is not None:
+            folder_ids = np.nonzero(self.folders == folder)[0]
+            folder_id = folder_ids[0] if len(folder_ids) > 0 else -1
+            mask &= self.file_folder_ids[self.image_ids] == folder_id
+        if class_id is not None:
+            mask &= self.class_ids == class_id
+        return mask
+
+    def get_class_counts(self, folder = None):
+        # Returns an array of box counts indexed by class id
+        mask = self.get_box_mask(folder)
+        return np.bincount(self.class_ids[mask], minlength = self.get_num_classes())
+
+    def get_folder_class_counts(self):
+        # Returns a [num_folders, num_classes] array of box counts
+        num_classes = self.get_num_classes()
+        mask = self.get_box_mask()
+        flat_ids = self.file_folder_ids[self.image_ids[mask]].astype(np.int64) * num_classes + self.class_ids[mask]
+        counts = np.bincount(flat_ids, minlength = len(self.folders) * num_classes)
+        return counts.reshape(len(self.folders), num_classes)
+
+    def get_file_class_ids(self):
+        # Returns a dict of label file rel path ('folder/file.txt') to the sorted list of class ids in that file
+        order = np.argsort(self.image_ids, kind = 'stable')
+        sorted_class_ids = self.class_ids[order]
+        bounds = np.searchsorted(self.image_ids[order], np.arange(len(self.file_names) + 1))
+        file_class_ids = dict()
+        for image_id in range(len(self.file_names)):
+            file_class_ids[self.get_file_rel_path(image_id)] = np.unique(sorted_class_ids[bounds[image_id]:bounds[image_id + 1]]).tolist()
+        return file_class_ids
+
+    def get_box_size_histogram(self, bins = BOX_SIZE_BINS, folder = None, class_id = None):
+        # Returns box counts for each bin of sqrt(width * height) in normalized image units
+        mask = self.get_box_mask(folder, class_id)
+        sizes = np.sqrt(np.clip(self.xywh[mask, 2] * self.xywh[mask, 3], 0, 1))
+        return np.histogram(sizes, bins = bins)[0]
+
+    def get_stats_dict(self, bins = BOX_SIZE_BINS):
+        # Returns label stats for the labeling folder and each of its folders
+        folder_counts = self.get_folder_class_counts()
+        num_classes = folder_counts.shape[1]
+        num_files = np.bincount(self.file_folder_ids, minlength = len(self.folders))
+        bin_names = [str(bins[i]) + '-' + str(bins[i + 1]) for i in range(len(bins) - 1)]
+        stats_dict = dict()
+        for folder_id, folder in enumerate(self.folders.tolist()):
+            stats_dict[folder] = {
+                'num_label_files': int(num_files[folder_id]),
+                'class_counts': {self.get_class_name(i): int(folder_counts[folder_id, i]) for i in range(num_classes)}
+            }
+        sizes = self.get_box_size_histogram(bins)
+        stats_dict['ALL_FOLDERS'] = {
+            'num_label_files': int(len(self.file_names)),
+            'class_counts': {self.get_class_name(i): int(folder_counts[:, i].sum()) for i in range(num_classes)},
+            'box_size_counts': {bin_name: int(count) for bin_name, count in zip(bin_names, sizes)}
+        }
+        return stats_dict
+
+    def check_labels(self, num_classes, fix = False, report_file = None):
+        # Checks every indexed box for class ids outside of [0, num_classes), coordinates outside of the image,
+        # zero area boxes, and duplicate boxes. If fix is True, out of range boxes are clipped to the image,
+        # the other bad boxes are removed, and the affected label files are rewritten.
+        # Returns a dict with the issue counts and the files affected by each issue.
+        xyxy = np.concatenate([self.xywh[:, 0:2] - self.xywh[:, 2:4] / 2, self.xywh[:, 0:2] + self.xywh[:, 2:4] / 2], axis = 1)
+        finite = np.isfinite(xyxy).all(axis = 1)
+        bad_class = (self.class_ids < 0) | (self.class_ids >= num_classes)
+        out_of_range = ~finite | (xyxy < -LABEL_RANGE_TOLERANCE).any(axis = 1) | (xyxy > 1 + LABEL_RANGE_TOLERANCE).any(axis = 1)
+        xyxy = np.clip(np.nan_to_num(xyxy), 0, 1)
+        fixed_xywh = np.concatenate([(xyxy[:, 0:2] + xyxy[:, 2:4]) / 2, xyxy[:, 2:4] - xyxy[:, 0:2]], axis = 1).astype(np.float32)
+        zero_area = (fixed_xywh[:, 2:4] <= MIN_BOX_SIZE).any(axis = 1)
+        # Duplicates are boxes in the same file with the same class and coordinates after rounding to label file precision
+        duplicate = np.zeros(len(self.class_ids), dtype = bool)
+        candidates = np.nonzero(~(bad_class | zero_area))[0]
+        if len(candidates) > 0:
+            keys = np.column_stack([self.image_ids[candidates], self.class_ids[candidates],
+                                    np.round(fixed_xywh[candidates] * 1e6).astype(np.int64)])
+            order = np.lexsort(keys.T[::-1])
+            sorted_keys = keys[order]
+            repeated = np.zeros(len(order), dtype = bool)
+            repeated[1:] = (sorted_keys[1:] == sorted_keys[:-1]).all(axis = 1)
+            duplicate[candidates[order[repeated]]] = True
+        issue_masks = dict(zip(LABEL_ISSUE_NAMES, [bad_class, out_of_range, zero_area, duplicate]))
+        remove_mask = bad_class | zero_area | duplicate
+        issue_image_ids = np.unique(self.image_ids[remove_mask | out_of_range])
+
+        report_dict = dict()
+        report_dict['num_files'] = int(len(self.file_names))
+        report_dict['num_boxes'] = int(len(self.class_ids))
+        report_dict['num_classes'] = int(num_classes)
+        report_dict['num_issue_files'] = int(len(issue_image_ids))
+        report_dict['issue_counts'] = {name: int(mask.sum()) for name, mask in issue_masks.items()}
+        report_dict['fixed'] = bool(fix and len(issue_image_ids) > 0)
+        report_dict['issue_files'] = dict()
+        for name, mask in issue_masks.items():
+            report_dict['issue_files'][name] = [self.get_file_rel_path(image_id) for image_id in np.unique(self.image_ids[mask]).tolist()]
+        ai_utils.count_metric('boxes_checked', report_dict['num_boxes'])
+        print('Checked ' + str(report_dict['num_boxes']) + ' boxes in ' + str(report_dict['num_files']) + ' label files, found issues ' +
+              str(report_dict['issue_counts']) + ' in ' + str(report_dict['num_issue_files']) + ' files')
+
+        if fix == True and len(issue_image_ids) > 0:
+            keep_indexes = np.nonzero(~remove_mask)[0]
+            keep_indexes = keep_indexes[np.argsort(self.image_ids[keep_indexes], kind = 'stable')]
+            keep_image_ids = self.image_ids[keep_indexes]
+            starts = np.searchsorted(keep_image_ids, issue_image_ids, side = 'left')
+            ends = np.searchsorted(keep_image_ids, issue_image_ids, side = 'right')
+            for image_id, start, end in zip(issue_image_ids.tolist(), starts.tolist(), ends.tolist()):
+                box_indexes = keep_indexes[start:end]
+                file_path = os.path.join(self.label_folder, self.get_file_rel_path(image_id))
+                ai_utils.save_txt_label_array(self.class_ids[box_indexes], fixed_xywh[box_indexes], file_path)
+                ai_utils.add_written_path(file_path)
+            print('Fixed ' + str(len(issue_image_ids)) + ' label files, removed ' + str(int(remove_mask.sum())) + ' boxes')
+            self.update()
+        if report_file is not None:
+            ai_utils.write_dict_to_file(report_dict, report_file)
+        return report_dict
+
+    def get_file_rel_path(self, image_id):
+        return os.path.join(str(self.folders[self.file_folder_ids[image_id]]), str(self.file_names[image_id]))
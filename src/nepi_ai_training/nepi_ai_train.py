@@ -21,18 +21,35 @@ try:
     sys.tracebacklimit = None
     import grp
     import pwd
-    import subprocess
+    import importlib
+    import importlib.util
     import glob
     import fileinput
     import random
     import yaml
     import shutil
     import logging
-    import declxml as xml
-    from PIL import Image
     import shlex
     import getpass
-    import xml.etree.ElementTree as ET
+    import hashlib
+    import math
+    import stat
+    import fcntl
+    import time
+    import concurrent.futures
+    import io
+    import json
+    import itertools
+    import threading
+    import select
+    import struct
+    import ctypes
+    import ctypes.util
+    import resource
+    # Heavy modules are only checked for here, and imported on first use
+    for module_name in ['numpy','PIL','declxml']:
+        if importlib.util.find_spec(module_name) is None:
+            raise ImportError("No module named '" + module_name + "'")
     
 
 except Exception as e:
@@ -42,6 +59,28 @@ except Exception as e:
     print("Then try rerunning this script agian")
     imports = False
 
+
+class lazy_module(object):
+    # Stands in for a module that is imported on first attribute access, so scripts and commands
+    # that never use a heavy module start without importing it
+
+    def __init__(self, module_name):
+        self.__dict__['module_name'] = module_name
+        self.__dict__['module'] = None
+
+    def __getattr__(self, name):
+        module = self.__dict__['module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['module_name'])
+            self.__dict__['module'] = module
+        return getattr(module, name)
+
+np = lazy_module('numpy')
+Image = lazy_module('PIL.Image')
+xml = lazy_module('declxml')
+ET = lazy_module('xml.etree.ElementTree')
+subprocess = lazy_module('subprocess')
+
 ##########################################
 # PORJECT SETTINGS - Edit as Necessary
 ##########################################
@@ -60,12 +99,83 @@ RANDOM_FILE_NAME = 'random_set'
 CLASSES_FILE_NAME = 'classes.txt'
 STATS_FILE_NAME = 'stats.yaml'
 
+BOX_TAG_INDEXES = {'xmin': 0, 'ymin': 1, 'xmax': 2, 'ymax': 3}
+
+UNKNOWN_LABEL_ACTIONS = ['ask','add','remove','skip']
+REMOVE_LABEL_NAME = 'Remove'
+UNKNOWN_CLASS_ID = -2
+
+SPLIT_NAMES = ['train','val','test']
+
+LINK_MODES = ['copy','hardlink','reflink','symlink','store']
+FICLONE = 0x40049409 # Linux ioctl request for reflink copies
+DATA_STORE_FOLDER_NAME = 'data_store'
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Run metrics settings
+RUN_LOG_FILE_NAME = 'run_log.jsonl'
+METRICS_PREFIX = 'nepi_ai_training'
+
+# Crash recovery settings
+STAGE_JOURNAL_FILE_NAME = 'stage_journal.txt'
+CHECKPOINT_SECONDS = 60
+
+# Folder watcher settings
+WATCH_POLL_INTERVAL = 5.0
+WATCH_DEBOUNCE_SECONDS = 3.0
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT_SIZE = 16
+
+COPY_WORKERS = 8
+COPY_MTIME_TOLERANCE = 2.0 # seconds, covers FAT file systems on usb drives
+
+IMAGE_CHECK_CACHE_FILE_NAME = 'image_check_cache.txt'
+
+IMAGE_CACHE_FOLDER_NAME = 'image_cache'
+IMAGE_CACHE_MANIFEST_FILE_NAME = 'cache_manifest.txt'
+IMAGE_CACHE_PAD_COLOR = (114, 114, 114)
+IMAGE_CACHE_JPEG_QUALITY = 95
+
+PACKED_DATA_FOLDER_NAME = 'packed_data'
+PACKED_DATA_FORMATS = ['encoded','raw']
+PACKED_SHARD_SIZE_MB = 1024
+
+# Difference hash grid size, giving PHASH_SIZE * PHASH_SIZE bit hashes
+PHASH_SIZE = 8
+# Number of chunks each hash is split into for duplicate searches
+PHASH_CHUNKS = 4
+# Largest group of chained near duplicates, so a slowly changing image sequence does not join into one group
+DEDUP_MAX_GROUP_SIZE = 500
+BIT_COUNTS = [bin(value).count('1') for value in range(256)]
+MIN_POOL_FILES = 64
+
 
 ##########################################
 # System Variables
 ##########################################
 CURRENT_FOLDER = os.path.realpath(__file__)
 
+# Image check results keyed by file path with values [size, mtime_ns, valid]
+IMAGE_CHECK_CACHE = dict()
+
+# Paths created or written by this process, for fix_folder_permissions
+WRITTEN_PATHS = set()
+
+FOLDER_PERMISSIONS_MODE = 0o775
+
+# Link modes that already failed and fell back to copies
+LINK_FALLBACK_MODES = set()
+# Content addressed image store used by the 'store' link mode, see set_data_store_folder
+DATA_STORE_FOLDER = None
+# Image check cache file from load_image_check_cache, saved again at checkpoints
+IMAGE_CHECK_CACHE_FILE = None
+# Active run_metrics from start_run_metrics, which count_metric adds to
+RUN_METRICS = None
+
 
 ##########################################
 # AI Training Utility Functions
@@ -94,71 +204,141 @@ def make_folder(folder_path):
     success = False
     try:
         os.mkdir(folder_path)
+        add_written_path(folder_path)
         fix_folder_permissions(folder_path)
         success = True
     except Exception as e:
         print("Failed to make folder: " + folder_path + " " + str(e))
     return success
 
-def fix_folder_permissions(folder_path, user = None, group = None):
+def add_written_path(path):
+    WRITTEN_PATHS.add(path)
+
+def pop_written_paths():
+    paths = sorted(WRITTEN_PATHS)
+    WRITTEN_PATHS.clear()
+    return paths
+
+def start_run_metrics(script_name, log_file = None, prom_folder = None):
+    global RUN_METRICS
+    RUN_METRICS = run_metrics(script_name, log_file = log_file, prom_folder = prom_folder)
+    return RUN_METRICS
+
+def count_metric(name, value = 1):
+    # Adds to a counter of the active run stage. Counters ending in '_seconds' are times.
+    if RUN_METRICS is not None:
+        RUN_METRICS.count(name, value)
+
+def walk_folder_paths(folder_path):
+    # Yields folder_path and every path under it without following symlinked folders
+    yield folder_path
+    for [file_type, entry] in scan_folder(folder_path, recursive = True, folders = True):
+        yield entry.path
+
+def fix_folder_permissions(folder_path, user = None, group = None, file_paths = None):
+    # Sets owner and mode on folder_path and everything under it, only touching paths that differ.
+    # If file_paths is given, only folder_path and those paths are checked.
     success = True
+    if os.path.exists(folder_path) == False:
+        return success
     [fuser,fgroup] = get_user_id(folder_path)
     if user is None:
         user = fuser
     if group is None:
         group = fgroup
-    print("setting permissions for folder: " + folder_path + " to " + user + ":"  + group)
-    if os.path.exists(folder_path) == True:
+    try:
+        uid = pwd.getpwnam(user).pw_uid
+        gid = grp.getgrnam(group).gr_gid
+    except KeyError as e:
+        print("Failed to find user or group for folder permissions: " + user + ":" + group + " " + str(e))
+        return False
+    if file_paths is None:
+        print("setting permissions for folder: " + folder_path + " to " + user + ":"  + group)
+        paths = walk_folder_paths(folder_path)
+    else:
+        print("setting permissions for " + str(len(file_paths)) + " paths in folder: " + folder_path + " to " + user + ":"  + group)
+        folder_prefix = folder_path.rstrip('/') + '/'
+        paths = [folder_path] + [path for path in file_paths if path.startswith(folder_prefix)]
+    start_time = time.time()
+    num_checked = 0
+    num_fixed = 0
+    for path in paths:
+        num_checked += 1
         try:
-            os.system('chown -R ' + user + ':' + group + ' ' + folder_path) # Use os.system instead of os.chown to have a recursive option
-            #os.chown(full_path_subdir, user, group)
-            os.system('chmod -R 0775 ' + folder_path)
+            stat_info = os.lstat(path)
+            fixed = False
+            if stat_info.st_uid != uid or stat_info.st_gid != gid:
+                os.lchown(path, uid, gid)
+                fixed = True
+            if stat.S_ISLNK(stat_info.st_mode) == False and stat.S_IMODE(stat_info.st_mode) != FOLDER_PERMISSIONS_MODE:
+                os.chmod(path, FOLDER_PERMISSIONS_MODE)
+                fixed = True
+            if fixed == True:
+                num_fixed += 1
+        except FileNotFoundError:
+            pass
         except Exception as e:
             success = False
-            print("Failed to update folder permissions: " + folder_path + " " + str(e))
+            print("Failed to update permissions: " + path + " " + str(e))
+    if num_fixed > 0:
+        print("Updated permissions for " + str(num_fixed) + " paths in folder: " + folder_path)
+    count_metric('permission_paths_checked', num_checked)
+    count_metric('permission_paths_fixed', num_fixed)
+    count_metric('permission_seconds', time.time() - start_time)
     return success
 
 
-def get_folder_list(folder_path):
-
-  folder_list=[]
-  if os.path.exists(folder_path):
-    filelist=os.listdir(folder_path + '/')
-    #print('')
-    #print('Files and Folders in Path:')
-    #print(folder_path)
-    #print(filelist)
-    for i, file in enumerate(filelist):
-        #print(file)
-        foldername = (folder_path + '/' + file)
-        #print('Checking file: ')
-        #print(foldername)
-        if os.path.isdir(foldername): # file is a folder
-            folder_list.append(foldername)
-  return folder_list
+def get_file_type(file_name):
+    # Returns 'image', 'xml', 'txt' or 'other' from a file's extension
+    f_ext = os.path.splitext(file_name)[1].replace(".","")
+    if f_ext in IMAGE_FILE_TYPES:
+        return 'image'
+    if f_ext == 'xml' or f_ext == 'txt':
+        return f_ext
+    return 'other'
+
+
+def scan_folder(folder_path, recursive = False, ext_list = None, file_types = None, folders = False):
+    # Yields [file_type, entry] for the files in a folder without building lists, where entry is an os.DirEntry
+    # whose stat() result is cached and file_type is from get_file_type. ext_list entries can be 'xml' or '.xml'.
+    # Subfolders are yielded with file_type 'folder' if folders is True, and scanned if recursive is True.
+    # Symlinked folders are listed but never scanned.
+    if ext_list is not None:
+        ext_list = set(ext.replace(".","") for ext in ext_list)
+    scan_folders = [folder_path]
+    while len(scan_folders) > 0:
+        folder = scan_folders.pop()
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    try:
+                        is_folder = entry.is_dir()
+                    except OSError:
+                        is_folder = False
+                    if is_folder == True:
+                        if recursive == True and entry.is_symlink() == False:
+                            scan_folders.append(entry.path)
+                        if folders == True:
+                            yield ['folder', entry]
+                        continue
+                    if ext_list is not None and os.path.splitext(entry.name)[1].replace(".","") not in ext_list:
+                        continue
+                    file_type = get_file_type(entry.name)
+                    if file_types is not None and file_type not in file_types:
+                        continue
+                    yield [file_type, entry]
+        except OSError as e:
+            if folder == folder_path and os.path.exists(folder_path) == False:
+                return
+            print("Failed to scan folder: " + folder + " " + str(e))
+
+
+def get_folder_list(folder_path, recursive = False):
+    # Returns the subfolders of folder_path, including nested subfolders if recursive is True
+    return [entry.path for [file_type, entry] in scan_folder(folder_path, recursive = recursive, file_types = [], folders = True)]
 
 def get_file_list(folder_path, ext_list = None):
-  all_files = ext_list is None
-  file_list = []
-  if os.path.exists(folder_path):
-    filelist=os.listdir(folder_path + '/')
-    #print('')
-    #print('Files and Folders in Path:')
-    #print(folder_path)
-    #print(filelist)
-    for i, file in enumerate(filelist):
-        #print(file)
-        filename = (folder_path + '/' + file)
-        #print('Checking file: ')
-        #print(filename)
-        if os.path.isdir(filename) == False: # file is a folder
-            f_split = os.path.splitext(file)
-            if len(f_split) > 1:
-                f_ext = os.path.splitext(file)[1]
-                f_ext_clean = f_split[1].replace(".","")
-            if all_files == True or f_ext in ext_list or f_ext_clean in ext_list:
-                file_list.append(filename)
-  return file_list
+    return [entry.path for [file_type, entry] in scan_folder(folder_path, ext_list = ext_list)]
 
 
 def open_new_file(file_path):
@@ -177,12 +357,41 @@ def read_list_from_file(file_path):
         lines = [line.rstrip() for line in f] 
     return lines
 
-def write_list_to_file(data_list, file_path):
+def sync_folder(folder_path):
+    # Makes renames in a folder durable. Not supported on every file system.
+    try:
+        fd = os.open(folder_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def write_file_atomic(file_path, write_function, mode = 'w', sync = True):
+    # Calls write_function with an open temp file, then renames it over file_path, so a crash leaves
+    # either the old or the new file and never a truncated one. sync also makes the write survive
+    # power loss, but is slow for many small files such as txt labels.
+    tmp_path = file_path + '.' + str(os.getpid()) + '_' + str(threading.get_ident()) + '.tmp'
+    try:
+        with open(tmp_path, mode) as f:
+            write_function(f)
+            if sync == True:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if sync == True:
+        sync_folder(os.path.dirname(os.path.abspath(file_path)))
+    add_written_path(file_path)
+
+def write_list_to_file(data_list, file_path, sync = True):
     success = True
     try:
-        with open(file_path, 'w') as file:
-            for data in data_list:
-                file.write(data + '\n')
+        write_file_atomic(file_path, lambda f: f.writelines(data + '\n' for data in data_list), sync = sync)
     except Exception as e:
         print("Failed to write list to file " + file_path + " " + str(e))
         success = False
@@ -206,14 +415,52 @@ def read_dict_from_file(file_path):
 def write_dict_to_file(dict_2_save,file_path,defaultFlowStyle=False,sortKeys=False):
     success = False
     try:
-        with open(file_path, "w") as f:
-            yaml.dump(dict_2_save, stream=f, default_flow_style=defaultFlowStyle, sort_keys=sortKeys)
+        write_file_atomic(file_path, lambda f: yaml.dump(dict_2_save, stream=f, default_flow_style=defaultFlowStyle, sort_keys=sortKeys))
         success = True
     except Exception as e:
         print("Failed to write dict: "  + " to file: " + file_path + " " + str(e))
     return success
 
 
+def get_hash_split(rel_path, val_percent = 10, test_percent = 10):
+    # Stable split from a hash of the path, so reruns always agree
+    digest = hashlib.sha1(rel_path.encode('utf-8')).hexdigest()
+    bucket = (int(digest[:8], 16) % 10000) / float(100)
+    if bucket < val_percent:
+        return 'val'
+    elif bucket < (val_percent + test_percent):
+        return 'test'
+    return 'train'
+
+
+def read_split_manifest(file_path):
+    split_dict = dict()
+    if os.path.exists(file_path):
+        try:
+            with open(file_path) as f:
+                for line in f:
+                    entry = line.rstrip('\n').split('\t')
+                    if len(entry) == 2 and entry[1] in SPLIT_NAMES:
+                        split_dict[entry[0]] = entry[1]
+        except Exception as e:
+            print("Failed to read split manifest: " + file_path + " " + str(e))
+    return split_dict
+
+
+def append_split_manifest(split_dict, file_path):
+    # Only new entries are passed in, so existing lines are never rewritten
+    success = True
+    try:
+        with open(file_path, 'a') as f:
+            for rel_path, split in split_dict.items():
+                f.write(rel_path + '\t' + split + '\n')
+        add_written_path(file_path)
+    except Exception as e:
+        print("Failed to append to split manifest: " + file_path + " " + str(e))
+        success = False
+    return success
+
+
 def copy_file(file_path, destination_path):
     success = False
     output_path = destination_path.replace(" ","_")
@@ -221,6 +468,7 @@ def copy_file(file_path, destination_path):
     if os.path.exists(output_path) == False:
         try:
             shutil.copy(file_path, output_path)
+            add_written_path(output_path)
             #print("File: " + file_path + " Copied to: " + output_path)
             success = True
         except FileNotFoundError:
@@ -230,6 +478,211 @@ def copy_file(file_path, destination_path):
     return success 
 
 
+def reflink_file(file_path, output_path):
+    with open(file_path, 'rb') as src:
+        with open(output_path, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                dst.close()
+                os.remove(output_path)
+                raise
+
+def set_data_store_folder(folder_path):
+    global DATA_STORE_FOLDER
+    DATA_STORE_FOLDER = folder_path
+
+
+def get_file_sha256(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        block = f.read(HASH_BLOCK_SIZE)
+        while block:
+            sha.update(block)
+            block = f.read(HASH_BLOCK_SIZE)
+    return sha.hexdigest()
+
+
+def store_file(file_path):
+    # Adds a file to the content addressed data store and returns its blob path.
+    # Blobs are reflinked or copied from the source, never hardlinked, so changing or removing a raw data file
+    # can not change a blob. Files with the same content are stored once.
+    if DATA_STORE_FOLDER is None:
+        raise OSError('No data store folder set')
+    file_hash = get_file_sha256(file_path)
+    blob_folder = os.path.join(DATA_STORE_FOLDER, file_hash[:2])
+    blob_path = os.path.join(blob_folder, file_hash + os.path.splitext(file_path)[1].lower())
+    if os.path.exists(blob_path) == False:
+        if os.path.exists(blob_folder) == False:
+            os.makedirs(blob_folder, exist_ok = True)
+            add_written_path(blob_folder)
+        tmp_path = blob_path + '.' + str(os.getpid()) + '_' + str(threading.get_ident()) + '.tmp'
+        try:
+            try:
+                reflink_file(file_path, tmp_path)
+            except OSError:
+                shutil.copy2(file_path, tmp_path)
+            # Linking the finished blob in place never replaces a blob another worker already added
+            os.link(tmp_path, blob_path)
+        except FileExistsError:
+            pass
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        add_written_path(blob_path)
+    return blob_path
+
+
+def gc_data_store(store_folder, view_folders):
+    # Removes blobs from the data store that no file or symlink in the view folders refers to.
+    # Returns [num_removed, num_bytes_removed]
+    num_removed = 0
+    num_bytes = 0
+    if os.path.exists(store_folder) == False:
+        return num_removed, num_bytes
+    used_inodes = set()
+    used_targets = set()
+    for view_folder in view_folders:
+        for path in walk_folder_paths(view_folder):
+            try:
+                path_stat = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISLNK(path_stat.st_mode):
+                used_targets.add(os.path.realpath(path))
+            elif stat.S_ISREG(path_stat.st_mode):
+                used_inodes.add((path_stat.st_dev, path_stat.st_ino))
+    blob_folders = []
+    for path in walk_folder_paths(store_folder):
+        if path == store_folder:
+            continue
+        try:
+            path_stat = os.lstat(path)
+        except OSError:
+            continue
+        if stat.S_ISDIR(path_stat.st_mode):
+            blob_folders.append(path)
+        elif (path_stat.st_dev, path_stat.st_ino) not in used_inodes and os.path.realpath(path) not in used_targets:
+            try:
+                os.remove(path)
+                num_removed += 1
+                num_bytes += path_stat.st_size
+            except OSError as e:
+                print('Failed to remove blob: ' + path + ' ' + str(e))
+    for blob_folder in blob_folders:
+        if next(scan_folder(blob_folder, folders = True), None) is None:
+            os.rmdir(blob_folder)
+    print('Removed ' + str(num_removed) + ' unused blobs (' + str(round(num_bytes / 1e6, 1)) + ' MB) from data store: ' + store_folder)
+    count_metric('store_files_removed', num_removed)
+    count_metric('store_bytes_removed', num_bytes)
+    return num_removed, num_bytes
+
+
+def link_file(file_path, destination_path, link_mode = 'copy'):
+    # Same as copy_file, but can share the source data with a hardlink, reflink or symlink.
+    # The 'store' mode links to a blob in the content addressed data store instead of the source file.
+    # Falls back to a copy if the link is not supported, for example across file systems.
+    # Only use links for files that are never written in place, such as images.
+    if link_mode == 'copy' or link_mode not in LINK_MODES:
+        return copy_file(file_path, destination_path)
+    success = False
+    output_path = destination_path.replace(" ","_")
+    if os.path.exists(output_path) == False:
+        try:
+            if link_mode == 'hardlink':
+                os.link(file_path, output_path)
+            elif link_mode == 'reflink':
+                reflink_file(file_path, output_path)
+            elif link_mode == 'symlink':
+                os.symlink(os.path.abspath(file_path), output_path)
+            elif link_mode == 'store':
+                blob_path = store_file(file_path)
+                try:
+                    os.link(blob_path, output_path)
+                except OSError:
+                    os.symlink(os.path.abspath(blob_path), output_path)
+            add_written_path(output_path)
+            success = True
+        except FileNotFoundError:
+            print("Error file " + file_path + "not found") 
+        except OSError as e:
+            if link_mode not in LINK_FALLBACK_MODES:
+                print("Failed to " + link_mode + " files, using copies instead: " + str(e))
+                LINK_FALLBACK_MODES.add(link_mode)
+            success = copy_file(file_path, destination_path)
+    return success
+
+
+def copy_file_pair(file_path, output_path, link_mode = 'copy'):
+    # Returns [status, num_bytes] with status one of 'copied', 'skipped', 'missing' or 'failed'
+    try:
+        src_stat = os.stat(file_path)
+    except OSError:
+        return ['missing', 0]
+    try:
+        dst_stat = os.stat(output_path)
+        if link_mode != 'copy':
+            return ['skipped', 0]
+        if dst_stat.st_size == src_stat.st_size and abs(dst_stat.st_mtime - src_stat.st_mtime) <= COPY_MTIME_TOLERANCE:
+            return ['skipped', 0]
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print("Failed to check file: " + output_path + " " + str(e))
+        return ['failed', 0]
+    try:
+        if link_mode == 'copy':
+            # copy2 keeps the source mtime so the next run can skip this file
+            shutil.copy2(file_path, output_path)
+            add_written_path(output_path)
+        elif link_file(file_path, output_path, link_mode) == False:
+            return ['failed', 0]
+    except Exception as e:
+        print("Failed to copy file: " + file_path + " " + str(e))
+        return ['failed', 0]
+    return ['copied', src_stat.st_size]
+
+def copy_files_bulk(file_pairs, link_mode = 'copy', num_workers = COPY_WORKERS):
+    # Copies a list of [source_path, destination_path] pairs on a thread pool, skipping destinations
+    # with the same size and mtime as their source. Returns a dict of counts and throughput.
+    start_time = time.time()
+    file_pairs = [[file_path, dest_path.replace(" ","_")] for [file_path, dest_path] in file_pairs]
+    for folder in sorted(set(os.path.dirname(dest_path) for [file_path, dest_path] in file_pairs)):
+        if os.path.exists(folder) == False:
+            try:
+                os.makedirs(folder)
+                add_written_path(folder)
+            except Exception as e:
+                print("Failed to make folder: " + folder + " " + str(e))
+    counts = {'copied': 0, 'skipped': 0, 'missing': 0, 'failed': 0}
+    num_bytes = 0
+    if len(file_pairs) > 0:
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, num_workers)) as executor:
+            for [status, size] in executor.map(lambda pair: copy_file_pair(pair[0], pair[1], link_mode), file_pairs):
+                counts[status] += 1
+                num_bytes += size
+    elapsed = max(time.time() - start_time, 1e-6)
+    copy_stats = {
+        'num_files': counts['copied'],
+        'num_skipped': counts['skipped'],
+        'num_missing': counts['missing'],
+        'num_failed': counts['failed'],
+        'num_bytes': num_bytes,
+        'seconds': round(elapsed, 3),
+        'mb_per_sec': round(num_bytes / elapsed / 1e6, 2),
+        'files_per_sec': round(counts['copied'] / elapsed, 1)
+    }
+    count_metric('files_copied', counts['copied'])
+    count_metric('files_skipped', counts['skipped'])
+    count_metric('bytes_copied', num_bytes)
+    count_metric('copy_seconds', elapsed)
+    if len(file_pairs) > 0:
+        print('Copied ' + str(counts['copied']) + ' files (' + str(round(num_bytes / 1e6, 1)) + ' MB) with ' + link_mode +
+              ', skipped ' + str(counts['skipped']) + ', failed ' + str(counts['failed']) + ' in ' + str(copy_stats['seconds']) + ' sec: ' +
+              str(copy_stats['mb_per_sec']) + ' MB/s, ' + str(copy_stats['files_per_sec']) + ' files/s')
+    return copy_stats
+
+
 def get_folder_files(folder_path):
     img_files = []
     xml_files = []
@@ -237,20 +690,14 @@ def get_folder_files(folder_path):
     if os.path.exists(folder_path) == False:
         print('Get stats folder not found: ' + folder_path)
     else:
-        path, dirs, files = next(os.walk(folder_path))
-        for file in files:
-            f_ext = os.path.splitext(file)[1]
-            f_ext = f_ext.replace(".","")
-            if f_ext in IMAGE_FILE_TYPES:
-                img_files.append(file)
-            if f_ext == 'xml':
-                xml_files.append(file)
-            if f_ext == 'txt':
-                txt_files.append(file)
+        file_lists = {'image': img_files, 'xml': xml_files, 'txt': txt_files}
+        for [file_type, entry] in scan_folder(folder_path, file_types = file_lists.keys()):
+            file_lists[file_type].append(entry.name)
     return img_files,xml_files,txt_files
 
 
-def update_stats_file(folder_path):
+def update_stats_file(folder_path, catalog = None, label_index = None, folders = None):
+    # Set folders to a list of subfolders to only update their stats, the others are kept from the stats file
     stats_dict = dict()
     if os.path.exists(folder_path) == False:
         print('Stats update folder not found: ' + folder_path)
@@ -262,12 +709,31 @@ def update_stats_file(folder_path):
             'num_xml_files': 0,
             'num_txt_files': 0
         }   
-        folders_to_process=get_folder_list(folder_path)
+        old_stats_dict = None
+        if folders is not None and os.path.exists(stats_file):
+            old_stats_dict = read_dict_from_file(stats_file)
+        if old_stats_dict is not None:
+            stats_dict.update(old_stats_dict)
+            folders_to_process = []
+            for folder in folders:
+                if os.path.dirname(os.path.normpath(folder)) != os.path.normpath(folder_path):
+                    continue # nested folders have no stats entry
+                if os.path.isdir(folder):
+                    folders_to_process.append(folder)
+                else:
+                    stats_dict.pop(os.path.basename(folder), None)
+        elif catalog is not None:
+            folders_to_process=catalog.get_folder_list(folder_path)
+        else:
+            folders_to_process=get_folder_list(folder_path)
         #print('Found folders: ' + str(folders_to_process))
         for folder in folders_to_process:
             #print('Gathering stats for folder: ' + folder)
-            [img_files,xml_files,txt_files] = get_folder_files(folder)
             folder_name = os.path.basename(folder)
+            if catalog is not None:
+                stats_dict[folder_name] = catalog.get_folder_stats(folder)
+                continue
+            [img_files,xml_files,txt_files] = get_folder_files(folder)
             stats_dict[folder_name] = {
                 'num_img_files': len(img_files),
                 'num_xml_files': len(xml_files),
@@ -288,7 +754,19 @@ def update_stats_file(folder_path):
             'num_xml_files': num_xml_files,
             'num_txt_files': num_txt_files
         }
+        if catalog is not None:
+            stats_dict['ALL_FOLDERS']['num_boxes'] = sum(stats_dict[key].get('num_boxes', 0) for key in stats_dict.keys() if key != 'ALL_FOLDERS')
+        if label_index is not None:
+            # Add class counts and box sizes from the label index
+            if old_stats_dict is not None:
+                label_index.update(folders = [os.path.basename(folder) for folder in folders_to_process])
+            else:
+                label_index.update()
+            for key, label_stats in label_index.get_stats_dict().items():
+                if key in stats_dict:
+                    stats_dict[key].update(label_stats)
         success = write_dict_to_file(stats_dict,stats_file)
+        count_metric('stats_folders', len(folders_to_process))
     return stats_dict
 
 
@@ -321,9 +799,10 @@ def fix_brocken_labels(labels, classes, classes_dict):
                     classes.append(label)
                     index = classes.index(label)
                 elif sel_ind == (len(classes) + 1):
-                    label = get_new_label()
-                    classes.append(label)
-                    index = classes.index(label)
+                    new_label = get_new_label()
+                    if new_label not in classes:
+                        classes.append(new_label)
+                    index = classes.index(new_label)
                 elif sel_ind == (len(classes) + 2):
                     index = -1
                 else:
@@ -335,47 +814,211 @@ def fix_brocken_labels(labels, classes, classes_dict):
     return classes, classes_dict
 
 
+def find_unknown_labels(file_paths, classes, classes_dict):
+    # Scans xml files and returns a dict of labels found in neither classes nor classes_dict to their counts
+    unknown_labels = dict()
+    for file_path in file_paths:
+        try:
+            labels = parse_xml_label_boxes(file_path)[2]
+        except Exception as e:
+            print('Failed to read xml label file: ' + file_path + ' ' + str(e))
+            continue
+        for label in labels:
+            if label not in classes_dict and label not in classes:
+                unknown_labels[label] = unknown_labels.get(label, 0) + 1
+    return unknown_labels
+
+
+def resolve_unknown_labels(unknown_labels, classes, classes_dict, label_mapping = None, unknown_action = 'ask'):
+    # Maps each unknown label once, from label_mapping first, then by unknown_action.
+    # label_mapping maps a label to a class name, or to None or 'Remove' to drop its boxes.
+    # unknown_action is one of 'ask', 'add', 'remove' or 'skip'. 'ask' is treated as 'skip'
+    # when there is no terminal, so unattended runs never wait for input.
+    # Returns [classes, classes_dict, unresolved_labels]
+    if label_mapping is None:
+        label_mapping = dict()
+    if unknown_action not in UNKNOWN_LABEL_ACTIONS:
+        print('Unknown label action ' + str(unknown_action) + ' not in ' + str(UNKNOWN_LABEL_ACTIONS) + ', using skip')
+        unknown_action = 'skip'
+    if unknown_action == 'ask' and sys.stdin.isatty() == False:
+        unknown_action = 'skip'
+    unresolved_labels = []
+    for label in sorted(unknown_labels):
+        if label in classes_dict:
+            continue
+        if label in label_mapping:
+            target = label_mapping[label]
+            if target is None or target == REMOVE_LABEL_NAME:
+                index = -1
+            else:
+                if target not in classes:
+                    classes.append(target)
+                index = classes.index(target)
+                if target not in classes_dict:
+                    classes_dict[target] = index
+            print('Mapping label: ' + label + " : " + str(index))
+            classes_dict[label] = index
+        elif unknown_action == 'add':
+            classes.append(label)
+            classes_dict[label] = classes.index(label)
+            print('Adding label: ' + label + " : " + str(classes_dict[label]))
+        elif unknown_action == 'remove':
+            print('Removing label: ' + label)
+            classes_dict[label] = -1
+        elif unknown_action == 'ask':
+            [classes, classes_dict] = fix_brocken_labels([label], classes, classes_dict)
+        else:
+            unresolved_labels.append(label)
+    if len(unresolved_labels) > 0:
+        print('Unresolved labels, add them to LABEL_MAPPING in the project settings: ' + str(unresolved_labels))
+    return classes, classes_dict, unresolved_labels
+
+
+def parse_xml_label_boxes(file_path):
+    # Streams a Pascal VOC xml file and returns [image_width, image_height, labels, boxes]
+    # with each box as [xmin, ymin, xmax, ymax]
+    image_width = 0.0
+    image_height = 0.0
+    labels = []
+    boxes = []
+    label = None
+    box = [0.0, 0.0, 0.0, 0.0]
+    tags = []
+    for event, elem in ET.iterparse(file_path, events = ('start', 'end')):
+        if event == 'start':
+            tags.append(elem.tag)
+            continue
+        tags.pop()
+        parent = tags[-1] if len(tags) > 0 else None
+        tag = elem.tag
+        if parent == 'size':
+            if tag == 'width':
+                image_width = float(elem.text)
+            elif tag == 'height':
+                image_height = float(elem.text)
+        elif parent == 'object' and tag == 'name':
+            label = elem.text
+        elif parent == 'bndbox' and len(tags) > 1 and tags[-2] == 'object':
+            if tag in BOX_TAG_INDEXES:
+                box[BOX_TAG_INDEXES[tag]] = float(elem.text)
+        elif tag == 'object':
+            labels.append(label)
+            boxes.append(box)
+            label = None
+            box = [0.0, 0.0, 0.0, 0.0]
+            elem.clear()
+    return image_width, image_height, labels, boxes
+
+
+def get_xml_image_size(file_path, image_width, image_height):
+    # Returns [image_width, image_height], read from the xml file's image if the xml size is missing or zero.
+    # Returns zeros if no image is found, so the caller can skip the file.
+    if image_width > 0 and image_height > 0:
+        return image_width, image_height
+    f_base = os.path.splitext(file_path)[0]
+    for f_ext in IMAGE_FILE_TYPES:
+        image_file = f_base + '.' + f_ext
+        if os.path.exists(image_file):
+            try:
+                with Image.open(image_file) as img:
+                    [image_width, image_height] = img.size
+                print('Using image size ' + str([image_width, image_height]) + ' for xml label file without a size: ' + file_path)
+                return float(image_width), float(image_height)
+            except Exception as e:
+                print('Failed to read image size for xml label file: ' + file_path + ' ' + str(e))
+            break
+    print('Skipping xml label file without an image size: ' + file_path)
+    return 0.0, 0.0
+
+
+def normalize_label_boxes(boxes, image_sizes):
+    # Converts an (N,4) array of [xmin, ymin, xmax, ymax] boxes with (N,2) [width, height] image sizes
+    # to an (N,4) array of normalized [x, y, width, height] boxes clipped to the image.
+    # Rows without a positive image size are returned as nan, callers skip those files.
+    size_mask = np.all(image_sizes > 0, axis = 1)
+    sizes = np.where(image_sizes > 0, image_sizes, 1.0)
+    x_corners = np.clip(boxes[:,[0,2]], 0.0, sizes[:,0:1]) / sizes[:,0:1]
+    y_corners = np.clip(boxes[:,[1,3]], 0.0, sizes[:,1:2]) / sizes[:,1:2]
+    xywh = np.empty(boxes.shape, dtype = np.float64)
+    xywh[:,0] = 0.5 * (x_corners[:,0] + x_corners[:,1])
+    xywh[:,1] = 0.5 * (y_corners[:,0] + y_corners[:,1])
+    xywh[:,2] = x_corners[:,1] - x_corners[:,0]
+    xywh[:,3] = y_corners[:,1] - y_corners[:,0]
+    xywh[~size_mask] = np.nan
+    return xywh
+
+
 def read_xml_label_file(file_path,classes):
-    
+    labels = []
+    bboxes = []
     f_ext = os.path.splitext(file_path)[1]
     if f_ext == '.xml':    
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-        labels = []
-        bboxes = []
-        size = root.find("size")
-        image_width = 1.0 * int(size.find("width").text)
-        image_height = 1.0 * int(size.find("height").text)
-        for ind, o_entry in enumerate(root.findall("object")):
-            label = o_entry.find("name").text
-            labels.append(label)
-            if label not in classes:
-                class_ind = -1
-            else:
-                class_ind = classes.index(label)
-                
-            box = o_entry.find("bndbox")
-            xmax = int(box.find("xmax").text)
-            xmin = int(box.find("xmin").text)
-            ymax = int(box.find("ymax").text)
-            ymin = int(box.find("ymin").text)
-
-            absolute_x = xmin + 0.5 * (xmax - xmin)
-            absolute_y = ymin + 0.5 * (ymax - ymin)
-
-            absolute_width = xmax - xmin
-            absolute_height = ymax - ymin
-
-            x = absolute_x / image_width
-            y = absolute_y / image_height
-            width = absolute_width / image_width
-            height = absolute_height / image_height
-
-            bbox = [class_ind, x, y, width, height]
-            bboxes.append(bbox)
+        classes_lookup = create_classes_dict(classes)
+        [image_width, image_height, labels, boxes] = parse_xml_label_boxes(file_path)
+        if len(boxes) > 0:
+            [image_width, image_height] = get_xml_image_size(file_path, image_width, image_height)
+        if len(boxes) > 0 and image_width > 0 and image_height > 0:
+            image_sizes = np.tile([image_width, image_height], (len(boxes), 1))
+            xywh = normalize_label_boxes(np.array(boxes, dtype = np.float64), image_sizes)
+            for label, box in zip(labels, xywh.tolist()):
+                bboxes.append([classes_lookup.get(label, -1)] + box)
     return labels, bboxes
 
 
+def convert_xml_file_batch(file_paths, classes, classes_dict = None):
+    # Converts a batch of xml files to txt files in one vectorized pass.
+    # Labels that are not in classes are mapped through classes_dict, and the xml file is updated to match.
+    # Files with labels in neither are not written. Returns [labels, bboxes, converted, xml_updated] for each file.
+    classes_lookup = create_classes_dict(classes)
+    if classes_dict is None:
+        classes_dict = dict()
+    file_labels = []
+    file_boxes = []
+    image_sizes = []
+    counts = []
+    for file_path in file_paths:
+        try:
+            [image_width, image_height, labels, boxes] = parse_xml_label_boxes(file_path)
+        except Exception as e:
+            print('Failed to read xml label file: ' + file_path + ' ' + str(e))
+            [image_width, image_height, labels, boxes] = [0.0, 0.0, None, []]
+        if len(boxes) > 0:
+            [image_width, image_height] = get_xml_image_size(file_path, image_width, image_height)
+            if image_width <= 0 or image_height <= 0:
+                [labels, boxes] = [None, []]
+        file_labels.append(labels)
+        file_boxes.extend(boxes)
+        image_sizes.append([image_width, image_height])
+        counts.append(len(boxes))
+    results = []
+    if len(file_paths) == 0:
+        return results
+    all_boxes = np.array(file_boxes, dtype = np.float64).reshape(-1, 4)
+    all_sizes = np.repeat(np.array(image_sizes, dtype = np.float64), counts, axis = 0)
+    all_labels = [label for labels in file_labels if labels is not None for label in labels]
+    class_ids = np.array([classes_lookup[label] if label in classes_lookup else classes_dict.get(label, UNKNOWN_CLASS_ID)
+                          for label in all_labels], dtype = np.int64)
+    xywh = normalize_label_boxes(all_boxes, all_sizes)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    for ind, file_path in enumerate(file_paths):
+        labels = file_labels[ind]
+        if labels is None:
+            results.append([[], [], False, False])
+            continue
+        [start, end] = offsets[ind:ind+2]
+        file_class_ids = class_ids[start:end]
+        if np.any(file_class_ids == UNKNOWN_CLASS_ID):
+            bboxes = [[class_id] + box for class_id, box in zip(file_class_ids.tolist(), xywh[start:end].tolist())]
+            results.append([labels, bboxes, False, False])
+            continue
+        xml_updated = False
+        if any(label not in classes_lookup for label in labels):
+            xml_updated = update_xml_label_file(file_path,classes,classes_dict)
+        keep = file_class_ids != -1
+        txt_file = os.path.splitext(file_path)[0] + '.txt'
+        converted = save_txt_label_array(file_class_ids[keep], xywh[start:end][keep], txt_file)
+        results.append([[], [], converted, xml_updated])
+    return results
 
 
 def update_xml_label_file(file_path,classes,classes_dict):
@@ -406,6 +1049,7 @@ def update_xml_label_file(file_path,classes,classes_dict):
             print('Failed to copy labels to file: ' + orig_file)
         try:
             tree.write(file_path)
+            add_written_path(file_path)
             #print('Updated annotation labels in file: ' + file_path)
             success = True
         except Exception as e:
@@ -418,30 +1062,108 @@ def save_txt_label_file(bounding_boxes,file_path):
     lines = []
     for box in bounding_boxes:
         lines.append("%d %.6f %.6f %.6f %.6f" % (box[0],box[1],box[2],box[3],box[4]))
-    success = write_list_to_file(lines,file_path)
+    success = write_list_to_file(lines,file_path,sync = False)
+    return success
+
+def save_txt_label_array(class_ids, xywh, file_path):
+    # Writes all boxes for one label file with a single formatting pass
+    success = False
+    num_boxes = len(class_ids)
+    try:
+        values = np.column_stack([class_ids, xywh]).ravel().tolist()
+        text = ("%d %.6f %.6f %.6f %.6f\n" * num_boxes) % tuple(values)
+        write_file_atomic(file_path, lambda f: f.write(text), sync = False)
+        success = True
+    except Exception as e:
+        print("Failed to write label file " + file_path + " " + str(e))
     return success
 
-def convert_xml_files(folder_path, classes, classes_dict):
-    files = get_file_list(folder_path, ext_list = ['xml'])
-    for file in files:
-        [labels, bboxes] = read_xml_label_file(file,classes)
-        broken_labels = [i for i, box in enumerate(bboxes) if box[0] == -1]
-        if len(broken_labels) > 0:
-            [new_classes, new_classes_dict] = fix_brocken_labels(labels,classes,classes_dict)
-            classes = new_classes
-            classes_dict = new_classes_dict
-            new_bboxes = []
-            for i, label in enumerate(labels):
-                if label in classes_dict.keys():
-                    ind = classes_dict[label]
-                    if ind != -1:
-                        bbox = bboxes[i]
-                        bbox[0] = ind
-                        new_bboxes.append(bbox)
-            bboxes = new_bboxes
-            success = update_xml_label_file(file,classes,classes_dict)
-        txt_file = file.replace('.xml','.txt')
-        success = save_txt_label_file(bboxes,txt_file)
+def convert_xml_file(file_path, classes, classes_dict = None):
+    # Writes the txt label file for one xml file if all of its labels are known.
+    # Returns [labels, bboxes, converted, xml_updated]
+    return convert_xml_file_batch([file_path], classes, classes_dict)[0]
+
+def get_stale_xml_files(folder_path):
+    # Returns [stale_files, num_current], where stale xml files have no txt file or a txt file older than the xml file
+    stale_files = []
+    num_current = 0
+    mtimes = dict()
+    for [file_type, entry] in scan_folder(folder_path, file_types = ['xml','txt']):
+        try:
+            mtimes[entry.name] = entry.stat().st_mtime_ns
+        except OSError:
+            pass
+    for name in sorted(mtimes.keys()):
+        if name.endswith('.xml'):
+            txt_mtime = mtimes.get(name[:-4] + '.txt')
+            if txt_mtime is not None and txt_mtime >= mtimes[name]:
+                num_current += 1
+            else:
+                stale_files.append(os.path.join(folder_path,name))
+    return stale_files, num_current
+
+def run_convert_xml_batches(files, classes, classes_dict, num_workers):
+    if num_workers > 1 and len(files) >= MIN_POOL_FILES:
+        chunk_size = max(1, len(files) // (num_workers * 4))
+        batches = [files[ind:ind+chunk_size] for ind in range(0, len(files), chunk_size)]
+        results = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers = num_workers) as executor:
+            for batch_results in executor.map(convert_xml_file_batch, batches, [classes] * len(batches), [classes_dict] * len(batches)):
+                results.extend(batch_results)
+    else:
+        results = convert_xml_file_batch(files,classes,classes_dict)
+    return results
+
+def convert_xml_files(folder_path, classes, classes_dict, force = False, num_workers = None,
+                      label_mapping = None, unknown_action = 'ask'):
+    # Converts xml label files to txt label files, skipping xml files older than their txt file.
+    # Set force to True to convert all xml files, for example after the classes list changed.
+    # Unknown labels are collected from all files and resolved once with resolve_unknown_labels.
+    if force == True:
+        files = get_file_list(folder_path, ext_list = ['xml'])
+        num_skipped = 0
+    else:
+        [files, num_skipped] = get_stale_xml_files(folder_path)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    start_time = time.time()
+    results = run_convert_xml_batches(files, classes, classes_dict, num_workers)
+    num_converted = 0
+    unknown_files = []
+    unknown_labels = dict()
+    for file, [labels, bboxes, converted, xml_updated] in zip(files, results):
+        if xml_updated == True:
+            add_written_path(file)
+            add_written_path(file + '.org')
+        if converted == True:
+            add_written_path(os.path.splitext(file)[0] + '.txt')
+            num_converted += 1
+        elif len(labels) > 0:
+            unknown_files.append(file)
+            for label in labels:
+                if label not in classes_dict and label not in classes:
+                    unknown_labels[label] = unknown_labels.get(label, 0) + 1
+    if len(unknown_files) > 0:
+        print('Found unknown labels in ' + str(len(unknown_files)) + ' files: ' + str(unknown_labels))
+        [classes, classes_dict, unresolved_labels] = resolve_unknown_labels(unknown_labels, classes, classes_dict,
+                                                                            label_mapping, unknown_action)
+        results = run_convert_xml_batches(unknown_files, classes, classes_dict, num_workers)
+        num_unresolved = 0
+        for file, [labels, bboxes, converted, xml_updated] in zip(unknown_files, results):
+            if xml_updated == True:
+                add_written_path(file)
+                add_written_path(file + '.org')
+            if converted == True:
+                add_written_path(os.path.splitext(file)[0] + '.txt')
+                num_converted += 1
+            else:
+                num_unresolved += 1
+        if num_unresolved > 0:
+            print('Skipped ' + str(num_unresolved) + ' xml label files with unresolved labels in: ' + folder_path)
+    print('Converted ' + str(num_converted) + ' xml label files and skipped ' + str(num_skipped) + ' current files in: ' + folder_path)
+    count_metric('xml_files_converted', num_converted)
+    count_metric('xml_files_skipped', num_skipped)
+    count_metric('convert_seconds', time.time() - start_time)
     return classes,classes_dict
 
 
@@ -468,23 +1190,19 @@ def update_label_files(classes, classes_file, label_folder):
     classes_dict = dict()
     for i, label in enumerate(classes):
         classes_dict[label] = i
+    labels_changed = orig_classes != new_classes
     for folder in folders_to_process:       
         print('Preparing txt label files in: ' + str(folder))
-        labels_changed = orig_classes != new_classes
-        has_labels = False
-        for f in os.listdir(folder):
-            if f.endswith(".xml"):  
-                if has_labels == False:
-                    print('')
-                    print('**************************')
-                    print('Updating xml label files in folder : ' + str(folder))
-                has_labels = True
-            if has_labels == True:       
-                [convert_classes,classes_dict] = convert_xml_files(label_folder,new_classes,classes_dict)
-                if convert_classes != new_classes:
-                    print('Saving classes file to: ' + str(classes_file))
-                    write_list_to_file(convert_classes, classes_file)
-                    new_classes = convert_classes
+        has_labels = next(scan_folder(folder, file_types = ['xml']), None) is not None
+        if has_labels == True:       
+            print('')
+            print('**************************')
+            print('Updating xml label files in folder : ' + str(folder))
+            [convert_classes,classes_dict] = convert_xml_files(folder,new_classes,classes_dict,force = labels_changed)
+            if convert_classes != new_classes:
+                print('Saving classes file to: ' + str(classes_file))
+                write_list_to_file(convert_classes, classes_file)
+                new_classes = convert_classes
         folder_classes_file = os.path.join(folder,CLASSES_FILE_NAME)
         print('Saving classes file to: ' + str(folder_classes_file))
         write_list_to_file(new_classes, folder_classes_file)
@@ -492,14 +1210,17 @@ def update_label_files(classes, classes_file, label_folder):
 
 
 
-def fix_data_files(source_path):
+def fix_data_files(source_path, recursive = False, folders = None):
     imgs_list = []
     print('Looking for source folder: ' + source_path)
     if os.path.exists(source_path) == False:
         print('Source update folder not found: ' + source_path)
         return False
     success = False
-    folders_to_process=get_folder_list(source_path)
+    if folders is not None:
+        folders_to_process = folders
+    else:
+        folders_to_process=get_folder_list(source_path, recursive = recursive)
     print('Fixing files in source folders: ' + str(folders_to_process))
     fixed_files = []
     for source_folder in folders_to_process:
@@ -515,8 +1236,10 @@ def fix_data_files(source_path):
                 try:
                     # Rename the file
                     os.rename(old_file_name, new_file_name)
+                    add_written_path(new_file_name)
                     #print(f"File '{old_file_name}' renamed to '{new_file_name}' successfully.")
                     fixed_files.append(old_file_name)
+                    count_metric('files_renamed')
                 except FileNotFoundError:
                     print(f"Error: File '{old_file_name}' not found.")
                 except FileExistsError:
@@ -527,7 +1250,61 @@ def fix_data_files(source_path):
 
 
 
-def update_labling_data(source_path, output_path, use_percent_data = 100):
+def sample_valid_files(file_list, num_samples, check_function = None, seed = None):
+    # Draws up to num_samples distinct files without replacement using a lazy Fisher-Yates shuffle.
+    # Only drawn files are checked, so the expected cost tracks num_samples, not the list size.
+    rng = random.Random(seed)
+    num_files = len(file_list)
+    swapped = dict()
+    samples = []
+    ind = 0
+    while len(samples) < num_samples and ind < num_files:
+        draw_ind = rng.randrange(ind, num_files)
+        file_ind = swapped.get(draw_ind, draw_ind)
+        swapped[draw_ind] = swapped.get(ind, ind)
+        ind += 1
+        file = file_list[file_ind]
+        if check_function is not None and check_function(file) == False:
+            print('Skipping bad image file: ' + str(file))
+            continue
+        samples.append(file)
+    print('Finished data selection with ' + str(len(samples)) + ' files from ' + str(ind) + ' draws')
+    return samples
+
+
+def find_label_folder_sources(source_path, folder_name):
+    # Returns the relative paths of the folders under source_path that get_label_folder_name maps to folder_name.
+    # Each '_' in the name is tried as a '/' only where that folder exists, so only existing folders are checked.
+    rel_paths = []
+    parts = folder_name.split('_')
+    def search(folder, rel_path, part, ind):
+        if ind == len(parts):
+            if part != '' and os.path.isdir(os.path.join(folder, part)):
+                rel_paths.append(os.path.join(rel_path, part))
+            return
+        search(folder, rel_path, part + '_' + parts[ind], ind + 1)
+        if part != '' and os.path.isdir(os.path.join(folder, part)):
+            search(os.path.join(folder, part), os.path.join(rel_path, part), parts[ind], ind + 1)
+    search(source_path, '', parts[0], 1)
+    return rel_paths
+
+
+def get_label_folder_name(source_path, source_folder):
+    # Nested source folders map to a single labeling folder level, with '/' replaced by '_'.
+    # Raises ValueError if another source folder maps to the same name, such as 'a/b_c' and 'a_b/c'.
+    folder_name = os.path.relpath(source_folder, source_path).replace(os.sep, '_')
+    if '_' in folder_name:
+        rel_paths = find_label_folder_sources(source_path, folder_name)
+        if len(rel_paths) > 1:
+            raise ValueError('Source folders ' + str(sorted(rel_paths)) + ' map to the same label folder: ' + folder_name +
+                             ', rename one of them')
+    return folder_name
+
+
+def update_labling_data(source_path, output_path, use_percent_data = 100, catalog = None, seed = None, link_mode = 'copy',
+                        recursive = False, folders = None, journal = None):
+    # Set folders to a list of source folders to only update those folders.
+    # With a stage_journal, copies are checkpointed every CHECKPOINT_SECONDS and finished folders are skipped on a rerun.
     imgs_list = []
     print('Looking for source folder: ' + source_path)
     if os.path.exists(source_path) == False:
@@ -544,13 +1321,43 @@ def update_labling_data(source_path, output_path, use_percent_data = 100):
             return False
 
     success = False
-    folders_to_process=get_folder_list(source_path)
+    if catalog is not None:
+        folder_list_function = catalog.get_folder_list
+        folder_files_function = catalog.get_folder_files
+        check_image_function = catalog.check_image_file
+    else:
+        folder_list_function = get_folder_list
+        folder_files_function = get_folder_files
+        check_image_function = check_image_file
+    if folders is not None:
+        folders_to_process = [folder for folder in folders if os.path.isdir(folder)]
+    else:
+        folders_to_process = folder_list_function(source_path, recursive = recursive)
     print('Updating from source folders: ' + str(folders_to_process))
-    for source_folder in folders_to_process:
-        [img_files,xml_files,txt_files] = get_folder_files(source_folder)
-        #print('Found Source files: ' + str([img_files,xml_files,txt_files]))
-        source_name = os.path.basename(source_folder)
+    link_pairs = []
+    copy_pairs = []
+    pending_folders = []
+    try:
+        source_names = [get_label_folder_name(source_path,source_folder) for source_folder in folders_to_process]
+    except ValueError as e:
+        print('Failed to update labeling data: ' + str(e))
+        return False
+    last_checkpoint = time.time()
+    for source_folder, source_name in zip(folders_to_process, source_names):
         output_folder = os.path.join(output_path,source_name)
+        if journal is not None and journal.is_done('link_data', source_folder):
+            if os.path.exists(output_folder) == False:
+                continue
+            for img_file in folder_files_function(output_folder)[0]:
+                imgs_list.append(os.path.join(source_folder,img_file))
+            continue
+        if journal is not None and time.time() - last_checkpoint >= CHECKPOINT_SECONDS:
+            checkpoint_labling_data(link_pairs, copy_pairs, link_mode, catalog, journal, pending_folders)
+            [link_pairs, copy_pairs, pending_folders] = [[], [], []]
+            last_checkpoint = time.time()
+        pending_folders.append(source_folder)
+        [img_files,xml_files,txt_files] = folder_files_function(source_folder)
+        #print('Found Source files: ' + str([img_files,xml_files,txt_files]))
         [limg_files,lxml_files,ltxt_files] = [[],[],[]]
         if os.path.exists(output_folder) == False:
             try:
@@ -561,7 +1368,7 @@ def update_labling_data(source_path, output_path, use_percent_data = 100):
                 return False
         else:
             print('Gathering data info for label folder: ' + output_folder)
-            [limg_files,lxml_files,ltxt_files] = get_folder_files(output_folder)
+            [limg_files,lxml_files,ltxt_files] = folder_files_function(output_folder)
             #print('Found Dest files: ' + str([limg_files,lxml_files,ltxt_files]))
 
         # add random data form source as needed
@@ -573,62 +1380,63 @@ def update_labling_data(source_path, output_path, use_percent_data = 100):
         print('Updating folder: ' + source_folder + ' with stats ' + str([num_images,label_size,label_percent]))
         #print('Starting folder: ' + output_folder + ' with files ' + str([limg_files,lxml_files,ltxt_files]))
         copy_files = []
-        attempts = 0
-        while label_percent < use_percent_data and attempts < (10  * num_images):
-
-            if use_percent_data < 100:
-                random_img = random.choice(img_files)
-            elif num_images >= attempts:
-                random_img = img_files[attempts]
-            random_img_path = os.path.join(source_folder,random_img)
-            attempts += 1
-            #print('Checking image file: ' + str(random_img_path))
-            if random_img not in limg_files:
-                valid = check_image_file(random_img_path)
-                if valid == False:
-                    print('Skipping bad image file: ' + str(random_img_path))
-                else:
-                    #print('Adding image file: ' + str(random_img_path))
-                    limg_files.append(random_img)
-                    copy_files.append(random_img)
-                    f_ext = os.path.splitext(random_img)[1]
-                    xml_file = random_img.replace(f_ext,'.xml')
-                    xml_file_path = os.path.join(source_folder,xml_file)
-                    xml_exists = os.path.exists(xml_file_path)
-                    
-                    if xml_file not in lxml_files and xml_exists:
-                        #print('Adding xml file: ' + str(xml_file))
-                        copy_files.append(xml_file)
-                    txt_file = random_img.replace(f_ext,'.txt')
-                    txt_file_path = os.path.join(source_folder,txt_file)
-                    txt_exists = os.path.exists(txt_file_path)
-                    if txt_file not in ltxt_files and txt_exists:
-                        #print('Adding txt file: ' + str(txt_file))
-                        copy_files.append(txt_file)
-        
-            label_size = len(limg_files)
-            label_percent = (label_size / num_images) * float(100)
-            #print('Looping folder: ' + source_folder + ' with stats ' + str([label_size,label_percent]))
-        print('Finished label data selection with attempts: ' + str(attempts))
+        link_files = []
+        limg_set = set(limg_files)
+        lxml_set = set(lxml_files)
+        ltxt_set = set(ltxt_files)
+        xml_set = set(xml_files)
+        txt_set = set(txt_files)
+        num_select = int(math.ceil(num_images * use_percent_data / float(100))) - label_size
+        if num_select > 0:
+            candidate_paths = [os.path.join(source_folder,img_file) for img_file in img_files if img_file not in limg_set]
+            if num_select >= len(candidate_paths) and catalog is None:
+                check_image_files(candidate_paths)
+            selected_paths = sample_valid_files(candidate_paths, num_select, check_function = check_image_function, seed = seed)
+            for random_img_path in selected_paths:
+                random_img = os.path.basename(random_img_path)
+                #print('Adding image file: ' + str(random_img_path))
+                limg_files.append(random_img)
+                link_files.append(random_img)
+                f_base = os.path.splitext(random_img)[0]
+                xml_file = f_base + '.xml'
+                if xml_file in xml_set and xml_file not in lxml_set:
+                    #print('Adding xml file: ' + str(xml_file))
+                    copy_files.append(xml_file)
+                txt_file = f_base + '.txt'
+                if txt_file in txt_set and txt_file not in ltxt_set:
+                    #print('Adding txt file: ' + str(txt_file))
+                    copy_files.append(txt_file)
         for img_file in limg_files:
             imgs_list.append(os.path.join(source_folder,img_file))
         
-        print('Copying files from folder: ' + source_folder)
-        print('Copying files to folder: ' + output_folder)
         #print('Copying files: ' + str(copy_files))
-
-        
+        for file in link_files:
+            link_pairs.append([os.path.join(source_folder,file), os.path.join(output_folder,file)])
         for file in copy_files:
-            file_path = os.path.join(source_folder,file)
-            dest_path = os.path.join(output_folder,file)
-            #print('Copying file: ' + str(file_path) + " to " +  str(dest_path))
-            success = copy_file(file_path, dest_path)       
+            copy_pairs.append([os.path.join(source_folder,file), os.path.join(output_folder,file)])
 
+    print('Copying files to label folder: ' + output_path)
+    checkpoint_labling_data(link_pairs, copy_pairs, link_mode, catalog, journal, pending_folders)
     return imgs_list     
 
 
-def create_random_data_set(source_image_list,random_folder_path,random_data_size):
+def checkpoint_labling_data(link_pairs, copy_pairs, link_mode, catalog, journal, folders):
+    copy_stats = copy_files_bulk(link_pairs, link_mode)
+    # Label files are edited in place, so are always copied to protect the originals
+    copy_stats = copy_files_bulk(copy_pairs)
+    if journal is not None:
+        # Image checks are saved before the folders are recorded, so a rerun never checks them again
+        if catalog is not None:
+            catalog.commit()
+        if IMAGE_CHECK_CACHE_FILE is not None:
+            save_image_check_cache(IMAGE_CHECK_CACHE_FILE)
+        journal.mark_done('link_data', folders)
+    return copy_stats
+
 
+def create_random_data_set(source_image_list,random_folder_path,random_data_size,seed = None,link_mode = 'copy',journal = None):
+    # With a stage_journal, the new folder is recorded before it is filled, so a folder left unfinished
+    # by a crash is removed and made again on a rerun instead of being kept as a partial random set.
     num_images = len(source_image_list)
     print("Starting random data selection with num_images: " + str(num_images))
 
@@ -637,60 +1445,787 @@ def create_random_data_set(source_image_list,random_folder_path,random_data_size
     if random_data_size == 0:
         return []
 
+    if journal is not None:
+        for started_folder in sorted(journal.get_keys('random_set_folder')):
+            if started_folder.startswith(random_folder_path + '_') and os.path.exists(started_folder):
+                print('Removing unfinished random data folder: ' + started_folder)
+                shutil.rmtree(started_folder)
     ind = 0
     exists = True
     while exists == True:
         ind += 1
         random_folder = random_folder_path + '_' + str(ind)
         exists = os.path.exists(random_folder)
+    if journal is not None:
+        journal.mark_done('random_set_folder', random_folder)
     try:
         make_folder(random_folder)
         fix_folder_permissions
     except Exception as e:
         print('Failed to create random data folder: ' + random_folder + ' ' + str(e))
         return []  
-    img_files = []
-    copy_files = []
-    attempts = 0
-    count = 0
-    while count < random_data_size and attempts < (10  * num_images) :
-        attempts += 1
-        random_img = random.choice(source_image_list)
-        #print('Checking image file: ' + str(random_img))
-
-        valid = check_image_file(random_img)
-        if valid == False:
-            print('Skipping bad image file: ' + str(random_img))
-        elif random_img not in copy_files:
-            #print('Adding image file: ' + str(random_img))
-            img_files.append(random_img)
-            copy_files.append(random_img)
-            count += 1
-            f_ext = os.path.splitext(random_img)[1]
-            xml_file = random_img.replace(f_ext,'.xml')
-            xml_exists = os.path.exists(xml_file)
-            if xml_exists:
-                #print('Adding xml file: ' + str(xml_file))
-                copy_files.append(xml_file)
-            txt_file = random_img.replace(f_ext,'.txt')
-            txt_exists = os.path.exists(txt_file)
-            if txt_exists:
-                #print('Adding txt file: ' + str(txt_file))
-                copy_files.append(txt_file)
-    print('Finished random data selection with attempts: ' + str(attempts))
-    for file in copy_files:
+    link_pairs = []
+    copy_pairs = []
+    img_files = sample_valid_files(source_image_list, random_data_size, check_function = check_image_file, seed = seed)
+    for random_img in img_files:
+        #print('Adding image file: ' + str(random_img))
+        link_pairs.append([random_img, os.path.join(random_folder,os.path.basename(random_img))])
+        # Label files that do not exist are skipped by the bulk copy
+        f_base = os.path.splitext(random_img)[0]
+        for label_file in [f_base + '.xml', f_base + '.txt']:
+            copy_pairs.append([label_file, os.path.join(random_folder,os.path.basename(label_file))])
+    copy_stats = copy_files_bulk(link_pairs, link_mode)
+    copy_stats = copy_files_bulk(copy_pairs)
+    return img_files
+
+
+
+def get_data_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def get_file_data_hash(file_path):
+    # Returns get_data_hash of a file's contents, or None if it can not be read
+    file_hash = None
+    try:
+        with open(file_path, 'rb') as f:
+            file_hash = get_data_hash(f.read())
+    except OSError:
+        pass
+    return file_hash
+
+
+def letterbox_label_boxes(class_ids, xywh, scaled_size, pad, image_size):
+    # Rescales normalized [x, y, width, height] boxes from the original image to the letterboxed image
+    new_xywh = np.array(xywh, dtype = np.float64).reshape(-1, 4)
+    new_xywh[:,0] = (new_xywh[:,0] * scaled_size[0] + pad[0]) / image_size
+    new_xywh[:,1] = (new_xywh[:,1] * scaled_size[1] + pad[1]) / image_size
+    new_xywh[:,2] = new_xywh[:,2] * scaled_size[0] / image_size
+    new_xywh[:,3] = new_xywh[:,3] * scaled_size[1] / image_size
+    return class_ids, new_xywh
+
+
+def read_txt_label_array(file_path):
+    # Returns [class_ids, xywh] arrays from a yolo txt label file
+    values = []
+    with open(file_path) as f:
+        for line in f:
+            entry = line.split()
+            if len(entry) == 5:
+                values.append([float(value) for value in entry])
+    values = np.array(values, dtype = np.float64).reshape(-1, 5)
+    return values[:,0].astype(np.int64), values[:,1:]
+
+
+def build_cache_image(src_img, src_txt, dst_img, dst_txt, image_size):
+    # Writes a letterboxed image_size x image_size copy of an image with matching txt labels.
+    # Both files are replaced atomically, so an interrupted build never leaves a truncated cache image.
+    # Returns [image_hash, success]
+    image_hash = None
+    success = False
+    try:
+        with open(src_img, 'rb') as f:
+            image_hash = get_data_hash(f.read())
+        with Image.open(src_img) as img:
+            img = img.convert('RGB')
+            [width, height] = img.size
+            scale = min(image_size / float(width), image_size / float(height))
+            scaled_size = [max(1, int(round(width * scale))), max(1, int(round(height * scale)))]
+            pad = [(image_size - scaled_size[0]) // 2, (image_size - scaled_size[1]) // 2]
+            cache_img = Image.new('RGB', (image_size, image_size), IMAGE_CACHE_PAD_COLOR)
+            cache_img.paste(img.resize(scaled_size, Image.BILINEAR), tuple(pad))
+        os.makedirs(os.path.dirname(dst_img), exist_ok = True)
+        img_format = Image.registered_extensions().get(os.path.splitext(dst_img)[1].lower())
+        write_file_atomic(dst_img, lambda f: cache_img.save(f, format = img_format, quality = IMAGE_CACHE_JPEG_QUALITY),
+                          mode = 'wb', sync = False)
+        [class_ids, xywh] = read_txt_label_array(src_txt)
+        [class_ids, xywh] = letterbox_label_boxes(class_ids, xywh, scaled_size, pad, image_size)
+        success = save_txt_label_array(class_ids, xywh, dst_txt)
+    except Exception as e:
+        print('Failed to build cache image for: ' + src_img + ' ' + str(e))
+    return image_hash, success
+
+
+def read_image_cache_manifest(file_path):
+    # Returns dict of rel_path to [img_size, img_mtime_ns, img_hash, label_hash]
+    manifest = dict()
+    if os.path.exists(file_path):
+        for line in read_list_from_file(file_path):
+            entry = line.split('\t')
+            if len(entry) == 5:
+                manifest[entry[0]] = [int(entry[1]), int(entry[2]), entry[3], entry[4]]
+    return manifest
+
+
+def write_image_cache_manifest(manifest, manifest_file):
+    lines = [rel_path + '\t' + '\t'.join(str(value) for value in entry) for rel_path, entry in manifest.items()]
+    return write_list_to_file(lines, manifest_file)
+
+
+def build_image_cache(source_folder, cache_folder, rel_paths, image_size, num_workers = None):
+    # Builds letterboxed copies of the images at rel_paths under source_folder, with rescaled txt labels,
+    # in cache_folder. Entries are rebuilt only when the source image or label hash changed. Images with a new
+    # size or mtime are hashed and compared to the manifest, so copied or touched images are not rebuilt.
+    # Returns the set of rel_paths available in the cache.
+    if os.path.exists(cache_folder) == False:
+        os.makedirs(cache_folder)
+        add_written_path(cache_folder)
+    manifest_file = os.path.join(cache_folder, IMAGE_CACHE_MANIFEST_FILE_NAME)
+    manifest = read_image_cache_manifest(manifest_file)
+    new_manifest = dict()
+    build_list = []
+    for rel_path in rel_paths:
+        src_img = os.path.join(source_folder, rel_path)
+        src_txt = os.path.splitext(src_img)[0] + '.txt'
+        try:
+            img_stat = os.stat(src_img)
+            with open(src_txt, 'rb') as f:
+                label_hash = get_data_hash(f.read())
+        except OSError:
+            continue
+        entry = manifest.get(rel_path)
+        if entry is not None and entry[3] == label_hash and entry[0] == img_stat.st_size and entry[1] == img_stat.st_mtime_ns:
+            new_manifest[rel_path] = entry
+        elif entry is not None and entry[3] == label_hash and entry[0] == img_stat.st_size and \
+             os.path.exists(os.path.join(cache_folder, rel_path)) and get_file_data_hash(src_img) == entry[2]:
+            new_manifest[rel_path] = [img_stat.st_size, img_stat.st_mtime_ns, entry[2], label_hash]
+        else:
+            build_list.append([rel_path, img_stat.st_size, img_stat.st_mtime_ns, label_hash])
+    # Remove cache images that are no longer used before the manifest is checkpointed without them
+    build_set = set(entry[0] for entry in build_list)
+    for rel_path in manifest.keys():
+        if rel_path not in new_manifest and rel_path not in build_set:
+            dst_img = os.path.join(cache_folder, rel_path)
+            for cache_file in [dst_img, os.path.splitext(dst_img)[0] + '.txt']:
+                if os.path.exists(cache_file):
+                    os.remove(cache_file)
+    if len(build_list) > 0:
+        print('Building ' + str(len(build_list)) + ' cache images at size ' + str(image_size) + ' in: ' + cache_folder)
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        pool_workers = num_workers if num_workers > 1 and len(build_list) >= MIN_POOL_FILES else 1
+        # Builds in batches and saves the manifest every CHECKPOINT_SECONDS, so an interrupted run keeps its work
+        batch_size = max(MIN_POOL_FILES, pool_workers * 64)
+        last_checkpoint = time.time()
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers = pool_workers) if pool_workers > 1 else None
+        try:
+            for ind in range(0, len(build_list), batch_size):
+                batch = build_list[ind:ind + batch_size]
+                src_imgs = [os.path.join(source_folder, entry[0]) for entry in batch]
+                src_txts = [os.path.splitext(src_img)[0] + '.txt' for src_img in src_imgs]
+                dst_imgs = [os.path.join(cache_folder, entry[0]) for entry in batch]
+                dst_txts = [os.path.splitext(dst_img)[0] + '.txt' for dst_img in dst_imgs]
+                sizes = [image_size] * len(batch)
+                if executor is not None:
+                    chunk_size = max(1, len(batch) // (pool_workers * 4))
+                    results = list(executor.map(build_cache_image, src_imgs, src_txts, dst_imgs, dst_txts, sizes, chunksize = chunk_size))
+                else:
+                    results = list(map(build_cache_image, src_imgs, src_txts, dst_imgs, dst_txts, sizes))
+                for entry, dst_img, dst_txt, [image_hash, success] in zip(batch, dst_imgs, dst_txts, results):
+                    if success == True:
+                        new_manifest[entry[0]] = [entry[1], entry[2], image_hash, entry[3]]
+                        add_written_path(dst_img)
+                        add_written_path(dst_txt)
+                if time.time() - last_checkpoint >= CHECKPOINT_SECONDS:
+                    write_image_cache_manifest(new_manifest, manifest_file)
+                    last_checkpoint = time.time()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    write_image_cache_manifest(new_manifest, manifest_file)
+    print('Image cache has ' + str(len(new_manifest)) + ' images, rebuilt ' + str(len(build_list)))
+    count_metric('images_cached', len(build_list))
+    return set(new_manifest.keys())
+
+
+
+def get_packed_file_names(split):
+    # Returns [index_file_name, shard_file_prefix] for a packed data split
+    return [split + '_index.npz', split + '_shard_']
+
+
+def get_pack_fingerprint(image_files):
+    # Hash of the image list and the size and mtime of every image and label file
+    file_hash = hashlib.sha1()
+    for image_file in image_files:
+        txt_file = os.path.splitext(image_file)[0] + '.txt'
+        for file_path in [image_file, txt_file]:
+            try:
+                file_stat = os.stat(file_path)
+                file_hash.update((file_path + '\t' + str(file_stat.st_size) + '\t' + str(file_stat.st_mtime_ns) + '\n').encode())
+            except OSError:
+                file_hash.update((file_path + '\tmissing\n').encode())
+    return file_hash.hexdigest()
+
+
+def pack_data_split(image_files, pack_folder, split, data_format = 'encoded', shard_size_mb = PACKED_SHARD_SIZE_MB):
+    # Packs the images and txt labels of one split into large shard files with an offset index.
+    # 'encoded' stores the image file bytes, 'raw' stores decoded RGB uint8 pixels.
+    # Returns True if the packed split is current.
+    if data_format not in PACKED_DATA_FORMATS:
+        print('Unknown packed data format ' + str(data_format) + ' not in ' + str(PACKED_DATA_FORMATS))
+        return False
+    if os.path.exists(pack_folder) == False:
+        os.makedirs(pack_folder)
+        add_written_path(pack_folder)
+    [index_name, shard_prefix] = get_packed_file_names(split)
+    index_file = os.path.join(pack_folder, index_name)
+    fingerprint = get_pack_fingerprint(image_files) + ':' + data_format
+    if os.path.exists(index_file):
+        try:
+            with np.load(index_file) as index:
+                if str(index['fingerprint']) == fingerprint:
+                    print('Packed ' + split + ' data is current with ' + str(len(index['offsets'])) + ' images')
+                    return True
+        except Exception as e:
+            print('Failed to read packed index: ' + index_file + ' ' + str(e))
+    print('Packing ' + str(len(image_files)) + ' ' + split + ' images into: ' + pack_folder)
+    start_time = time.time()
+    shard_size = int(shard_size_mb * 1024 * 1024)
+    im_files = []
+    shard_ids = []
+    offsets = []
+    lengths = []
+    shapes = []
+    label_arrays = []
+    shard_paths = []
+    shard_file = None
+    shard_offset = 0
+    for image_file in image_files:
+        txt_file = os.path.splitext(image_file)[0] + '.txt'
         try:
-            
-            #print("File: " + image_file_path + " Copied to: " + random_folder)
+            with open(image_file, 'rb') as f:
+                data = f.read()
+            with Image.open(io.BytesIO(data)) as img:
+                [width, height] = img.size
+                if data_format == 'raw':
+                    data = np.asarray(img.convert('RGB'), dtype = np.uint8).tobytes()
+            [class_ids, xywh] = read_txt_label_array(txt_file)
+        except Exception as e:
+            print('Skipping file that failed to pack: ' + image_file + ' ' + str(e))
+            continue
+        if shard_file is None or (shard_offset > 0 and shard_offset + len(data) > shard_size):
+            if shard_file is not None:
+                shard_file.close()
+            shard_paths.append(os.path.join(pack_folder, shard_prefix + str(len(shard_paths)) + '.bin'))
+            shard_file = open(shard_paths[-1] + '.tmp', 'wb')
+            shard_offset = 0
+        shard_file.write(data)
+        im_files.append(image_file)
+        shard_ids.append(len(shard_paths) - 1)
+        offsets.append(shard_offset)
+        lengths.append(len(data))
+        shapes.append([height, width])
+        label_arrays.append(np.column_stack([class_ids, xywh]).astype(np.float32))
+        shard_offset += len(data)
+    if shard_file is not None:
+        shard_file.close()
+    label_counts = [len(labels) for labels in label_arrays]
+    label_offsets = np.concatenate([[0], np.cumsum(label_counts, dtype = np.int64)]).astype(np.int64)
+    if len(label_arrays) > 0:
+        labels = np.concatenate(label_arrays)
+    else:
+        labels = np.zeros((0, 5), dtype = np.float32)
+    # Swap in the new shards, then remove shards left over from a larger previous pack
+    for shard_path in shard_paths:
+        os.replace(shard_path + '.tmp', shard_path)
+        add_written_path(shard_path)
+    for [file_type, entry] in scan_folder(pack_folder, ext_list = ['bin']):
+        if entry.name.startswith(shard_prefix) and entry.path not in shard_paths:
+            os.remove(entry.path)
+    write_file_atomic(index_file, lambda f: np.savez(f, im_files = np.array(im_files, dtype = np.str_),
+                      shard_ids = np.array(shard_ids, dtype = np.int32), offsets = np.array(offsets, dtype = np.int64),
+                      lengths = np.array(lengths, dtype = np.int64), shapes = np.array(shapes, dtype = np.int32).reshape(-1, 2),
+                      label_offsets = label_offsets, labels = labels, data_format = np.array(data_format),
+                      fingerprint = np.array(fingerprint)), mode = 'wb')
+    num_bytes = sum(lengths)
+    seconds = max(time.time() - start_time, 1e-6)
+    count_metric('images_packed', len(im_files))
+    count_metric('bytes_packed', num_bytes)
+    print('Packed ' + str(len(im_files)) + ' images (' + str(round(num_bytes / 1e6, 1)) + ' MB) into ' + str(len(shard_paths)) +
+          ' shards in ' + str(round(seconds, 1)) + ' secs')
+    return True
+
+
+class packed_data_set(object):
+    # Read access to a packed data split through memory mapped shard files
+
+    def __init__(self, pack_folder, split):
+        self.pack_folder = pack_folder
+        self.split = split
+        [index_name, self.shard_prefix] = get_packed_file_names(split)
+        with np.load(os.path.join(pack_folder, index_name)) as index:
+            self.im_files = index['im_files'].tolist()
+            self.shard_ids = index['shard_ids']
+            self.offsets = index['offsets']
+            self.lengths = index['lengths']
+            self.shapes = index['shapes']
+            self.label_offsets = index['label_offsets']
+            self.labels = index['labels']
+            self.data_format = str(index['data_format'])
+        self.shards = dict()
+
+    def __len__(self):
+        return len(self.im_files)
+
+    def __getstate__(self):
+        # Memory maps are reopened in each data loader worker
+        state = self.__dict__.copy()
+        state['shards'] = dict()
+        return state
+
+    def get_shard(self, shard_id):
+        shard = self.shards.get(shard_id)
+        if shard is None:
+            shard_path = os.path.join(self.pack_folder, self.shard_prefix + str(shard_id) + '.bin')
+            shard = np.memmap(shard_path, dtype = np.uint8, mode = 'r')
+            self.shards[shard_id] = shard
+        return shard
+
+    def get_image_bytes(self, i):
+        shard = self.get_shard(int(self.shard_ids[i]))
+        offset = int(self.offsets[i])
+        return shard[offset:offset + int(self.lengths[i])]
+
+    def get_image(self, i):
+        # Returns the image as an RGB uint8 array
+        data = self.get_image_bytes(i)
+        if self.data_format == 'raw':
+            [height, width] = self.shapes[i]
+            return data.reshape(height, width, 3)
+        with Image.open(io.BytesIO(data)) as img:
+            return np.asarray(img.convert('RGB'))
+
+    def get_labels(self, i):
+        # Returns the image's labels as a [class_id, x, y, width, height] float32 array
+        return self.labels[self.label_offsets[i]:self.label_offsets[i + 1]]
+
+
+
+def get_image_phash(file_path):
+    # Returns the difference hash of an image as a hex string, or None if the image can not be read
+    phash = None
+    try:
+        with Image.open(file_path) as img:
+            img.draft('L', (PHASH_SIZE * 8, PHASH_SIZE * 8))
+            pixels = np.asarray(img.convert('L').resize((PHASH_SIZE + 1, PHASH_SIZE), Image.BILINEAR), dtype = np.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+        phash = '%0*x' % (PHASH_SIZE * PHASH_SIZE // 4, int(''.join('1' if bit else '0' for bit in bits), 2))
+    except Exception as e:
+        print('Failed to hash image file: ' + file_path + ' ' + str(e))
+    return phash
+
+
+def get_image_phashes(file_paths, num_workers = None):
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if num_workers > 1 and len(file_paths) >= MIN_POOL_FILES:
+        print('Hashing ' + str(len(file_paths)) + ' image files with ' + str(num_workers) + ' workers')
+        chunk_size = max(1, len(file_paths) // (num_workers * 4))
+        with concurrent.futures.ProcessPoolExecutor(max_workers = num_workers) as executor:
+            return list(executor.map(get_image_phash, file_paths, chunksize = chunk_size))
+    return [get_image_phash(file_path) for file_path in file_paths]
+
+
+def get_hamming_distances(values_a, values_b):
+    # Bit counts of the xor of two uint64 arrays
+    xor_bytes = np.ascontiguousarray(np.bitwise_xor(values_a, values_b)).view(np.uint8).reshape(-1, 8)
+    return np.array(BIT_COUNTS, dtype = np.int64)[xor_bytes].sum(axis = 1)
+
+
+def find_duplicate_clusters(phashes, max_distance, max_group_size = DEDUP_MAX_GROUP_SIZE):
+    # Groups hashes that are chained within max_distance of each other using multi-index hashing.
+    # The 64 bit hashes are split into PHASH_CHUNKS chunks. Two hashes within max_distance must have a chunk
+    # within max_distance // PHASH_CHUNKS bits of each other, so only pairs found by looking up each chunk's
+    # neighbors in a sorted array are compared.
+    # Groups are not joined past max_group_size hashes, which breaks long chains of hashes that each differ a little.
+    # Returns a cluster id for each hash, the index of the cluster's first member. None hashes are never grouped.
+    parents = list(range(len(phashes)))
+    group_sizes = [1] * len(phashes)
+    def get_root(ind):
+        while parents[ind] != ind:
+            parents[ind] = parents[parents[ind]]
+            ind = parents[ind]
+        return ind
+    hash_inds = np.array([ind for ind, phash in enumerate(phashes) if phash is not None], dtype = np.int64)
+    values = np.array([int(phashes[ind], 16) for ind in hash_inds.tolist()], dtype = np.uint64)
+    chunk_bits = 64 // PHASH_CHUNKS
+    chunk_radius = max_distance // PHASH_CHUNKS
+    flips = [0]
+    for num_bits in range(1, chunk_radius + 1):
+        for bits in itertools.combinations(range(chunk_bits), num_bits):
+            flips.append(sum(1 << bit for bit in bits))
+    for chunk in range(PHASH_CHUNKS):
+        chunk_values = (values >> np.uint64(chunk * chunk_bits)) & np.uint64((1 << chunk_bits) - 1)
+        order = np.argsort(chunk_values, kind = 'stable')
+        sorted_values = chunk_values[order]
+        for flip in flips:
+            keys = chunk_values ^ np.uint64(flip)
+            lefts = np.searchsorted(sorted_values, keys, side = 'left')
+            counts = np.searchsorted(sorted_values, keys, side = 'right') - lefts
+            pairs_a = np.repeat(np.arange(len(values)), counts)
+            offsets = np.arange(len(pairs_a)) - np.repeat(np.cumsum(counts) - counts, counts)
+            pairs_b = order[np.repeat(lefts, counts) + offsets]
+            mask = pairs_a < pairs_b
+            pairs_a = pairs_a[mask]
+            pairs_b = pairs_b[mask]
+            mask = get_hamming_distances(values[pairs_a], values[pairs_b]) <= max_distance
+            for ind_a, ind_b in zip(hash_inds[pairs_a[mask]].tolist(), hash_inds[pairs_b[mask]].tolist()):
+                [root_a, root_b] = [get_root(ind_a), get_root(ind_b)]
+                if root_a != root_b and group_sizes[root_a] + group_sizes[root_b] <= max_group_size:
+                    parents[max(root_a, root_b)] = min(root_a, root_b)
+                    group_sizes[min(root_a, root_b)] += group_sizes[max(root_a, root_b)]
+    return [get_root(ind) for ind in range(len(phashes))]
+
+
+
+def get_system_resources(folder_path = None):
+    # Returns the cpus this process can use, total and available memory in MB (capped by any cgroup memory limit),
+    # and the free disk space in MB of the drive with folder_path
+    try:
+        cpu_count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpu_count = os.cpu_count() or 1
+    mem_dict = dict()
+    try:
+        with open('/proc/meminfo','r') as f:
+            for line in f:
+                [name, value] = line.split(':',1)
+                mem_dict[name] = int(value.split()[0]) / 1024.0
+    except (OSError, ValueError):
+        pass
+    ram_total_mb = mem_dict.get('MemTotal', os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1048576.0)
+    ram_available_mb = mem_dict.get('MemAvailable', ram_total_mb)
+    try:
+        with open('/sys/fs/cgroup/memory.max','r') as f:
+            limit_mb = int(f.read().strip()) / 1048576.0
+        with open('/sys/fs/cgroup/memory.current','r') as f:
+            used_mb = int(f.read().strip()) / 1048576.0
+        ram_total_mb = min(ram_total_mb, limit_mb)
+        ram_available_mb = min(ram_available_mb, limit_mb - used_mb)
+    except (OSError, ValueError):
+        pass # no cgroup v2 memory limit
+    resources = {
+        'cpu_count': cpu_count,
+        'ram_total_mb': int(ram_total_mb),
+        'ram_available_mb': int(ram_available_mb),
+        'disk_free_mb': None
+    }
+    if folder_path is not None and os.path.exists(folder_path):
+        resources['disk_free_mb'] = int(shutil.disk_usage(folder_path).free / 1048576.0)
+    return resources
+
+
+def get_peak_memory_mb():
+    # Returns the largest resident memory size this process has used so far
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+
+class run_metrics(object):
+    # Times the stages of a script run and counts the files, bytes and boxes processed in each one.
+    # finish() appends one JSON line per stage and one for the whole run to log_file, and if prom_folder
+    # is set, writes the same values to a Prometheus textfile for the node exporter textfile collector.
+
+    def __init__(self, script_name, log_file = None, prom_folder = None):
+        self.script_name = script_name
+        self.log_file = log_file
+        self.prom_folder = prom_folder
+        self.start_time = time.time()
+        self.run_id = time.strftime('%Y%m%d_%H%M%S', time.localtime(self.start_time)) + '_' + str(os.getpid())
+        self.stages = []
+        self.stage = None
+        self.counts = dict()
+        self.lock = threading.Lock()
+
+    def start_stage(self, name):
+        # Ends the current stage, if any, and starts timing the next one
+        self.end_stage()
+        self.stage = {'stage': name, 'start': time.time(), 'seconds': 0.0, 'counts': dict()}
+
+    def end_stage(self):
+        if self.stage is not None:
+            self.stage['seconds'] = time.time() - self.stage['start']
+            self.stages.append(self.stage)
+            self.stage = None
+
+    def count(self, name, value = 1):
+        with self.lock:
+            counts = self.stage['counts'] if self.stage is not None else self.counts
+            counts[name] = counts.get(name, 0) + value
+
+    def get_stage_dicts(self):
+        # Returns one dict per stage name, adding up stages that ran more than once, with rates for each counter
+        stage_dicts = dict()
+        for stage in self.stages:
+            stage_dict = stage_dicts.setdefault(stage['stage'], {'stage': stage['stage'], 'seconds': 0.0})
+            stage_dict['seconds'] += stage['seconds']
+            for name, value in stage['counts'].items():
+                stage_dict[name] = stage_dict.get(name, 0) + value
+        for stage_dict in stage_dicts.values():
+            seconds = max(stage_dict['seconds'], 1e-6)
+            for name in list(stage_dict.keys()):
+                if name not in ['stage', 'seconds'] and name.endswith('_seconds') == False:
+                    stage_dict[name + '_per_sec'] = round(stage_dict[name] / seconds, 2)
+            for name, value in stage_dict.items():
+                if isinstance(value, float):
+                    stage_dict[name] = round(value, 3)
+        return list(stage_dicts.values())
+
+    def finish(self, success = True):
+        # Ends the run and writes the run log and Prometheus textfile. Returns the stage dicts.
+        self.end_stage()
+        run_seconds = time.time() - self.start_time
+        stage_dicts = self.get_stage_dicts()
+        print('Run stage times for ' + self.script_name + ':')
+        for stage_dict in stage_dicts:
+            print('  ' + stage_dict['stage'] + ': ' + str(stage_dict['seconds']) + ' secs')
+        run_dict = dict(self.counts)
+        run_dict.update({'stage': 'run', 'seconds': round(run_seconds, 3), 'success': bool(success)})
+        if self.log_file is not None:
+            lines = []
+            for stage_dict in stage_dicts + [run_dict]:
+                line_dict = {'run_id': self.run_id, 'script': self.script_name, 'time': round(self.start_time, 3)}
+                line_dict.update(stage_dict)
+                lines.append(json.dumps(line_dict) + '\n')
+            try:
+                with open(self.log_file, 'a') as f:
+                    f.writelines(lines)
+                add_written_path(self.log_file)
+            except Exception as e:
+                print('Failed to write run log: ' + self.log_file + ' ' + str(e))
+        if self.prom_folder is not None:
+            self.write_prom_file(stage_dicts, run_dict)
+        return stage_dicts
+
+    def write_prom_file(self, stage_dicts, run_dict):
+        # Each script writes its own file, replaced atomically as the textfile collector requires
+        metrics = dict()
+        for stage_dict in stage_dicts:
+            labels = 'script="' + self.script_name + '",stage="' + stage_dict['stage'] + '"'
+            for name, value in stage_dict.items():
+                if name == 'stage':
+                    continue
+                if name.endswith('_per_sec'):
+                    metric = 'stage_rate'
+                    name = name[:-len('_per_sec')]
+                elif name.endswith('_seconds') or name == 'seconds':
+                    metric = 'stage_seconds'
+                    name = name[:-len('_seconds')] if name != 'seconds' else 'total'
+                else:
+                    metric = 'stage_count'
+                metrics.setdefault(metric, []).append(labels + ',name="' + name + '"} ' + str(value))
+        run_labels = 'script="' + self.script_name + '"} '
+        metrics['run_seconds'] = [run_labels + str(run_dict['seconds'])]
+        metrics['run_success'] = [run_labels + ('1' if run_dict['success'] else '0')]
+        metrics['run_timestamp_seconds'] = [run_labels + str(round(self.start_time, 3))]
+        lines = []
+        for metric, values in metrics.items():
+            lines.append('# TYPE ' + METRICS_PREFIX + '_' + metric + ' gauge')
+            lines += [METRICS_PREFIX + '_' + metric + '{' + value for value in values]
+        prom_file = os.path.join(self.prom_folder, METRICS_PREFIX + '_' + self.script_name + '.prom')
+        try:
+            if os.path.exists(self.prom_folder) == False:
+                os.makedirs(self.prom_folder)
+            write_list_to_file(lines, prom_file)
+        except Exception as e:
+            print('Failed to write metrics file: ' + prom_file + ' ' + str(e))
 
-            shutil.copy(file, random_folder)
-            #print("File: " + image_file_path + " Copied to: " + random_folder)
-        except FileNotFoundError:
-            print("Error file " + copy_files + "not found") 
+
+
+class stage_journal(object):
+    # Append only record of the keys, such as folders, that each stage of a run has finished.
+    # A rerun with the same run_key skips them, so a crash or power loss only loses the work since
+    # the last checkpoint. A different run_key, for example from changed settings, starts over.
+    # Call finish() when the run completes to remove the journal.
+
+    def __init__(self, journal_file, run_key = ''):
+        self.journal_file = journal_file
+        self.run_key = str(run_key)
+        self.done = dict()
+        lines = []
+        if os.path.exists(journal_file):
+            try:
+                with open(journal_file) as f:
+                    # The last line is only complete if it ends with a newline
+                    lines = f.read().split('\n')[:-1]
+            except Exception as e:
+                print('Failed to read stage journal: ' + journal_file + ' ' + str(e))
+        if len(lines) > 0 and lines[0] == 'run\t' + self.run_key:
+            for line in lines[1:]:
+                entry = line.split('\t', 1)
+                if len(entry) != 2:
+                    continue
+                if entry[0] == 'reset':
+                    self.done.pop(entry[1], None)
+                else:
+                    self.done.setdefault(entry[0], set()).add(entry[1])
+            print('Resuming unfinished run from stage journal: ' +
+                  str(dict((stage, len(keys)) for stage, keys in self.done.items())))
+        else:
+            if len(lines) > 0:
+                print('Settings changed since the unfinished run in stage journal, starting over')
+            write_list_to_file(['run\t' + self.run_key], journal_file)
+        self.journal = open(journal_file, 'a')
+
+    def is_done(self, stage, key):
+        return key in self.done.get(stage, ())
+
+    def get_keys(self, stage):
+        return set(self.done.get(stage, ()))
+
+    def get_pending(self, stage, keys):
+        return [key for key in keys if self.is_done(stage, key) == False]
+
+    def mark_done(self, stage, keys):
+        # Records one key or a list of keys, synced to disk before returning
+        if isinstance(keys, str):
+            keys = [keys]
+        if len(keys) == 0:
+            return
+        done = self.done.setdefault(stage, set())
+        for key in keys:
+            done.add(key)
+            self.journal.write(stage + '\t' + key + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def reset_stage(self, stage):
+        # Forgets the finished keys of a stage, for example when its inputs changed during the run
+        self.done.pop(stage, None)
+        self.mark_done('reset', stage)
+        self.done.pop('reset', None)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def finish(self):
+        self.close()
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+        self.done = dict()
+
+
+
+class folder_watcher(object):
+    # Reports files that are added to a folder tree, using inotify when available and polling folder mtimes otherwise
+
+    def __init__(self, folder_path, recursive = True, poll_interval = WATCH_POLL_INTERVAL):
+        self.folder_path = folder_path
+        self.recursive = recursive
+        self.poll_interval = poll_interval
+        self.inotify_fd = None
+        self.watch_folders = dict()
+        self.folder_mtimes = dict()
+        self.folder_files = dict()
+        self.last_event_time = 0
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            self.inotify_fd = fd
         except Exception as e:
-            print("Excepton: " + str(e))
-    
-    return img_files
+            print('Inotify not available, polling for changes every ' + str(poll_interval) + ' secs: ' + str(e))
+        self.add_folder(folder_path)
+        for folder in get_folder_list(folder_path, recursive = recursive):
+            self.add_folder(folder)
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+    def add_folder(self, folder):
+        # Starts watching a folder and returns the files already in it
+        files = set(entry.path for [file_type, entry] in scan_folder(folder))
+        self.folder_files[folder] = files
+        try:
+            self.folder_mtimes[folder] = os.stat(folder).st_mtime_ns
+        except OSError:
+            pass
+        if self.inotify_fd is not None:
+            wd = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            if wd < 0:
+                print('Failed to watch folder: ' + folder + ' ' + os.strerror(ctypes.get_errno()))
+            else:
+                self.watch_folders[wd] = folder
+        return files
+
+    def can_add_folder(self, folder):
+        return self.recursive == True or os.path.dirname(folder) == self.folder_path
+
+    def get_changes(self, timeout):
+        # Waits up to timeout secs and returns the set of file paths that were added or written
+        if self.inotify_fd is not None:
+            return self.read_events(timeout)
+        time.sleep(timeout)
+        return self.poll_folders()
+
+    def read_events(self, timeout):
+        changes = set()
+        ready = select.select([self.inotify_fd], [], [], timeout)[0]
+        if len(ready) == 0:
+            return changes
+        try:
+            data = os.read(self.inotify_fd, 65536)
+        except BlockingIOError:
+            return changes
+        # Any event, even one that adds no files, means the drop is still being written
+        self.last_event_time = time.time()
+        offset = 0
+        while offset + INOTIFY_EVENT_SIZE <= len(data):
+            [wd, mask, cookie, name_len] = struct.unpack_from('iIII', data, offset)
+            name = data[offset + INOTIFY_EVENT_SIZE:offset + INOTIFY_EVENT_SIZE + name_len].rstrip(b'\0')
+            offset += INOTIFY_EVENT_SIZE + name_len
+            if mask & IN_Q_OVERFLOW:
+                print('Missed folder watch events, rescanning folders')
+                changes.update(self.poll_folders(force = True))
+                continue
+            folder = self.watch_folders.get(wd)
+            if folder is None or len(name) == 0:
+                continue
+            path = os.path.join(folder, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                # Files can land in a new folder before its watch is added
+                if self.can_add_folder(path):
+                    changes.update(self.add_folder(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changes.add(path)
+                self.folder_files.setdefault(folder, set()).add(path)
+        return changes
+
+    def poll_folders(self, force = False):
+        # Rescans only folders whose mtime changed, which is enough to find added files
+        changes = set()
+        for folder in [self.folder_path] + get_folder_list(self.folder_path, recursive = self.recursive):
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+            except OSError:
+                continue
+            if folder not in self.folder_files:
+                if self.inotify_fd is None or force == True:
+                    changes.update(self.add_folder(folder))
+                continue
+            if mtime == self.folder_mtimes.get(folder) and force == False:
+                continue
+            self.folder_mtimes[folder] = mtime
+            files = set(entry.path for [file_type, entry] in scan_folder(folder))
+            changes.update(files - self.folder_files[folder])
+            self.folder_files[folder] = files
+            self.last_event_time = time.time()
+        return changes
+
+    def wait_for_drop(self, debounce = WATCH_DEBOUNCE_SECONDS):
+        # Blocks until files are added, then until no more are added for debounce secs. Returns the added files.
+        changes = set()
+        while len(changes) == 0:
+            changes.update(self.get_changes(self.poll_interval))
+        while time.time() - self.last_event_time < debounce:
+            changes.update(self.get_changes(min(debounce, self.poll_interval)))
+        return changes
 
 
 
@@ -713,7 +2248,7 @@ def get_user_choice(options):
 def get_new_label():
     while True:
         try:
-            name = int(input("Enter a label name: "))
+            name = input("Enter a label name: ").strip()
             if name == '':
                 print("Invalid input. Please try again")
             else:
@@ -724,28 +2259,102 @@ def get_new_label():
 
 
 
-def check_image_file(file_path):
+def verify_image_file(file_path):
     valid = False
-    file = os.path.basename(file_path)
-    f_ext = os.path.splitext(file)[1]
-    f_ext = f_ext.replace(".","")
-    if f_ext in IMAGE_FILE_TYPES and os.path.exists(file_path) == True:
-      try:
+    try:
         img = Image.open(file_path) # open the image file
         img.verify()
         valid = True
-      except:
+    except:
         #print('File not image: ' + str(file_path))
         pass
+    return valid
+
+def check_image_file(file_path):
+    valid = False
+    file = os.path.basename(file_path)
+    f_ext = os.path.splitext(file)[1]
+    f_ext = f_ext.replace(".","")
+    if f_ext in IMAGE_FILE_TYPES and os.path.exists(file_path) == True:
+      stat_info = os.stat(file_path)
+      cached = IMAGE_CHECK_CACHE.get(file_path)
+      if cached is not None and cached[0] == stat_info.st_size and cached[1] == stat_info.st_mtime_ns:
+        valid = cached[2]
+      else:
+        start_time = time.time()
+        valid = verify_image_file(file_path)
+        IMAGE_CHECK_CACHE[file_path] = [stat_info.st_size, stat_info.st_mtime_ns, valid]
+        count_metric('images_checked')
+        count_metric('image_check_seconds', time.time() - start_time)
     else:
         print('Image file not found: ' + str(file_path))
     return valid
 
+def check_image_files(file_paths, num_workers = None):
+    # Batch version of check_image_file. Returns dict of file path to valid.
+    # Cached results are reused and the rest are verified across a process pool.
+    valid_dict = dict()
+    check_list = []
+    for file_path in file_paths:
+        f_ext = os.path.splitext(file_path)[1].replace(".","")
+        try:
+            stat_info = os.stat(file_path)
+        except OSError:
+            stat_info = None
+        if f_ext not in IMAGE_FILE_TYPES or stat_info is None:
+            valid_dict[file_path] = False
+            continue
+        cached = IMAGE_CHECK_CACHE.get(file_path)
+        if cached is not None and cached[0] == stat_info.st_size and cached[1] == stat_info.st_mtime_ns:
+            valid_dict[file_path] = cached[2]
+        else:
+            check_list.append([file_path, stat_info.st_size, stat_info.st_mtime_ns])
+    if len(check_list) > 0:
+        start_time = time.time()
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        check_paths = [entry[0] for entry in check_list]
+        if num_workers > 1 and len(check_list) >= MIN_POOL_FILES:
+            print('Checking ' + str(len(check_list)) + ' image files with ' + str(num_workers) + ' workers')
+            chunk_size = max(1, len(check_list) // (num_workers * 4))
+            with concurrent.futures.ProcessPoolExecutor(max_workers = num_workers) as executor:
+                results = list(executor.map(verify_image_file, check_paths, chunksize = chunk_size))
+        else:
+            results = [verify_image_file(file_path) for file_path in check_paths]
+        for entry, valid in zip(check_list, results):
+            IMAGE_CHECK_CACHE[entry[0]] = [entry[1], entry[2], valid]
+            valid_dict[entry[0]] = valid
+        count_metric('images_checked', len(check_list))
+        count_metric('image_check_seconds', time.time() - start_time)
+    return valid_dict
+
+def load_image_check_cache(file_path):
+    global IMAGE_CHECK_CACHE_FILE
+    IMAGE_CHECK_CACHE_FILE = file_path
+    if os.path.exists(file_path):
+        try:
+            with open(file_path) as f:
+                for line in f:
+                    entry = line.rstrip('\n').split('\t')
+                    if len(entry) == 4:
+                        IMAGE_CHECK_CACHE[entry[0]] = [int(entry[1]), int(entry[2]), entry[3] == '1']
+            print('Loaded ' + str(len(IMAGE_CHECK_CACHE)) + ' image check results from: ' + file_path)
+        except Exception as e:
+            print("Failed to read image check cache: " + file_path + " " + str(e))
+    return len(IMAGE_CHECK_CACHE)
+
+def save_image_check_cache(file_path):
+    lines = []
+    for check_path, entry in IMAGE_CHECK_CACHE.items():
+        lines.append(check_path + '\t' + str(entry[0]) + '\t' + str(entry[1]) + '\t' + ('1' if entry[2] else '0'))
+    return write_list_to_file(lines, file_path)
+
 def remove_bad_label_files(folder_path):
   print("Checking for bad images in folder: " + folder_path)
-  path, dirs, files = next(os.walk(folder_path))
+  files = [entry.name for [file_type, entry] in scan_folder(folder_path)]
   data_size = len(files)
   ind = 0
+  check_image_files([folder_path + '/' + f for f in files])
   for f in files:
     f_ext = os.path.splitext(f)[1]
     f_ext = f_ext.replace(".","")